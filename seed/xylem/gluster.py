@@ -1,8 +1,16 @@
+import errno
+import grp
 import os
+import pwd
+import subprocess
+import time
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure, threadpool
 from rhumba import RhumbaPlugin
-from rhumba.utils import fork
+
+from seed.xylem.gluster_exec import GlusterExecutor
+from seed.xylem.gluster_xml import VolumeInfoParser
 
 
 class Plugin(RhumbaPlugin):
@@ -15,18 +23,93 @@ class Plugin(RhumbaPlugin):
         self.gluster_mounts = self.config.get('gluster_mounts', ['/data'])
         self.gluster_replica = self.config.get('gluster_replica')
         self.gluster_stripe = self.config.get('gluster_stripe')
+        # Read volume info as XML, which we parse as it arrives, rather than
+        # the human readable output.
+        self.gluster_xml = self.config.get('gluster_xml', True)
+
+        # Gluster commands contend for a cluster wide lock, so we only run a
+        # few at a time, kill any that hang, and retry the ones that lost the
+        # race for the lock.
+        self.executor = GlusterExecutor(
+            self.gluster_path,
+            concurrency=int(self.config.get('gluster_concurrency', 4)),
+            timeout=float(self.config.get('gluster_timeout', 120)),
+            retries=int(self.config.get('gluster_retries', 5)),
+            retry_delay=float(self.config.get('gluster_retry_delay', 1)))
+
+        # We keep the state of the volumes we've seen, and refresh all of it
+        # from a single `volume info` every volume_refresh_interval seconds,
+        # so that asking for a running volume doesn't need the CLI. Set it to
+        # 0 to always ask gluster.
+        self.volume_refresh_interval = float(
+            self.config.get('volume_refresh_interval', 60))
+        self._volumes = {}
+        self._volume_refresher = task.LoopingCall(self.refreshVolumes)
+
+        # How long, in total, we wait for every node to create the brick
+        # directories for a new volume.
+        self.createdirs_timeout = float(
+            self.config.get('createdirs_timeout', 60))
+        self.clock = reactor
+
+        # At most this many volumes are created or started at once by
+        # createvolumes.
+        self.createvolumes_pipeline = int(
+            self.config.get('createvolumes_pipeline', 4))
+
+        # Brick directories are created in a small thread pool, so that a
+        # slow disk doesn't hold up everything else this worker does.
+        self.createdirs_threads = int(self.config.get('createdirs_threads', 4))
+        self.createdirs_owner = self.config.get('createdirs_owner')
+        self.createdirs_group = self.config.get('createdirs_group')
+        self.createdirs_mode = self.config.get('createdirs_mode')
+        if isinstance(self.createdirs_mode, basestring):
+            self.createdirs_mode = int(self.createdirs_mode, 8)
+        self.createdirs_xattrs = self.config.get('createdirs_xattrs') or {}
+        self._dir_pool = threadpool.ThreadPool(
+            0, self.createdirs_threads, 'xylem-createdirs')
+
+        self._start_id = reactor.callWhenRunning(self._start)
+        self._shutdown_id = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self._reactor_shutdown)
+
+    def _start(self):
+        """ Start background work once the reactor is running
+        """
+        self._start_id = None
+        if self.volume_refresh_interval > 0:
+            self._volume_refresher.start(
+                self.volume_refresh_interval, now=False)
+
+    def _reactor_shutdown(self):
+        # The trigger is being fired, so there's nothing left to remove.
+        self._shutdown_id = None
+        return self._shutdown()
+
+    def _shutdown(self):
+        """ Stop background work. This is safe to call more than once.
+        """
+        if self._start_id is not None:
+            reactor.removeSystemEventTrigger(self._start_id)
+            self._start_id = None
+        if self._shutdown_id is not None:
+            reactor.removeSystemEventTrigger(self._shutdown_id)
+            self._shutdown_id = None
+        if self._volume_refresher.running:
+            self._volume_refresher.stop()
+        if self._dir_pool.started:
+            self._dir_pool.stop()
 
-    @defer.inlineCallbacks
     def callGluster(self, *args):
         """ Calls the gluster CLI tool with `*args`
         """
-        out, err, code = yield fork(self.gluster_path, args=args)
+        return self.executor.run(args)
 
-        if code > 0:
-            raise Exception(err)
-
-        else:
-            defer.returnValue(out.strip('\n').split('\n'))
+    def streamGluster(self, make_parser, *args):
+        """ Calls the gluster CLI tool with `*args`, feeding its output to
+        a parser from `make_parser` as it arrives
+        """
+        return self.executor.run(args, make_parser)
 
     def _parseVolumeInfo(self, volumeInfo):
         """ Parse the output of a volume info command
@@ -57,23 +140,60 @@ class Plugin(RhumbaPlugin):
 
         return vols
 
-    def getVolumes(self):
-        """ Gets volume information from glusterfs on this server
+    def _cacheVolumes(self, vols, replace=False):
+        """ Remember the state of `vols`, replacing everything we knew if
+        `replace` is set
+        """
+        if self.volume_refresh_interval > 0:
+            if replace:
+                self._volumes = {}
+            self._volumes.update(vols)
+        return vols
+
+    def refreshVolumes(self):
+        """ Refresh our cached state for every volume
+        """
+        def log_err(f):
+            self.log("Unable to refresh volume info: %s" % (
+                f.getErrorMessage(),))
+
+        d = self.getVolumes()
+        d.addCallbacks(lambda _: None, log_err)
+        return d
+
+    def _volumeInfo(self, *names):
+        """ Runs `volume info` and parses the output
         """
-        d = self.callGluster('volume', 'info')
+        if self.gluster_xml:
+            args = ('volume', 'info') + names + ('--xml',)
+            return self.streamGluster(VolumeInfoParser, *args)
+
+        d = self.callGluster('volume', 'info', *names)
         d.addCallback(self._parseVolumeInfo)
         return d
 
-    def getVolume(self, name):
+    def getVolumes(self):
         """ Gets volume information from glusterfs on this server
         """
+        d = self._volumeInfo()
+        d.addCallback(self._cacheVolumes, replace=True)
+        return d
+
+    def getVolume(self, name, cached=True):
+        """ Gets volume information from glusterfs on this server. Volumes
+        we've already seen come from the cache unless `cached` is false.
+        """
         def catch_missing_volume(f):
             if f.value.args[0].strip().endswith('does not exist'):
+                self._volumes.pop(name, None)
                 return None
             return f
 
-        d = self.callGluster('volume', 'info', name)
-        d.addCallback(self._parseVolumeInfo)
+        if cached and name in self._volumes:
+            return defer.succeed(self._volumes[name])
+
+        d = self._volumeInfo(name)
+        d.addCallback(self._cacheVolumes)
         d.addCallback(lambda vols: vols[name])
         d.addErrback(catch_missing_volume)
         return d
@@ -98,25 +218,93 @@ class Plugin(RhumbaPlugin):
 
         return tuple(args)
 
-    @defer.inlineCallbacks
-    def createVolume(self, name):
-        """ Creates a Gluster volume
+    def waitForNodes(self, id, servers, timeout):
+        """ Wait for the result of job `id` from each of `servers` at once,
+        giving up on the ones that haven't answered after `timeout` seconds.
+        Returns each server's result, keyed by its host
         """
+        results = {}
+        done = defer.Deferred()
+
+        def finish():
+            if done.called:
+                return
+            if timer.active():
+                timer.cancel()
+            for server in servers:
+                results.setdefault(server['host'], {
+                    'Err': 'No result after %ss' % (timeout,)})
+            done.callback(results)
+
+        def node_done(r, host):
+            if isinstance(r, failure.Failure):
+                result = {'Err': r.getErrorMessage()}
+            else:
+                result = r.get('result') if r else None
+                if not isinstance(result, dict):
+                    result = {'Err': 'Unexpected result %r' % (result,)}
+            if not done.called:
+                results[host] = result
+                if len(results) == len(servers):
+                    finish()
+
+        timer = self.clock.callLater(timeout, finish)
+        for server in servers:
+            d = self.client.waitForResult(
+                self.queue_name, id, timeout=timeout, suid=server['uuid'])
+            d.addBoth(node_done, server['host'])
+
+        if not servers:
+            finish()
+        return done
 
-        args = self._createArgs(name)
-
-        # Fan out in rhumba and create volume paths
+    @defer.inlineCallbacks
+    def createDirs(self, names):
+        """ Fan out in rhumba to create the directories for volumes `names`
+        on every node. Returns the errors for each volume that failed on any
+        node
+        """
         queue = self.queue_name
         cluster_queues = yield self.client.clusterQueues()
-        server_uuids = [i['uuid'] for i in cluster_queues[queue]]
+        servers = cluster_queues[queue]
 
+        if len(names) == 1:
+            params = {'name': names[0]}
+        else:
+            params = {'names': names}
         id = yield self.client.queue(
-            queue, 'createdirs', {'name': name},
-            uids=server_uuids)
+            queue, 'createdirs', params,
+            uids=[server['uuid'] for server in servers])
+
+        results = yield self.waitForNodes(
+            id, servers, self.createdirs_timeout)
 
-        # Wait for all servers to finish
-        for uid in server_uuids:
-            yield self.client.waitForResult(queue, id, timeout=60, suid=uid)
+        errors = {}
+        for host, r in sorted(results.items()):
+            if not r.get('Err'):
+                continue
+            # Without a breakdown by volume, the whole node failed.
+            failed = r.get('failed') or dict.fromkeys(names, r['Err'])
+            for name, err in failed.items():
+                errors.setdefault(name, []).append('%s: %s' % (host, err))
+
+        defer.returnValue(
+            dict((name, ', '.join(errs)) for name, errs in errors.items()))
+
+    @defer.inlineCallbacks
+    def createVolume(self, name, dirs=True):
+        """ Creates a Gluster volume, and its directories unless `dirs` is
+        false
+        """
+
+        args = self._createArgs(name)
+
+        if dirs:
+            # Don't create a volume with bricks that may be missing.
+            errors = yield self.createDirs([name])
+            if errors:
+                raise Exception('Unable to create directories for %s: %s' % (
+                    name, errors[name]))
 
         self.log('[gluster] %s' % ' '.join(args))
 
@@ -126,36 +314,127 @@ class Plugin(RhumbaPlugin):
     def startVolume(self, name):
         """ Starts an existing Gluster volume
         """
-        return self.callGluster('volume', 'start', name)
+        def started(r):
+            if name in self._volumes:
+                self._volumes[name]['running'] = True
+            return r
 
-    def call_createdirs(self, args):
-        """Fan out call to create directories
+        d = self.callGluster('volume', 'start', name)
+        d.addCallback(started)
+        return d
+
+    def call_gluster_stats(self, args):
+        """ Report on the gluster commands we've run
         """
-        name = args['name']
+        stats = self.executor.stats()
+        stats['Err'] = None
+        return stats
 
-        for mount in self.gluster_mounts:
-            path = os.path.join(mount, name)
+    def _dirOwner(self):
+        """ The uid and gid brick directories should have, -1 meaning leave
+        it alone
+        """
+        uid = gid = -1
+        owner, group = self.createdirs_owner, self.createdirs_group
+        if owner is not None:
+            uid = owner if isinstance(owner, int) else pwd.getpwnam(
+                owner).pw_uid
+        if group is not None:
+            gid = group if isinstance(group, int) else grp.getgrnam(
+                group).gr_gid
+        return uid, gid
+
+    def _createDir(self, path):
+        """ Create and set up a brick directory, returning the error if that
+        failed
+        """
+        try:
             try:
                 os.makedirs(path)
-            except os.error, e:
-                # Raise any error except path exists
-                if e.errno != 17:
-                    return {'Err': str(e)}
+            except OSError as e:
+                # Raise any error except the directory existing already
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
+
+            if self.createdirs_mode is not None:
+                os.chmod(path, self.createdirs_mode)
+            if (self.createdirs_owner is not None or
+                    self.createdirs_group is not None):
+                os.chown(path, *self._dirOwner())
+            for name, value in sorted(self.createdirs_xattrs.items()):
+                subprocess.check_call(
+                    ['setfattr', '-n', name, '-v', str(value), path])
+        except Exception as e:
+            return str(e)
+
+        return None
+
+    def _createMountDirs(self, mount, names):
+        """ Create the directories for `names` on one mount. This blocks, so
+        it runs in the thread pool
+        """
+        start = time.time()
+        failed = {}
+        for name in names:
+            err = self._createDir(os.path.join(mount, name))
+            if err:
+                failed[name] = err
+
+        return {
+            'Err': ', '.join(failed[n] for n in names if n in failed) or None,
+            'failed': failed,
+            'time': time.time() - start,
+        }
 
-        return {'Err': None}
+    def call_createdirs(self, args):
+        """Fan out call to create directories
+        """
+        names = args.get('names') or [args['name']]
+
+        if not self._dir_pool.started:
+            self._dir_pool.start()
+
+        mounts = list(self.gluster_mounts)
+        d = defer.gatherResults([
+            threads.deferToThreadPool(
+                reactor, self._dir_pool, self._createMountDirs, mount, names)
+            for mount in mounts])
+
+        def report(results):
+            errors = ['%s: %s' % (mount, r['Err'])
+                      for mount, r in zip(mounts, results) if r['Err']]
+            failed = {}
+            for mount, r in zip(mounts, results):
+                for name, err in r['failed'].items():
+                    failed.setdefault(name, []).append(
+                        '%s: %s' % (mount, err))
+            return {
+                'Err': ', '.join(errors) or None,
+                'failed': dict(
+                    (name, ', '.join(errs)) for name, errs in failed.items()),
+                'mounts': dict(zip(mounts, results)),
+            }
+
+        d.addCallback(report)
+        return d
 
     @defer.inlineCallbacks
     def call_createvolume(self, args):
 
         name = args['name']
+        cached = name in self._volumes
         vol = yield self.getVolume(name)
 
+        if cached and not vol['running']:
+            # Someone may have started it since we last looked.
+            vol = yield self.getVolume(name, cached=False)
+
         if vol is None:
             # The volume doesn't exist, let's create it.
             yield self.createVolume(name)
-            vols = yield self.getVolumes()
-            self.log("Volume created %s" % repr(vols[name]))
-            defer.returnValue(vols[name])
+            vol = yield self.getVolume(name)
+            self.log("Volume created %s" % repr(vol))
+            defer.returnValue(vol)
 
         elif vol['running']:
             # The volume is running, everything's happy.
@@ -165,6 +444,67 @@ class Plugin(RhumbaPlugin):
         else:
             # The volume exists but isn't running, start it.
             yield self.startVolume(name)
+            vol = yield self.getVolume(name)
+            self.log("Volume started %s" % repr(vol))
+            defer.returnValue(vol)
+
+    @defer.inlineCallbacks
+    def _provisionVolume(self, name, vol, dirs_error):
+        """ Make sure volume `name` exists and is running, given what we know
+        about it
+        """
+        try:
+            if vol is None:
+                if dirs_error:
+                    raise Exception(
+                        'Unable to create directories: %s' % (dirs_error,))
+                yield self.createVolume(name, dirs=False)
+                status = 'created'
+            elif not vol['running']:
+                yield self.startVolume(name)
+                status = 'started'
+            else:
+                status = 'exists'
+        except Exception as e:
+            self.log("Unable to provision volume %s: %s" % (name, e))
+            defer.returnValue({'Err': str(e)})
+
+        defer.returnValue({'Err': None, 'status': status})
+
+    @defer.inlineCallbacks
+    def call_createvolumes(self, args):
+        """ Make sure each of the volumes `names` exists and is running,
+        creating their directories on every node in one go and at most
+        `createvolumes_pipeline` volumes at a time
+        """
+        names = []
+        for name in args['names']:
+            if name not in names:
+                names.append(name)
+
+        vols = yield self.getVolumes()
+
+        missing = [name for name in names if name not in vols]
+        dirs_errors = {}
+        if missing:
+            dirs_errors = yield self.createDirs(missing)
+
+        sem = defer.DeferredSemaphore(self.createvolumes_pipeline)
+        results = yield defer.gatherResults([
+            sem.run(self._provisionVolume,
+                    name, vols.get(name), dirs_errors.get(name))
+            for name in names])
+        results = dict(zip(names, results))
+
+        if any(r.get('status') in ('created', 'started')
+               for r in results.values()):
             vols = yield self.getVolumes()
-            self.log("Volume started %s" % repr(vols[name]))
-            defer.returnValue(vols[name])
+        for name, result in results.items():
+            if result['Err'] is None:
+                result['volume'] = vols.get(name)
+
+        failed = sorted(name for name, r in results.items() if r['Err'])
+        err = None
+        if failed:
+            err = 'Unable to provision %s' % (', '.join(failed),)
+        defer.returnValue({'Err': err, 'volumes': results})
@@ -0,0 +1,193 @@
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.python import failure
+
+# Errors gluster gives when another command holds the cluster lock. These go
+# away by themselves, so the command is worth trying again.
+RETRY_ERRORS = [
+    'Another transaction is in progress',
+    'Locking failed on',
+]
+
+
+class GlusterProcess(protocol.ProcessProtocol):
+    """
+    Runs a gluster CLI command, and fires `deferred` once the process has
+    ended. With a parser, output is fed to it as it arrives and the result is
+    whatever the parser's `close()` returns, otherwise the result is the
+    lines of output.
+    """
+
+    def __init__(self, parser=None):
+        self.parser = parser
+        self.deferred = defer.Deferred()
+        self.timed_out = False
+        self._out = []
+        self._err = []
+        self._failure = None
+
+    def outReceived(self, data):
+        if self.parser is None:
+            self._out.append(data)
+        elif self._failure is None:
+            try:
+                self.parser.feed(data)
+            except Exception:
+                self._failure = failure.Failure()
+
+    def errReceived(self, data):
+        self._err.append(data)
+
+    def kill(self):
+        self.timed_out = True
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def _result(self):
+        if self.parser is None:
+            return ''.join(self._out).strip('\n').split('\n')
+        return self.parser.close()
+
+    def processEnded(self, reason):
+        result = None
+        if self._failure is None and not self.timed_out:
+            try:
+                result = self._result()
+            except Exception:
+                self._failure = failure.Failure()
+
+        parser_error = getattr(self.parser, 'error', None)
+        if self.timed_out:
+            self.deferred.errback(Exception('Timed out'))
+        elif parser_error is not None:
+            self.deferred.errback(Exception(parser_error))
+        elif reason.value.signal is not None or reason.value.exitCode != 0:
+            # Anything killed by a signal failed, even if it wrote output.
+            self.deferred.errback(
+                Exception(''.join(self._err) or str(reason.value)))
+        elif self._failure is not None:
+            self.deferred.errback(self._failure)
+        else:
+            self.deferred.callback(result)
+
+
+class _CommandStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.total_wait = 0.0
+
+
+class GlusterExecutor(object):
+    """
+    Runs gluster CLI commands, at most `concurrency` at a time. Commands
+    beyond that wait their turn in the order they were asked for.
+
+    A command running for longer than `timeout` seconds is killed. Commands
+    that fail because another one holds the cluster lock are tried again up
+    to `retries` times, waiting `retry_delay` seconds (doubling each time)
+    at the back of the queue in between.
+    """
+
+    def __init__(self, gluster_path, concurrency=4, timeout=120, retries=5,
+                 retry_delay=1, clock=None):
+        self.gluster_path = gluster_path
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._reactor = reactor if clock is None else clock
+        self._sem = defer.DeferredSemaphore(concurrency)
+        self._stats = {}
+
+    @property
+    def running(self):
+        return self._sem.limit - self._sem.tokens
+
+    @property
+    def queued(self):
+        return len(self._sem.waiting)
+
+    def _command_stats(self, args):
+        return self._stats.setdefault(' '.join(args[:2]), _CommandStats())
+
+    def _retryable(self, e):
+        return any(err in str(e) for err in RETRY_ERRORS)
+
+    def _spawn(self, args, make_parser, queued_at):
+        stats = self._command_stats(args)
+        start = self._reactor.seconds()
+        stats.total_wait += start - queued_at
+
+        proto = GlusterProcess(None if make_parser is None else make_parser())
+        self._reactor.spawnProcess(
+            proto, self.gluster_path, (self.gluster_path,) + args, env={})
+        timer = None
+        if self.timeout:
+            timer = self._reactor.callLater(self.timeout, proto.kill)
+
+        def done(r):
+            if timer is not None and timer.active():
+                timer.cancel()
+            elapsed = self._reactor.seconds() - start
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            if isinstance(r, failure.Failure):
+                stats.errors += 1
+                if proto.timed_out:
+                    stats.timeouts += 1
+                    return failure.Failure(Exception(
+                        'gluster %s timed out after %ss' % (
+                            ' '.join(args), self.timeout)))
+            return r
+
+        proto.deferred.addBoth(done)
+        return proto.deferred
+
+    @defer.inlineCallbacks
+    def run(self, args, make_parser=None):
+        """
+        Run gluster with `args` once there's room. `make_parser`, if given,
+        is called for a new parser for each attempt.
+        """
+        args = tuple(args)
+        attempt = 0
+        while True:
+            try:
+                result = yield self._sem.run(
+                    self._spawn, args, make_parser, self._reactor.seconds())
+            except Exception as e:
+                if attempt >= self.retries or not self._retryable(e):
+                    raise
+                self._command_stats(args).retries += 1
+                yield task.deferLater(
+                    self._reactor, self.retry_delay * 2 ** attempt,
+                    lambda: None)
+                attempt += 1
+            else:
+                defer.returnValue(result)
+
+    def stats(self):
+        commands = {}
+        for command, stats in self._stats.items():
+            commands[command] = {
+                'calls': stats.calls,
+                'errors': stats.errors,
+                'timeouts': stats.timeouts,
+                'retries': stats.retries,
+                'avg_time': stats.total_time / stats.calls
+                if stats.calls else None,
+                'max_time': stats.max_time,
+                'avg_wait': stats.total_wait / stats.calls
+                if stats.calls else None,
+            }
+        return {
+            'running': self.running,
+            'queued': self.queued,
+            'commands': commands,
+        }
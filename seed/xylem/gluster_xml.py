@@ -0,0 +1,132 @@
+from xml.etree import ElementTree
+
+
+class _VolumeInfoTarget(object):
+    """
+    An ElementTree parser target that turns each <volume> element of
+    `gluster volume info --xml` output into a compact dict as soon as it
+    ends, without building a tree.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.op_ret = None
+        self.op_errstr = None
+        self._tags = []
+        self._texts = []
+        self._volume = None
+        self._depth = None
+        self._brick = None
+        self._option = None
+
+    def _path(self):
+        """
+        Where we are inside the current volume element, if we're in one.
+        """
+        if self._volume is None:
+            return None
+        return tuple(self._tags[self._depth:])
+
+    def start(self, tag, attrib):
+        self._tags.append(tag)
+        self._texts.append([])
+        path = self._path()
+        if path is None:
+            if tag == 'volume' and self._tags[-2:-1] == ['volumes']:
+                self._volume = {
+                    'name': None,
+                    'running': False,
+                    'bricks': [],
+                    'brick_uuids': {},
+                    'options': {},
+                }
+                self._depth = len(self._tags)
+        elif path == ('bricks', 'brick'):
+            self._brick = {'name': None, 'uuid': attrib.get('uuid')}
+        elif path == ('options', 'option'):
+            self._option = {}
+
+    def data(self, data):
+        if self._texts:
+            self._texts[-1].append(data)
+
+    def end(self, tag):
+        text = ''.join(self._texts.pop()).strip()
+        path = self._path()
+        self._tags.pop()
+        vol = self._volume
+
+        if path is None:
+            if tag == 'opRet':
+                self.op_ret = int(text)
+            elif tag == 'opErrstr':
+                self.op_errstr = text
+        elif path == ():
+            self._volume = None
+            self.callback(vol.pop('name'), vol)
+        elif path == ('name',):
+            vol['name'] = text
+        elif path == ('id',):
+            vol['id'] = text
+        elif path == ('statusStr',):
+            vol['running'] = text == 'Started'
+        elif path == ('typeStr',):
+            vol['type'] = text
+        elif path == ('brickCount',):
+            vol['brick_count'] = int(text)
+        elif path == ('bricks', 'brick', 'name'):
+            self._brick['name'] = text
+        elif path == ('bricks', 'brick', 'hostUuid'):
+            self._brick['uuid'] = text
+        elif path == ('bricks', 'brick'):
+            # Older versions of gluster only have the brick as text.
+            brick = self._brick['name'] or text
+            vol['bricks'].append(brick)
+            vol['brick_uuids'][brick] = self._brick['uuid']
+            self._brick = None
+        elif path in [('options', 'option', 'name'),
+                      ('options', 'option', 'value')]:
+            self._option[path[-1]] = text
+        elif path == ('options', 'option'):
+            vol['options'][self._option.get('name')] = self._option.get(
+                'value')
+            self._option = None
+
+    def close(self):
+        pass
+
+
+class VolumeInfoParser(object):
+    """
+    Incrementally parse `gluster volume info --xml` output as it is fed in.
+
+    Each volume is passed to `callback` (with its name and a dict of its
+    details) as soon as its element is complete. Without a callback, volumes
+    are collected in `volumes` instead.
+    """
+
+    def __init__(self, callback=None):
+        self.volumes = {}
+        if callback is None:
+            callback = self.volumes.__setitem__
+        self._target = _VolumeInfoTarget(callback)
+        self._parser = ElementTree.XMLParser(target=self._target)
+
+    @property
+    def error(self):
+        """
+        The error gluster reported, if it reported one.
+        """
+        if self._target.op_ret:
+            return self._target.op_errstr or 'Unknown gluster error'
+        return None
+
+    def feed(self, data):
+        self._parser.feed(data)
+
+    def close(self):
+        """
+        Finish parsing, and return the volumes we collected.
+        """
+        self._parser.close()
+        return self.volumes
@@ -0,0 +1,256 @@
+from collections import deque
+
+from twisted.enterprise import adbapi
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from seed.xylem.pg_compat import psycopg2, extensions
+
+
+def connect_async(**kw):
+    kw['async'] = True
+    return psycopg2.connect(**kw)
+
+
+class AsyncConnection(object):
+    """
+    A psycopg2 connection in asynchronous mode, driven by the reactor instead
+    of a thread. Only one query may be in progress at a time.
+
+    libpq ignores `connect_timeout` for asynchronous connections, so we
+    enforce it ourselves.
+    """
+
+    def __init__(self, conn, cursor_factory=None, clock=None,
+                 connect_timeout=None):
+        self._conn = conn
+        self._cursor_factory = cursor_factory
+        self._reactor = reactor if clock is None else clock
+        self._connect_timeout = connect_timeout
+        self._waiting = None
+
+    def fileno(self):
+        return self._conn.fileno()
+
+    def logPrefix(self):
+        return self.__class__.__name__
+
+    def _poll(self):
+        self._waiting = defer.Deferred()
+        d = self._waiting
+        self._continue()
+        return d
+
+    def _continue(self):
+        try:
+            state = self._conn.poll()
+        except Exception:
+            self._finish(failure.Failure())
+            return
+        if state == extensions.POLL_OK:
+            self._finish(None)
+        elif state == extensions.POLL_READ:
+            self._reactor.addReader(self)
+        elif state == extensions.POLL_WRITE:
+            self._reactor.addWriter(self)
+        else:
+            self._finish(failure.Failure(psycopg2.OperationalError(
+                "Unexpected poll state: %r" % (state,))))
+
+    def _finish(self, result):
+        d, self._waiting = self._waiting, None
+        if d is None:
+            return
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def doRead(self):
+        self._reactor.removeReader(self)
+        self._continue()
+
+    def doWrite(self):
+        self._reactor.removeWriter(self)
+        self._continue()
+
+    def connectionLost(self, reason):
+        # The reactor is letting go of us, most likely because it's stopping.
+        self._finish(reason)
+
+    def connect(self):
+        """
+        Wait for the connection to be established, giving up after
+        `connect_timeout` seconds.
+        """
+        d = self._poll()
+        if self._connect_timeout:
+            timer = self._reactor.callLater(
+                float(self._connect_timeout), self._timed_out)
+
+            def done(r):
+                if timer.active():
+                    timer.cancel()
+                return r
+            d.addBoth(done)
+        return d.addCallback(lambda _: self)
+
+    def _timed_out(self):
+        self.close()
+        self._finish(failure.Failure(psycopg2.OperationalError(
+            "timeout expired")))
+
+    def execute(self, sql, args=None):
+        """
+        Run a statement, returning a Deferred that fires with the cursor.
+        """
+        try:
+            cursor = self._conn.cursor(cursor_factory=self._cursor_factory)
+            cursor.execute(sql, args)
+        except Exception:
+            return defer.fail()
+        return self._poll().addCallback(lambda _: cursor)
+
+    def runQuery(self, sql, args=None):
+        return self.execute(sql, args).addCallback(lambda c: c.fetchall())
+
+    def runOperation(self, sql, args=None):
+        return self.execute(sql, args).addCallback(lambda _: None)
+
+    def broken(self, f):
+        """
+        Whether a failure means this connection shouldn't be used again.
+        """
+        return bool(self._conn.closed) or f.check(
+            psycopg2.OperationalError, psycopg2.InterfaceError) is not None
+
+    def close(self):
+        if self._conn.closed:
+            return
+        self._reactor.removeReader(self)
+        self._reactor.removeWriter(self)
+        self._conn.close()
+
+
+class AsyncConnectionPool(object):
+    """
+    A pool of asynchronous psycopg2 connections, with the parts of adbapi's
+    `ConnectionPool` that we use. Queries and operations don't need a thread,
+    so we can have many of them in flight without a bigger threadpool.
+
+    Interactions are blocking code that expects a normal cursor, so those
+    still go through an adbapi pool, which is only created if it's needed.
+    """
+
+    def __init__(self, cp_min=1, cp_max=2, cp_reconnect=False,
+                 cp_good_sql=None, cp_openfun=None, cursor_factory=None,
+                 connect=connect_async, clock=None, **connkw):
+        """
+        :param connect:
+            Callable taking psycopg2's connection arguments and returning a
+            new asynchronous connection.
+
+        The remaining `cp_*` arguments are only used for interactions.
+        Connections that break are always dropped from the pool and replaced
+        on next use.
+        """
+        self.min = cp_min
+        self.max = cp_max
+        self._interaction_args = dict(
+            cp_min=cp_min, cp_max=cp_max, cp_reconnect=cp_reconnect,
+            cp_good_sql=cp_good_sql, cp_openfun=cp_openfun,
+            cursor_factory=cursor_factory)
+        self._cursor_factory = cursor_factory
+        self._connect = connect
+        self._connkw = connkw
+        self._clock = clock
+        self.connections = []
+        self._idle = []
+        self._waiters = deque()
+        self._interaction_pool = None
+        self.running = True
+
+    def _open(self):
+        try:
+            conn = AsyncConnection(
+                self._connect(**self._connkw),
+                cursor_factory=self._cursor_factory, clock=self._clock,
+                connect_timeout=self._connkw.get('connect_timeout'))
+        except Exception:
+            return defer.fail()
+        self.connections.append(conn)
+
+        def failed(f):
+            self._discard(conn)
+            return f
+
+        return conn.connect().addErrback(failed)
+
+    def _discard(self, conn):
+        if conn in self.connections:
+            self.connections.remove(conn)
+        conn.close()
+
+    def _acquire(self):
+        if not self.running:
+            return defer.fail(
+                psycopg2.InterfaceError("Connection pool is closed"))
+        if self._idle:
+            return defer.succeed(self._idle.pop())
+        if len(self.connections) < self.max:
+            return self._open()
+        d = defer.Deferred()
+        self._waiters.append(d)
+        return d
+
+    def _release(self, conn, broken=False):
+        if broken or not self.running:
+            self._discard(conn)
+            if self._waiters:
+                self._open().chainDeferred(self._waiters.popleft())
+        elif self._waiters:
+            self._waiters.popleft().callback(conn)
+        else:
+            self._idle.append(conn)
+
+    def _run(self, method, *args):
+        def run(conn):
+            def done(r):
+                self._release(conn, isinstance(r, failure.Failure) and (
+                    conn.broken(r)))
+                return r
+            return getattr(conn, method)(*args).addBoth(done)
+
+        return self._acquire().addCallback(run)
+
+    def runQuery(self, sql, args=None):
+        return self._run('runQuery', sql, args)
+
+    def runOperation(self, sql, args=None):
+        return self._run('runOperation', sql, args)
+
+    def runInteraction(self, interaction, *args, **kw):
+        if not self.running:
+            return defer.fail(
+                psycopg2.InterfaceError("Connection pool is closed"))
+        if self._interaction_pool is None:
+            pool_args = dict(self._connkw, **self._interaction_args)
+            self._interaction_pool = adbapi.ConnectionPool(
+                'psycopg2', **pool_args)
+        return self._interaction_pool.runInteraction(interaction, *args, **kw)
+
+    def close(self):
+        """
+        Close idle connections now, and the others as soon as they're done.
+        Anything still waiting for a connection fails.
+        """
+        self.running = False
+        waiters, self._waiters = self._waiters, deque()
+        for d in waiters:
+            d.errback(psycopg2.InterfaceError("Connection pool is closed"))
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+        if self._interaction_pool is not None:
+            self._interaction_pool.close()
+            self._interaction_pool = None
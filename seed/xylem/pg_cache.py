@@ -0,0 +1,65 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+
+class CredentialCache(object):
+    """
+    A bounded LRU cache with expiry for rows from the `databases` table.
+
+    Rows are stored exactly as they come out of the table, so passwords stay
+    encrypted while they're held in memory.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, clock=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = reactor if clock is None else clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        """
+        Return the cached row for `name`, or `None` if we don't have a fresh
+        one.
+        """
+        entry = self._entries.pop(name, None)
+        if entry is not None and entry[0] > self._clock.seconds():
+            # Re-insert to mark this as the most recently used entry.
+            self._entries[name] = entry
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def put(self, row):
+        """
+        Cache a row, evicting the least recently used entry if we're full.
+        """
+        if self.max_size <= 0:
+            return
+        name = row['name']
+        self._entries.pop(name, None)
+        self._entries[name] = (self._clock.seconds() + self.ttl, {
+            'name': row['name'],
+            'host': row['host'],
+            'username': row['username'],
+            'password': row['password'],
+        })
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, name):
+        self._entries.pop(name, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -8,7 +8,7 @@ except ImportError:
     pass
 
 import psycopg2
-from psycopg2 import errorcodes
+from psycopg2 import errorcodes, extensions
 from psycopg2.extras import DictCursor
 
-__all__ = ['psycopg2', 'errorcodes', 'DictCursor']
+__all__ = ['psycopg2', 'errorcodes', 'extensions', 'DictCursor']
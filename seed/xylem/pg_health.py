@@ -0,0 +1,86 @@
+from twisted.internet import reactor
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _ServerState(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.latency = None
+        self.last_error = None
+        self.last_checked = None
+
+
+class ServerHealth(object):
+    """
+    Circuit breakers for the target postgres servers.
+
+    A server's circuit opens after `failure_threshold` consecutive failed
+    checks, which takes it out of use. Once `reset_timeout` seconds have
+    passed the circuit is half-open, meaning we check it again, and a
+    successful check closes it.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30, clock=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = reactor if clock is None else clock
+        self._servers = {}
+
+    def _get(self, hostname):
+        return self._servers.setdefault(hostname, _ServerState())
+
+    def state(self, hostname):
+        server = self._servers.get(hostname)
+        if server is None or server.opened_at is None:
+            return CLOSED
+        if self._clock.seconds() - server.opened_at >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def available(self, hostname):
+        """
+        Should we send work to this server?
+        """
+        return self.state(hostname) == CLOSED
+
+    def should_check(self, hostname):
+        """
+        Should we check this server now? We leave open circuits alone until
+        they're ready to be retried.
+        """
+        return self.state(hostname) != OPEN
+
+    def record_success(self, hostname, latency):
+        server = self._get(hostname)
+        server.failures = 0
+        server.opened_at = None
+        server.latency = latency
+        server.last_error = None
+        server.last_checked = self._clock.seconds()
+
+    def record_failure(self, hostname, error):
+        server = self._get(hostname)
+        now = self._clock.seconds()
+        half_open = self.state(hostname) == HALF_OPEN
+        server.failures += 1
+        server.latency = None
+        server.last_error = error
+        server.last_checked = now
+        if half_open or server.failures >= self.failure_threshold:
+            server.opened_at = now
+
+    def stats(self):
+        stats = {}
+        for hostname, server in self._servers.items():
+            stats[hostname] = {
+                'state': self.state(hostname),
+                'failures': server.failures,
+                'latency': server.latency,
+                'last_error': server.last_error,
+                'last_checked': server.last_checked,
+            }
+        return stats
@@ -0,0 +1,82 @@
+# Schema migrations for xylem's internal DB.
+#
+# Each migration is a (version, description, statements) tuple. Versions must
+# only ever be added to the end of this list, and a migration must never be
+# changed once it has been released.
+
+MIGRATIONS = [
+    (1, "Create databases and warm_databases tables", [
+        # These may already exist if they were created before we tracked
+        # schema versions.
+        "CREATE TABLE IF NOT EXISTS databases (name varchar(66) UNIQUE,"
+        " host varchar(256), username varchar(256), password varchar(256));",
+        "CREATE TABLE IF NOT EXISTS warm_databases (name varchar(66) UNIQUE,"
+        " host varchar(256), username varchar(256), password varchar(256));",
+    ]),
+    (2, "Index databases by host", [
+        "CREATE INDEX databases_host_idx ON databases (host);",
+        "CREATE INDEX warm_databases_host_idx ON warm_databases (host);",
+    ]),
+    (3, "Add timestamps and server ids", [
+        "ALTER TABLE databases ADD COLUMN created_at timestamptz"
+        " DEFAULT now();",
+        "ALTER TABLE databases ADD COLUMN last_accessed timestamptz;",
+        "ALTER TABLE databases ADD COLUMN server_id varchar(256);",
+        "UPDATE databases SET server_id = host;",
+        "CREATE INDEX databases_server_id_idx ON databases (server_id);",
+    ]),
+    (4, "Track databases waiting to be dropped", [
+        "ALTER TABLE databases ADD COLUMN drop_requested_at timestamptz;",
+        "CREATE INDEX databases_drop_requested_idx ON databases"
+        " (drop_requested_at) WHERE drop_requested_at IS NOT NULL;",
+    ]),
+    (5, "Record resource profiles", [
+        "ALTER TABLE databases ADD COLUMN profile varchar(256);",
+    ]),
+]
+
+# Our advisory locks for creating databases use the class 0x78796c6d, so we
+# use the next one along for migrations.
+MIGRATION_LOCK = (0x78796c6e, 0)
+
+
+def current_version(migrations=MIGRATIONS):
+    return max(version for version, _, _ in migrations)
+
+
+def migrate(cursor, migrations=MIGRATIONS):
+    """
+    Apply any migrations that haven't been applied yet, in a single
+    transaction. This runs in a pool thread on an autocommit connection, so
+    we manage the transaction ourselves.
+
+    Returns a list of the versions that were applied.
+    """
+    cursor.execute("BEGIN;")
+    try:
+        # Only one xylem node at a time gets to migrate. The others wait here
+        # and then find nothing left to do.
+        cursor.execute(
+            "SELECT pg_advisory_xact_lock(%s, %s);", MIGRATION_LOCK)
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS xylem_schema ("
+            "version integer PRIMARY KEY, description text,"
+            " applied_at timestamptz DEFAULT now());")
+        cursor.execute("SELECT version FROM xylem_schema;")
+        applied = set(row[0] for row in cursor.fetchall())
+
+        done = []
+        for version, description, statements in migrations:
+            if version in applied:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO xylem_schema (version, description)"
+                " VALUES (%s, %s);", (version, description))
+            done.append(version)
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+    return done
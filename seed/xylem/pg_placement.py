@@ -0,0 +1,70 @@
+import random
+
+
+class Placement(object):
+    """
+    An index of per-server load used to choose where new databases go.
+
+    Stats are collected in the background and fed in with `update()`. Each
+    server's load is the sum of its database count, total database size and
+    connected backends, each normalised against the busiest server, divided
+    by the server's configured `weight`. Servers with a `max_databases`
+    setting are not eligible once they reach it.
+    """
+
+    def __init__(self, choice=random.choice):
+        self._choice = choice
+        self._stats = {}
+
+    def update(self, hostname, db_count, total_size, backends):
+        self._stats[hostname] = {
+            'db_count': db_count,
+            'total_size': total_size,
+            'backends': backends,
+        }
+
+    def remove(self, hostname):
+        self._stats.pop(hostname, None)
+
+    def stats(self):
+        return dict((k, dict(v)) for k, v in self._stats.items())
+
+    def _eligible(self, server):
+        stats = self._stats.get(server['hostname'])
+        if stats is None:
+            return False
+        limit = server.get('max_databases')
+        return limit is None or stats['db_count'] < int(limit)
+
+    def _load(self, server, maxima):
+        stats = self._stats[server['hostname']]
+        load = sum(
+            float(stats[k]) / maxima[k] for k in maxima if maxima[k] > 0)
+        return load / float(server.get('weight', 1))
+
+    def choose(self, servers):
+        """
+        Return the least loaded eligible server. If we don't have stats for
+        any of them yet, pick one at random.
+        """
+        if not servers:
+            return None
+        eligible = [s for s in servers if self._eligible(s)]
+        if not eligible:
+            known = [s for s in servers if s['hostname'] in self._stats]
+            if known:
+                # Everything we know about is full.
+                return None
+            return self._choice(servers)
+
+        maxima = {}
+        for k in ['db_count', 'total_size', 'backends']:
+            maxima[k] = max(self._stats[s['hostname']][k] for s in eligible)
+        loads = [(self._load(s, maxima), s) for s in eligible]
+        lowest = min(load for load, _ in loads)
+        server = self._choice([s for load, s in loads if load == lowest])
+
+        # Count the new database straight away, so that we don't pile
+        # everything onto one server between refreshes.
+        self._stats[server['hostname']]['db_count'] += 1
+        return server
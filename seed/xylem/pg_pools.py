@@ -0,0 +1,108 @@
+from twisted.internet import reactor
+
+
+class _PoolEntry(object):
+    def __init__(self, pool, max_size, now):
+        self.pool = pool
+        self.max_size = max_size
+        self.created = now
+        self.last_used = now
+        self.in_use = 0
+        self.requests = 0
+
+
+class ServerPools(object):
+    """
+    A registry of long-lived admin connection pools for the target postgres
+    servers, keyed by server hostname.
+
+    Pools are created the first time a server is used, shared by all requests
+    after that, and closed again once they have been idle for
+    `idle_timeout` seconds.
+    """
+
+    def __init__(self, connect, max_size=2, idle_timeout=300, clock=None):
+        """
+        :param connect:
+            Callable taking a server config dict and a maximum pool size and
+            returning a new `ConnectionPool` for that server.
+        """
+        self._connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clock = reactor if clock is None else clock
+        self._pools = {}
+
+    def key(self, server):
+        return server['hostname']
+
+    def _get(self, server):
+        key = self.key(server)
+        entry = self._pools.get(key)
+        if entry is None:
+            max_size = int(server.get('pool_max', self.max_size))
+            entry = _PoolEntry(
+                self._connect(server, max_size), max_size,
+                self._clock.seconds())
+            self._pools[key] = entry
+        return entry
+
+    def _run(self, server, method, *args, **kw):
+        entry = self._get(server)
+        entry.in_use += 1
+        entry.requests += 1
+
+        def release(r):
+            entry.in_use -= 1
+            entry.last_used = self._clock.seconds()
+            return r
+
+        d = getattr(entry.pool, method)(*args, **kw)
+        return d.addBoth(release)
+
+    def runQuery(self, server, *args, **kw):
+        return self._run(server, 'runQuery', *args, **kw)
+
+    def runOperation(self, server, *args, **kw):
+        return self._run(server, 'runOperation', *args, **kw)
+
+    def runInteraction(self, server, *args, **kw):
+        return self._run(server, 'runInteraction', *args, **kw)
+
+    def evict_idle(self):
+        """
+        Close any pools that have no requests in flight and haven't been used
+        for `idle_timeout` seconds.
+        """
+        now = self._clock.seconds()
+        for key, entry in self._pools.items():
+            if entry.in_use:
+                continue
+            if now - entry.last_used >= self.idle_timeout:
+                del self._pools[key]
+                entry.pool.close()
+
+    def stats(self):
+        """
+        Return a dict of usage information for each open pool.
+        """
+        now = self._clock.seconds()
+        stats = {}
+        for key, entry in self._pools.items():
+            stats[key] = {
+                'max_size': entry.max_size,
+                'connections': len(entry.pool.connections),
+                'in_use': entry.in_use,
+                'requests': entry.requests,
+                'age': now - entry.created,
+                'idle': 0 if entry.in_use else now - entry.last_used,
+            }
+        return stats
+
+    def close(self):
+        """
+        Close all pools.
+        """
+        pools, self._pools = self._pools, {}
+        for entry in pools.values():
+            entry.pool.close()
@@ -0,0 +1,105 @@
+from twisted.internet import defer
+
+# How far behind the primary a replica is, in seconds. A server that isn't
+# in recovery is the primary (or was promoted), so it isn't behind at all.
+REPLICA_LAG = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 ELSE coalesce("
+    "extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END;")
+
+
+class _Replica(object):
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.lag = None
+        self.last_error = None
+        self.queries = 0
+
+
+class ReadReplicas(object):
+    """
+    Route read-only queries for xylem's internal DB to replicas that are
+    keeping up, and everything else to the primary.
+
+    Replicas aren't used until we've checked their lag, and are dropped again
+    if they fall more than `max_lag` seconds behind or a check fails. A query
+    that fails on a replica is retried on the primary.
+    """
+
+    def __init__(self, primary, max_lag=5):
+        self.primary = primary
+        self.max_lag = max_lag
+        self._replicas = []
+        self._next = 0
+        self.primary_queries = 0
+
+    @property
+    def enabled(self):
+        return bool(self._replicas)
+
+    def add(self, name, pool):
+        self._replicas.append(_Replica(name, pool))
+
+    def _usable(self):
+        return [r for r in self._replicas
+                if r.lag is not None and r.lag <= self.max_lag]
+
+    def _choose(self):
+        usable = self._usable()
+        if not usable:
+            return None
+        self._next = (self._next + 1) % len(usable)
+        return usable[self._next]
+
+    def runQuery(self, *args, **kw):
+        replica = self._choose()
+        if replica is None:
+            self.primary_queries += 1
+            return self.primary.runQuery(*args, **kw)
+
+        def fallback(f):
+            replica.last_error = f.getErrorMessage().strip()
+            self.primary_queries += 1
+            return self.primary.runQuery(*args, **kw)
+
+        replica.queries += 1
+        d = replica.pool.runQuery(*args, **kw)
+        return d.addErrback(fallback)
+
+    def check_lag(self):
+        """
+        Measure every replica's lag.
+        """
+        def update(rows, replica):
+            replica.lag = float(rows[0][0])
+            replica.last_error = None
+
+        def failed(f, replica):
+            replica.lag = None
+            replica.last_error = f.getErrorMessage().strip()
+
+        ds = []
+        for replica in self._replicas:
+            d = replica.pool.runQuery(REPLICA_LAG)
+            d.addCallbacks(
+                update, failed,
+                callbackArgs=(replica,), errbackArgs=(replica,))
+            ds.append(d)
+        return defer.gatherResults(ds)
+
+    def stats(self):
+        usable = self._usable()
+        return {
+            'primary_queries': self.primary_queries,
+            'replicas': dict((r.name, {
+                'lag': r.lag,
+                'usable': r in usable,
+                'queries': r.queries,
+                'last_error': r.last_error,
+            }) for r in self._replicas),
+        }
+
+    def close(self):
+        replicas, self._replicas = self._replicas, []
+        for replica in replicas:
+            replica.pool.close()
@@ -0,0 +1,85 @@
+import bisect
+import hashlib
+from collections import OrderedDict
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto a set of nodes.
+
+    Each node gets `points` positions on the ring and a key belongs to the
+    first node at or after its own position, so adding a node only moves the
+    keys that now belong to it.
+    """
+
+    def __init__(self, points=100):
+        self.points = points
+        self._ring = []
+
+    def _hash(self, key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+    def add(self, node):
+        for i in range(self.points):
+            self._ring.append((self._hash('%s#%s' % (node, i)), node))
+        self._ring.sort()
+
+    def get(self, key):
+        """
+        Return the node `key` belongs to, or `None` if there aren't any.
+        """
+        if not self._ring:
+            return None
+        i = bisect.bisect_left(self._ring, (self._hash(key),))
+        return self._ring[i % len(self._ring)][1]
+
+
+class MetadataShards(object):
+    """
+    The `databases` table spread over several of xylem's DBs, with each row
+    on the shard its name hashes to. The primary shard is xylem's main DB,
+    which also holds everything that isn't per-database.
+
+    With no other shards added, everything lives on the primary.
+    """
+
+    def __init__(self, primary_name, primary, points=100):
+        self.primary = primary_name
+        self._ring = HashRing(points)
+        self._pools = OrderedDict()
+        self.add(primary_name, primary)
+
+    @property
+    def enabled(self):
+        return len(self._pools) > 1
+
+    def add(self, name, pool):
+        self._pools[name] = pool
+        self._ring.add(name)
+
+    def names(self):
+        return list(self._pools)
+
+    def pool(self, shard):
+        return self._pools[shard]
+
+    def shard_for(self, key):
+        return self._ring.get(key)
+
+    def group(self, keys):
+        """
+        Split `keys` up by shard, returning a dict of shard name to keys.
+        """
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.shard_for(key), []).append(key)
+        return groups
+
+    def close(self):
+        """
+        Close every shard's pool except the primary's, which isn't ours.
+        """
+        pools, self._pools = self._pools, OrderedDict()
+        for name, pool in pools.items():
+            if name != self.primary:
+                pool.close()
@@ -5,14 +5,23 @@ import random
 import re
 import time
 import uuid
+from functools import partial, wraps
 
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
-from rhumba import RhumbaPlugin
-from twisted.internet import defer, reactor
+from rhumba import RhumbaPlugin, cron
+from twisted.internet import defer, reactor, task, threads
 from twisted.enterprise import adbapi
 
+from seed.xylem.pg_async import AsyncConnectionPool
+from seed.xylem.pg_cache import CredentialCache
 from seed.xylem.pg_compat import psycopg2, errorcodes, DictCursor
+from seed.xylem.pg_health import ServerHealth
+from seed.xylem.pg_migrations import migrate
+from seed.xylem.pg_placement import Placement
+from seed.xylem.pg_pools import ServerPools
+from seed.xylem.pg_replicas import ReadReplicas
+from seed.xylem.pg_shards import MetadataShards
 
 
 class APIError(Exception):
@@ -24,9 +33,79 @@ class APIError(Exception):
         self.err_msg = err_msg
 
 
+# The first key for our advisory locks, to keep them apart from any others.
+# This is "xylm" in ASCII.
+ADVISORY_LOCK_CLASS = 0x78796c6d
+
+NO_SERVERS = "No servers available for new databases"
+
+RECONCILE_DATABASES = (
+    "SELECT datname, pg_get_userbyid(datdba) AS owner FROM pg_database"
+    " WHERE NOT datistemplate;")
+
+RECONCILE_ROLES = "SELECT rolname FROM pg_roles;"
+
+# Per-database settings a resource profile may have, besides its
+# connection_limit.
+PROFILE_SETTINGS = ['statement_timeout', 'work_mem']
+
+SERVER_STATS = (
+    "SELECT count(*) AS db_count,"
+    " coalesce(sum(pg_database_size(datname)), 0) AS total_size,"
+    " (SELECT coalesce(sum(numbackends), 0) FROM pg_stat_database)"
+    " AS backends"
+    " FROM pg_database WHERE NOT datistemplate;")
+
+FIND_DBS = (
+    "SELECT name, host, username, password FROM databases"
+    " WHERE name = ANY(%s) AND drop_requested_at IS NULL;")
+
+INSERT_DB = (
+    "INSERT INTO databases"
+    " (name, host, username, password, server_id, profile)"
+    " VALUES (%s, %s, %s, %s, %s, %s) RETURNING *;")
+
+
+INSERT_WARM_DB = (
+    "INSERT INTO warm_databases (name, host, username, password)"
+    " VALUES (%s, %s, %s, %s) RETURNING *;")
+
+# Take one warm database for a host, skipping any that a concurrent claim
+# (possibly from another xylem node) already has locked.
+CLAIM_WARM_DB = (
+    "DELETE FROM warm_databases WHERE name = ("
+    " SELECT name FROM warm_databases WHERE host=%s"
+    " LIMIT 1 FOR UPDATE SKIP LOCKED)"
+    " RETURNING *;")
+
+
+def valid_db_name(name):
+    return isinstance(name, basestring) and re.match(r'^\w+$', name)
+
+
+def api_error_response(f):
+    """
+    Turn an APIError into an error response.
+    """
+    f.trap(APIError)
+    return {"Err": f.value.err_msg}
+
+
+def wait_for_setup(fn):
+    """
+    Hold a call until the plugin's setup has finished, and turn API errors
+    (including setup failures) into error responses.
+    """
+    @wraps(fn)
+    def wrapper(self, args):
+        d = self._readiness.wait()
+        d.addCallback(lambda _: fn(self, args))
+        d.addErrback(api_error_response)
+        return d
+    return wrapper
+
+
 class Plugin(RhumbaPlugin):
-    # FIXME: Setup is asynchronous and there may be a race condition if we try
-    #        to process a request before setup finishes.
     def __init__(self, *args, **kw):
         setup_db = kw.pop('setup_db', True)
         super(Plugin, self).__init__(*args, **kw)
@@ -40,47 +119,322 @@ class Plugin(RhumbaPlugin):
         self.password = self.config.get('db_password', '')
         self.username = self.config.get('db_username', 'postgres')
 
+        # Passwords are encrypted with `key`. If it has a `key_id`, that is
+        # recorded with each password so that we can tell which key to
+        # decrypt it with after a rotation. Previous keys are in `old_keys`,
+        # and passwords without an id use `unversioned_key` (which defaults
+        # to `key`).
         self.key = self.config['key']
+        self.key_id = self.config.get('key_id')
+        if self.key_id is not None:
+            self.key_id = str(self.key_id)
+        keys = dict(
+            (str(k), v) for k, v in self.config.get('old_keys', {}).items())
+        keys[None] = self.config.get('unversioned_key', self.key)
+        keys[self.key_id] = self.key
+        # Deriving the AES keys is the same work every time, so we only do it
+        # once.
+        self._aes_keys = dict(
+            (k, algorithms.AES(hashlib.md5(v).hexdigest()))
+            for k, v in keys.items())
+        self._crypto_backend = default_backend()
+
+        # Which driver our connection pools use: adbapi runs every query in
+        # a thread, while async drives psycopg2's asynchronous connections
+        # from the reactor.
+        self.db_driver = self.config.get('db_driver', 'adbapi')
+        if self.db_driver not in ('adbapi', 'async'):
+            raise ValueError("Unknown db_driver: %s" % (self.db_driver,))
+
+        # Named resource profiles limit what each database may use. These
+        # are checked before any pools are built, so that bad config doesn't
+        # leave pools behind that nothing will close.
+        self.resource_profiles = self.config.get('resource_profiles', {})
+        for profile in self.resource_profiles.values():
+            for setting in profile:
+                if setting != 'connection_limit' and (
+                        setting not in PROFILE_SETTINGS):
+                    raise ValueError(
+                        "Unknown resource profile setting: %s" % (setting,))
+
+        # Sizing and health checking for the long-lived pool we keep open to
+        # xylem's internal DB.
+        self.db_pool_min = int(self.config.get('db_pool_min', 1))
+        self.db_pool_max = int(self.config.get('db_pool_max', 5))
+        self.db_pool_check_interval = float(
+            self.config.get('db_pool_check_interval', 30))
+
+        # The pool is built up front so it lives as long as the plugin does.
+        # adbapi only connects once the reactor is running, and we start our
+        # health checks at the same time.
+        self._xylem_pool = self._get_xylem_db(
+            cp_min=self.db_pool_min,
+            cp_max=self.db_pool_max,
+            cp_reconnect=True,
+            cp_good_sql="SELECT 1")
+        self._xylem_pool_checker = task.LoopingCall(self._check_xylem_db)
+
+        # Lookups can optionally be spread over read replicas of xylem's DB.
+        # Writes and schema changes always go to the primary.
+        self._replicas = ReadReplicas(
+            self._xylem_pool,
+            max_lag=float(self.config.get('replica_max_lag', 5)))
+        for replica in self.config.get('db_replicas', []):
+            port = int(replica.get('port', 5432))
+            self._replicas.add(
+                '%s:%s' % (replica['host'], port),
+                self._get_connection(
+                    db=replica.get('db_name', self.db),
+                    host=replica['host'],
+                    port=port,
+                    user=replica.get('username', self.username),
+                    password=replica.get('password', self.password),
+                    cp_min=self.db_pool_min,
+                    cp_max=self.db_pool_max,
+                    cp_reconnect=True,
+                    cp_good_sql="SELECT 1"))
+        self.replica_check_interval = float(
+            self.config.get('replica_check_interval', 5))
+        self._replica_checker = task.LoopingCall(self._replicas.check_lag)
+
+        # Rows in the databases table can optionally be spread over several
+        # metadata DBs by consistent hashing of their names. Our main DB is
+        # always a shard, and keeps everything that isn't per-database. The
+        # shard names are what gets hashed, so every node must agree on them.
+        self._shards = MetadataShards(
+            self.config.get('db_shard_name', 'main'), self._xylem_pool,
+            points=int(self.config.get('db_shard_points', 100)))
+        for shard in self.config.get('db_shards', []):
+            self._shards.add(shard['name'], self._get_connection(
+                db=shard.get('db_name', self.db),
+                host=shard['host'],
+                port=int(shard.get('port', 5432)),
+                user=shard.get('username', self.username),
+                password=shard.get('password', self.password),
+                cp_min=self.db_pool_min,
+                cp_max=self.db_pool_max,
+                cp_reconnect=True,
+                cp_good_sql="SELECT 1"))
+
+        # Admin pools for the target servers are created on demand and
+        # closed again when they sit idle.
+        self._server_pools = ServerPools(
+            self._get_server_connection,
+            max_size=int(self.config.get('server_pool_max', 2)),
+            idle_timeout=float(
+                self.config.get('server_pool_idle_timeout', 300)))
+        self._server_pool_evictor = task.LoopingCall(
+            self._server_pools.evict_idle)
+
+        # We check every server in the background, and stop using ones that
+        # keep failing until they recover.
+        self.connect_timeout = int(self.config.get('connect_timeout', 5))
+        self._health = ServerHealth(
+            failure_threshold=int(
+                self.config.get('health_failure_threshold', 3)),
+            reset_timeout=float(self.config.get('health_reset_timeout', 30)))
+        self.health_check_interval = float(
+            self.config.get('health_check_interval', 10))
+        self._health_checker = task.LoopingCall(self._check_servers)
+
+        # New databases go on the least loaded server, based on stats we
+        # collect in the background.
+        self._placement = Placement()
+        self.placement_refresh_interval = float(
+            self.config.get('placement_refresh_interval', 60))
+        self._placement_refresher = task.LoopingCall(self._refresh_placement)
+
+        # Optionally keep some ready-made databases on each server, so that
+        # creating one is just a rename.
+        self.warm_pool_size = int(self.config.get('warm_pool_size', 0))
+        self.warm_pool_refill_interval = float(
+            self.config.get('warm_pool_refill_interval', 60))
+        self._warm_pool_refiller = task.LoopingCall(self._refill_warm_pool)
+        self._warm_refill_current = None
+        self._warm_refill_next = []
+
+        # Most requests are for databases we already know about, so we keep
+        # recently seen rows around. Set cache_size to 0 to disable this.
+        self._cache = CredentialCache(
+            max_size=int(self.config.get('cache_size', 1024)),
+            ttl=float(self.config.get('cache_ttl', 300)))
+
+        # We track which databases get used, and write that out in batches.
+        self._accessed = set()
+        self.access_flush_interval = float(
+            self.config.get('access_flush_interval', 60))
+        self._access_flusher = task.LoopingCall(self._flush_access_times)
+
+        # Concurrent requests for the same database share a single result.
+        # Optionally, we also take a postgres advisory lock while creating a
+        # database so that other xylem nodes wait for us.
+        self._inflight = InFlight()
+        self.advisory_locks = self.config.get('advisory_locks', False)
+        self.advisory_lock_timeout = float(
+            self.config.get('advisory_lock_timeout', 30))
+        self._lock_pool = None
+        if self.advisory_locks:
+            # A single connection, so every lock and unlock happens in the same
+            # postgres session.
+            self._lock_pool = self._get_xylem_db(cp_min=1, cp_max=1)
+
+        # Listings are paged, and pages can't be made arbitrarily large.
+        self.list_page_size = int(self.config.get('list_page_size', 100))
+        self.list_max_page_size = int(
+            self.config.get('list_max_page_size', 1000))
+
+        # Reconciliation skips databases that aren't ours, and can optionally
+        # run on a schedule. The schedule takes @cron's arguments (secs, min,
+        # hour, day, month, weekday) and rhumba finds it by looking for the
+        # `cronable` attribute that @cron sets, so we give this instance a
+        # decorated wrapper.
+        self.reconcile_ignore = self.config.get(
+            'reconcile_ignore', ['postgres', self.db])
+        reconcile_schedule = self.config.get('reconcile_schedule')
+        if reconcile_schedule:
+            reconcile = self.call_reconcile
+            self.call_reconcile = cron(**reconcile_schedule)(
+                wraps(reconcile)(lambda args: reconcile(args)))
+
+        # Servers may set their own default resource_profile, and requests
+        # may ask for a particular one.
+        self.resource_profile = self.config.get('resource_profile')
+
+        # Dropping databases happens in the background, a limited number per
+        # server at a time.
+        self.drop_batch_size = int(self.config.get('drop_batch_size', 5))
+        self.drop_interval = float(self.config.get('drop_interval', 10))
+        self._drop_worker = task.LoopingCall(self._drop_pending)
+        self._dropping = None
+
+        # Setup happens asynchronously, so requests that need it wait for it
+        # to finish. Only a limited number may wait, and if setup fails we
+        # reject them immediately and try again later.
+        self._readiness = Readiness(
+            int(self.config.get('setup_queue_size', 100)))
+        self.setup_retry_interval = float(
+            self.config.get('setup_retry_interval', 10))
+        self._setup_retry = None
+
+        # Everything the background work needs must exist before this,
+        # because _start is called immediately if the reactor is running.
+        self._start_id = reactor.callWhenRunning(self._start)
+        self._shutdown_id = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self._reactor_shutdown)
 
         if setup_db:
             reactor.callWhenRunning(self._setup_db)
 
-    def _cipher(self, key_iv):
+    def _cipher(self, key_iv, key_id=None):
         """
         Construct a Cipher object with suitable parameters.
 
         The parameters used are compatible with the pycrypto code this
         implementation replaced.
         """
-        key = hashlib.md5(self.key).hexdigest()
         return Cipher(
-            algorithms.AES(key), modes.CFB8(key_iv), backend=default_backend())
+            self._aes_keys[key_id], modes.CFB8(key_iv),
+            backend=self._crypto_backend)
+
+    def _key_id_of(self, e):
+        """
+        Return the id of the key a value was encrypted with. Base64 never
+        contains `$`, so anything before one is a key id.
+        """
+        if '$' in e:
+            return e.split('$', 1)[0]
+        return None
 
     def _encrypt(self, s):
-        key_iv = os.urandom(algorithms.AES.block_size / 8)
-        encryptor = self._cipher(key_iv).encryptor()
-        pwenc = encryptor.update(s) + encryptor.finalize()
-        return base64.b64encode(key_iv + pwenc)
+        return self._encrypt_many([s])[0]
 
     def _decrypt(self, e):
+        return self._decrypt_many([e])[0]
+
+    def _encrypt_many(self, values):
+        """
+        Encrypt several values with the current key.
+        """
         block_size = algorithms.AES.block_size / 8
-        msg = base64.b64decode(e)
-        key_iv = msg[:block_size]
-        decryptor = self._cipher(key_iv).decryptor()
-        return decryptor.update(msg[block_size:]) + decryptor.finalize()
+        prefix = ''
+        if self.key_id is not None:
+            prefix = '%s$' % (self.key_id,)
+        ivs = os.urandom(block_size * len(values))
+        encrypted = []
+        for i, s in enumerate(values):
+            key_iv = ivs[i * block_size:(i + 1) * block_size]
+            encryptor = self._cipher(key_iv, self.key_id).encryptor()
+            pwenc = encryptor.update(s) + encryptor.finalize()
+            encrypted.append(prefix + base64.b64encode(key_iv + pwenc))
+        return encrypted
+
+    def _decrypt_many(self, values):
+        """
+        Decrypt several values, each with the key it was encrypted with.
+        """
+        block_size = algorithms.AES.block_size / 8
+        decrypted = []
+        for e in values:
+            key_id = self._key_id_of(e)
+            if key_id is not None:
+                e = e.split('$', 1)[1]
+            if key_id not in self._aes_keys:
+                raise APIError("Unknown encryption key: %s" % (key_id,))
+            msg = base64.b64decode(e)
+            key_iv = msg[:block_size]
+            decryptor = self._cipher(key_iv, key_id).decryptor()
+            decrypted.append(
+                decryptor.update(msg[block_size:]) + decryptor.finalize())
+        return decrypted
 
     def _setup_db(self):
-        db_table = (
-            "CREATE TABLE databases (name varchar(66) UNIQUE, host"
-            " varchar(256), username varchar(256), password varchar(256));")
+        """
+        Bring our schema up to date and mark the plugin ready. If that fails,
+        requests are rejected until a retry succeeds.
+        """
+        self._setup_retry = None
 
-        cur = self._get_xylem_db()
+        def ready(_):
+            self._readiness.set_ready()
+            if self._warm_pool_enabled():
+                # Start filling the warm pool now that we have somewhere to
+                # keep track of it, but don't wait for that.
+                self._refill_warm_pool()
 
-        d = cur.runOperation(db_table)
-        ignore_pg_error(d, errorcodes.DUPLICATE_TABLE)
-        d.addBoth(cursor_closer(cur))
+        def failed(f):
+            msg = f.getErrorMessage().strip()
+            self.log("Setup failed, retrying in %ss: %s" % (
+                self.setup_retry_interval, msg))
+            self._readiness.set_failed(msg)
+            self._setup_retry = reactor.callLater(
+                self.setup_retry_interval, self._setup_db)
+
+        d = self._migrate()
+        d.addCallbacks(ready, failed)
         return d
 
+    def _migrate(self):
+        """
+        Migrate every metadata shard, returning the versions applied to the
+        primary.
+        """
+        def applied(versions, shard):
+            if versions and self._shards.enabled:
+                self.log("Applied schema migrations on %s: %s" % (
+                    shard, ', '.join(str(v) for v in versions)))
+            elif versions:
+                self.log("Applied schema migrations: %s" % (
+                    ', '.join(str(v) for v in versions),))
+            return versions
+
+        ds = []
+        for shard in self._shards.names():
+            d = self._shards.pool(shard).runInteraction(migrate)
+            ds.append(d.addCallback(applied, shard))
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d.addCallback(lambda results: results[0])
+
     def _create_password(self):
         # Guranteed random dice rolls
         return base64.b64encode(
@@ -90,31 +444,244 @@ class Plugin(RhumbaPlugin):
         return base64.b64encode("mydb" + str(
             time.time()+random.random()*time.time())).strip('=').lower()
 
-    def _get_connection(self, db, host, port, user, password):
-        return adbapi.ConnectionPool(
-            'psycopg2',
+    def _get_connection(self, db, host, port, user, password, cp_min=1,
+                        cp_max=2, **kw):
+        if self.db_driver == 'async':
+            pool = AsyncConnectionPool
+        else:
+            pool = partial(adbapi.ConnectionPool, 'psycopg2')
+        return pool(
             database=db,
             host=host,
             port=port,
             user=user,
             password=password,
-            cp_min=1,
-            cp_max=2,
+            cp_min=cp_min,
+            cp_max=cp_max,
             cp_openfun=self._fixdb,
-            cursor_factory=DictCursor)
+            cursor_factory=DictCursor,
+            **kw)
 
-    def _get_xylem_db(self):
+    def _get_xylem_db(self, **kw):
         return self._get_connection(
             db=self.db,
             host=self.host,
             port=self.port,
             user=self.username,
-            password=self.password)
+            password=self.password,
+            **kw)
+
+    def _get_server_connection(self, server, max_size):
+        return self._get_connection(
+            'postgres',
+            server.get('connect_addr', server['hostname']),
+            int(server.get('port', 5432)),
+            server.get('username', 'postgres'),
+            server.get('password'),
+            cp_max=max_size,
+            connect_timeout=self._connect_timeout(server))
+
+    def _connect_timeout(self, server):
+        return int(server.get('connect_timeout', self.connect_timeout))
+
+    def _probe_server(self, server):
+        """
+        Connect to a server and run a trivial query, returning how long that
+        took. This runs in a thread, and uses a fresh connection so that we
+        measure connecting as well.
+        """
+        start = time.time()
+        conn = psycopg2.connect(
+            database='postgres',
+            host=server.get('connect_addr', server['hostname']),
+            port=int(server.get('port', 5432)),
+            user=server.get('username', 'postgres'),
+            password=server.get('password'),
+            connect_timeout=self._connect_timeout(server))
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+        finally:
+            conn.close()
+        return time.time() - start
+
+    def _check_servers(self):
+        """
+        Check all servers concurrently, skipping any whose circuit is open.
+        """
+        def success(latency, hostname):
+            self._health.record_success(hostname, latency)
+
+        def failure(f, hostname):
+            msg = f.getErrorMessage().strip()
+            if self._health.available(hostname):
+                self.log("Health check failed for %s: %s" % (hostname, msg))
+            self._health.record_failure(hostname, msg)
+
+        ds = []
+        for server in self.servers:
+            hostname = server['hostname']
+            if not self._health.should_check(hostname):
+                continue
+            d = threads.deferToThread(self._probe_server, server)
+            d.addCallbacks(
+                success, failure,
+                callbackArgs=(hostname,), errbackArgs=(hostname,))
+            ds.append(d)
+        return defer.gatherResults(ds)
+
+    def call_server_health(self, args):
+        """
+        Report the health of each server.
+        """
+        return {"Err": None, "servers": self._health.stats()}
+
+    def _xylem_db(self):
+        """
+        Return the shared connection pool for xylem's internal DB.
+        """
+        return self._xylem_pool
+
+    def _metadata_db(self, name):
+        """
+        Return the pool for the metadata shard that `name`'s row belongs on.
+        """
+        return self._shards.pool(self._shards.shard_for(name))
+
+    @defer.inlineCallbacks
+    def _row_shard(self, name):
+        """
+        Find the shard that `name`'s row is on. A row may not have been moved
+        to the shard it belongs on yet, so we check the others too. If there's
+        no row anywhere, this is the shard a new one would go on.
+        """
+        shard = self._shards.shard_for(name)
+        others = [s for s in self._shards.names() if s != shard]
+        for candidate in [shard] + others:
+            rows = yield self._shards.pool(candidate).runQuery(
+                "SELECT 1 FROM databases WHERE name = %s;", (name,))
+            if rows:
+                defer.returnValue(candidate)
+        defer.returnValue(shard)
+
+    def _shard_reader(self, shard):
+        """
+        Return what to run lookups on a shard with. Lookups on the primary
+        can go to its read replicas.
+        """
+        if shard == self._shards.primary:
+            return self._replicas
+        return self._shards.pool(shard)
+
+    def _query_shards(self, query, args=None, readers=False):
+        """
+        Run a query on every metadata shard concurrently. Returns a list of
+        (shard, rows) pairs, in shard order.
+        """
+        shards = self._shards.names()
+        ds = []
+        for shard in shards:
+            if readers:
+                db = self._shard_reader(shard)
+            else:
+                db = self._shards.pool(shard)
+            ds.append(db.runQuery(query, args))
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d.addCallback(lambda results: zip(shards, results))
+
+    def _start(self):
+        """
+        Start background work once the reactor is running.
+        """
+        self._start_id = None
+        self._xylem_pool_checker.start(self.db_pool_check_interval, now=False)
+        if self._replicas.enabled:
+            self._replica_checker.start(self.replica_check_interval)
+        self._server_pool_evictor.start(
+            self.db_pool_check_interval, now=False)
+        self._health_checker.start(self.health_check_interval)
+        self._placement_refresher.start(self.placement_refresh_interval)
+        if self._warm_pool_enabled():
+            self._warm_pool_refiller.start(
+                self.warm_pool_refill_interval, now=False)
+        self._access_flusher.start(self.access_flush_interval, now=False)
+        self._drop_worker.start(self.drop_interval, now=False)
+
+    def _check_xylem_db(self):
+        """
+        Make sure the shared pools can still talk to the metadata DBs. A
+        broken connection is dropped by adbapi's reconnect logic and replaced
+        on the next query, so all we need to do here is exercise the pools and
+        log any errors.
+        """
+        def log_err(f):
+            self.log("xylem DB health check failed: %s" % (
+                f.getErrorMessage(),))
+
+        ds = [self._shards.pool(shard).runQuery("SELECT 1;")
+              for shard in self._shards.names()]
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d.addCallbacks(lambda _: None, log_err)
+
+    def _reactor_shutdown(self):
+        # The trigger is being fired, so there's nothing left to remove.
+        self._shutdown_id = None
+        return self._shutdown()
+
+    def _shutdown(self):
+        """
+        Stop background work and close the shared pools. This is safe to call
+        more than once, and before the reactor has started.
+        """
+        if self._start_id is not None:
+            reactor.removeSystemEventTrigger(self._start_id)
+            self._start_id = None
+        if self._setup_retry is not None and self._setup_retry.active():
+            self._setup_retry.cancel()
+        self._setup_retry = None
+        if self._shutdown_id is not None:
+            reactor.removeSystemEventTrigger(self._shutdown_id)
+            self._shutdown_id = None
+        if self._xylem_pool_checker.running:
+            self._xylem_pool_checker.stop()
+        if self._replica_checker.running:
+            self._replica_checker.stop()
+        self._replicas.close()
+        self._shards.close()
+        if self._server_pool_evictor.running:
+            self._server_pool_evictor.stop()
+        if self._health_checker.running:
+            self._health_checker.stop()
+        if self._placement_refresher.running:
+            self._placement_refresher.stop()
+        if self._warm_pool_refiller.running:
+            self._warm_pool_refiller.stop()
+        if self._access_flusher.running:
+            self._access_flusher.stop()
+        if self._drop_worker.running:
+            self._drop_worker.stop()
+        self._server_pools.close()
+        if self._lock_pool is not None:
+            self._lock_pool.close()
+            self._lock_pool = None
+        if self._xylem_pool is not None:
+            # close() also cancels the startup of a pool that isn't running
+            # yet, so we don't check `running` here.
+            self._xylem_pool.close()
+            self._xylem_pool = None
 
     def _fixdb(self, conn):
         conn.autocommit = True
 
+    @wait_for_setup
     def call_create_database(self, args):
+        return self._inflight.run(
+            args.get('name'), self._create_database, args)
+
+    def _create_database(self, args):
         cleanups = []  # Will be filled with callables to run afterwards
 
         def cleanup_cb(r):
@@ -123,16 +690,527 @@ class Plugin(RhumbaPlugin):
                 d.addCallback(lambda _: f())
             return d.addCallback(lambda _: r)
 
-        def api_error_eb(f):
-            f.trap(APIError)
-            return {"Err": f.value.err_msg}
-
         d = self._call_create_database(args, cleanups.append)
         d.addBoth(cleanup_cb)
-        d.addErrback(api_error_eb)
+        d.addErrback(api_error_response)
         return d
 
+    def call_clone_database(self, args):
+        """
+        Create a new database as a copy of one we already manage, on the same
+        server.
+        """
+        return self.call_create_database({
+            'name': args.get('name'),
+            'template': args.get('source'),
+        })
+
+    @wait_for_setup
+    def call_create_databases(self, args):
+        """
+        Create (or look up) several databases at once. The response has an
+        entry in `results` for each name, in the same format that
+        `call_create_database` uses.
+        """
+        d = self._call_create_databases(args)
+        d.addErrback(api_error_response)
+        return d
+
+    @wait_for_setup
+    def call_list_databases(self, args):
+        """
+        List the databases we manage, a page at a time in name order.
+
+        Pass the `next` value from a response as `after` to get the following
+        page. Results can be limited to one `host`, and passwords are only
+        included if `include_credentials` is set.
+        """
+        return self._call_list_databases(args)
+
+    @defer.inlineCallbacks
+    def _call_list_databases(self, args):
+        limit = args.get('limit', self.list_page_size)
+        if not isinstance(limit, int) or limit < 1:
+            raise APIError("limit must be a positive integer")
+        limit = min(limit, self.list_max_page_size)
+        include_credentials = args.get('include_credentials', False)
+
+        columns = "name, host, username"
+        if include_credentials:
+            columns += ", password"
+        query = (
+            "SELECT %s FROM databases WHERE name > %%s"
+            " AND drop_requested_at IS NULL" % (columns,))
+        params = [args.get('after') or '']
+        if args.get('host') is not None:
+            query += " AND host = %s"
+            params.append(args['host'])
+        # Ask for one extra row so we know whether there's another page.
+        query += " ORDER BY name LIMIT %s;"
+        params.append(limit + 1)
+
+        # Each shard's rows are in name order, so the first rows of them all
+        # together are the page we want.
+        results = yield self._query_shards(query, tuple(params), readers=True)
+        rows = {}
+        for _, shard_rows in results:
+            for row in shard_rows:
+                rows.setdefault(row['name'], row)
+        rows = [rows[name] for name in sorted(rows)]
+        more = len(rows) > limit
+        rows = rows[:limit]
+
+        databases = []
+        for row in rows:
+            databases.append({
+                "name": row['name'],
+                "hostname": row['host'],
+                "user": row['username'],
+            })
+        if include_credentials:
+            passwords = self._decrypt_many([row['password'] for row in rows])
+            for entry, password in zip(databases, passwords):
+                entry["password"] = password
+
+        defer.returnValue({
+            "Err": None,
+            "databases": databases,
+            "next": rows[-1]['name'] if more else None,
+        })
+
+    @wait_for_setup
+    def call_reconcile(self, args):
+        """
+        Compare the databases we have recorded with what actually exists on
+        each server. For every server we report `orphans` (databases we
+        don't know about), `missing` (databases we know about that aren't
+        there) and `role_mismatches` (databases whose user is missing or
+        doesn't own them).
+        """
+        return self._call_reconcile(args)
+
+    @defer.inlineCallbacks
+    def _call_reconcile(self, args):
+        # Read from the primary, so that we don't report databases a replica
+        # hasn't seen yet as orphans.
+        results = yield self._query_shards(
+            "SELECT name, host, username FROM databases;")
+        known = {}
+        for _, rows in results:
+            for row in rows:
+                # A row may briefly be on two shards while we rebalance.
+                known.setdefault(row['name'], row)
+        known = known.values()
+        warm = yield self._xylem_db().runQuery(
+            "SELECT name FROM warm_databases;")
+        ignored = set(n.lower() for n in self.reconcile_ignore)
+        ignored.update(row['name'].lower() for row in warm)
+
+        ds = []
+        for server in self.servers:
+            ds.append(defer.gatherResults([
+                self._server_pools.runQuery(server, RECONCILE_DATABASES),
+                self._server_pools.runQuery(server, RECONCILE_ROLES),
+            ], consumeErrors=True))
+        outcomes = yield defer.DeferredList(ds, consumeErrors=True)
+
+        report = {}
+        for server, (ok, r) in zip(self.servers, outcomes):
+            hostname = server['hostname']
+            if not ok:
+                report[hostname] = {
+                    "Err": r.value.subFailure.getErrorMessage().strip()}
+                continue
+            db_rows, role_rows = r
+            report[hostname] = self._reconcile_server(
+                [row for row in known if row['host'] == hostname],
+                dict((row['datname'], row['owner']) for row in db_rows),
+                set(row['rolname'] for row in role_rows),
+                ignored)
+
+        hostnames = set(s['hostname'] for s in self.servers)
+        unknown = {}
+        for row in known:
+            if row['host'] not in hostnames:
+                unknown.setdefault(row['host'], []).append(row['name'])
+
+        for hostname, result in sorted(report.items()):
+            if result["Err"] is not None:
+                self.log("Unable to reconcile %s: %s" % (
+                    hostname, result["Err"]))
+            elif (result["orphans"] or result["missing"] or
+                  result["role_mismatches"]):
+                self.log(
+                    "Reconciled %s: %s orphans, %s missing,"
+                    " %s role mismatches" % (
+                        hostname, len(result["orphans"]),
+                        len(result["missing"]),
+                        len(result["role_mismatches"])))
+
+        defer.returnValue({
+            "Err": None,
+            "servers": report,
+            "unknown_servers": dict(
+                (k, sorted(v)) for k, v in unknown.items()),
+        })
+
+    def _reconcile_server(self, known, databases, roles, ignored):
+        """
+        Diff one server's databases and roles against our rows for it.
+        Postgres folds unquoted names to lower case, so we do too.
+        """
+        known = dict((row['name'].lower(), row) for row in known)
+        actual = set(databases) - ignored
+
+        role_mismatches = []
+        for name in sorted(actual & set(known)):
+            user = known[name]['username'].lower()
+            owner = databases[name]
+            if user not in roles or owner != user:
+                role_mismatches.append({
+                    "name": known[name]['name'],
+                    "user": known[name]['username'],
+                    "owner": owner,
+                    "role_exists": user in roles,
+                })
+
+        return {
+            "Err": None,
+            "orphans": sorted(actual - set(known)),
+            "missing": sorted(
+                known[name]['name'] for name in set(known) - actual),
+            "role_mismatches": role_mismatches,
+        }
+
+    @wait_for_setup
+    def call_drop_database(self, args):
+        """
+        Mark a database for deletion. It stops being handed out straight
+        away, and is dropped (along with its user) in the background.
+        """
+        return self._call_drop_database(args)
+
+    @defer.inlineCallbacks
+    def _call_drop_database(self, args):
+        name = args['name']
+        if not valid_db_name(name):
+            raise APIError("Database name must be alphanumeric")
+
+        shard = yield self._row_shard(name)
+        rows = yield self._shards.pool(shard).runQuery(
+            "UPDATE databases SET drop_requested_at = coalesce("
+            "drop_requested_at, now()) WHERE name = %s RETURNING name;",
+            (name,))
+        if not rows:
+            raise APIError("Database not known to xylem")
+        self._cache.invalidate(name)
+        self._accessed.discard(name)
+        # Start on it now rather than waiting for the next run, but don't
+        # hold the request up.
+        self._drop_pending()
+        defer.returnValue({"Err": None, "name": name, "status": "pending"})
+
+    def _drop_pending(self):
+        """
+        Drop databases that are marked for deletion. Each server gets at
+        most `drop_batch_size` databases per run, and servers are handled
+        concurrently. Only one run happens at a time.
+        """
+        if not self._readiness.ready:
+            return defer.succeed(None)
+        if self._dropping is None:
+            def failed(f):
+                # Don't let this stop the background worker.
+                self.log("Unable to drop databases: %s" % (
+                    f.getErrorMessage().strip(),))
+
+            def done(_):
+                self._dropping = None
+
+            d = self._dropping = self._run_drops()
+            d.addErrback(failed)
+            d.addBoth(done)
+            return d
+        return self._dropping
+
+    def _drop_delay(self):
+        """
+        How long a database must have been waiting to be dropped before we
+        remove it. Other nodes may still hand out its credentials from their
+        caches until their entries expire.
+        """
+        if self._cache.max_size <= 0:
+            return 0
+        return self._cache.ttl
+
+    @defer.inlineCallbacks
+    def _run_drops(self):
+        results = yield self._query_shards(
+            "SELECT name, host, username, drop_requested_at FROM databases"
+            " WHERE drop_requested_at < now() - %s * interval '1 second'"
+            " ORDER BY drop_requested_at;", (self._drop_delay(),))
+        rows = []
+        shards = {}
+        for shard, shard_rows in results:
+            rows.extend(shard_rows)
+            for row in shard_rows:
+                shards.setdefault(row['name'], []).append(shard)
+        rows.sort(key=lambda row: row['drop_requested_at'])
+
+        batches = {}
+        for row in rows:
+            batch = batches.setdefault(row['host'], [])
+            if len(batch) < self.drop_batch_size:
+                batch.append((row['name'], row['username']))
+
+        ds = []
+        for hostname, batch in sorted(batches.items()):
+            server = self._server_for_host(hostname)
+            if server is None or not self._health.available(hostname):
+                # We'll try again when it comes back.
+                continue
+            ds.append(self._server_pools.runInteraction(
+                server, self._drop_dbs_interaction, batch))
+        outcomes = yield defer.DeferredList(ds, consumeErrors=True)
+
+        dropped = []
+        for ok, r in outcomes:
+            if not ok:
+                self.log("Unable to drop databases: %s" % (
+                    r.getErrorMessage().strip(),))
+                continue
+            for name, err in sorted(r.items()):
+                if err is None:
+                    dropped.append(name)
+                else:
+                    self.log("Unable to drop %s: %s" % (name, err))
+
+        if dropped:
+            by_shard = {}
+            for name in dropped:
+                for shard in shards[name]:
+                    by_shard.setdefault(shard, []).append(name)
+            for shard, names in sorted(by_shard.items()):
+                yield self._shards.pool(shard).runOperation(
+                    "DELETE FROM databases WHERE name = ANY(%s)"
+                    " AND drop_requested_at IS NOT NULL;", (names,))
+            for name in dropped:
+                self._cache.invalidate(name)
+            self.log("Dropped databases: %s" % (', '.join(dropped),))
+
+    def _drop_dbs_interaction(self, cursor, batch):
+        """
+        Drop several databases and their users on one server. This runs in a
+        pool thread, and returns a dict of name to error (or `None`).
+        """
+        results = {}
+        for name, user in batch:
+            try:
+                cursor.execute(
+                    "SELECT 1 FROM pg_database WHERE datname = %s;",
+                    (name.lower(),))
+                if cursor.fetchall():
+                    # Nobody new can connect once this is off, so we only
+                    # need to get rid of the sessions that are already there.
+                    cursor.execute(
+                        "ALTER DATABASE %s ALLOW_CONNECTIONS false;" % (name,))
+                    cursor.execute(
+                        "SELECT pg_terminate_backend(pid)"
+                        " FROM pg_stat_activity WHERE datname = %s"
+                        " AND pid <> pg_backend_pid();", (name.lower(),))
+                    cursor.execute("DROP DATABASE IF EXISTS %s;" % (name,))
+                cursor.execute("DROP ROLE IF EXISTS %s;" % (user,))
+                results[name] = None
+            except psycopg2.Error as e:
+                results[name] = str(e).strip()
+        return results
+
+    @wait_for_setup
+    def call_apply_profile(self, args):
+        """
+        Apply a database's resource profile again, for example after the
+        profile has been changed in config. Pass `profile` to switch the
+        database to a different one.
+        """
+        return self._call_apply_profile(args)
+
+    @defer.inlineCallbacks
+    def _call_apply_profile(self, args):
+        name = args['name']
+        if not valid_db_name(name):
+            raise APIError("Database name must be alphanumeric")
+
+        shard = yield self._row_shard(name)
+        xylemdb = self._shards.pool(shard)
+        rows = yield xylemdb.runQuery(
+            "SELECT name, host, username, profile FROM databases"
+            " WHERE name = %s AND drop_requested_at IS NULL;", (name,))
+        if not rows:
+            raise APIError("Database not known to xylem")
+        [row] = rows
+        profile = self._check_profile(args.get('profile', row['profile']))
+        server = self._server_for_host(row['host'])
+        if server is None:
+            raise APIError("Database %s is on unknown server %s" % (
+                name, row['host']))
+
+        yield self._server_pools.runInteraction(
+            server, self._run_statements_interaction,
+            self._profile_sql(name, row['username'], profile))
+        if profile != row['profile']:
+            yield xylemdb.runOperation(
+                "UPDATE databases SET profile = %s WHERE name = %s;",
+                (profile, name))
+        defer.returnValue({"Err": None, "name": name, "profile": profile})
+
+    @wait_for_setup
+    def call_rebalance_shards(self, args):
+        """
+        Move rows in the databases table to the metadata shards they belong
+        on, for example after adding a shard. Reports how many rows were
+        moved off each shard.
+        """
+        return self._call_rebalance_shards(args)
+
+    @defer.inlineCallbacks
+    def _call_rebalance_shards(self, args):
+        batch_size = args.get('batch_size', self.list_max_page_size)
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise APIError("batch_size must be a positive integer")
+
+        moved = {}
+        for shard in self._shards.names():
+            pool = self._shards.pool(shard)
+            moved[shard] = 0
+            after = ''
+            while True:
+                rows = yield pool.runQuery(
+                    "SELECT * FROM databases WHERE name > %s"
+                    " ORDER BY name LIMIT %s;", (after, batch_size))
+                if not rows:
+                    break
+                after = rows[-1]['name']
+                targets = {}
+                for row in rows:
+                    target = self._shards.shard_for(row['name'])
+                    if target != shard:
+                        targets.setdefault(target, []).append(row)
+                for target, target_rows in sorted(targets.items()):
+                    # Copy before deleting, so that lookups can always find
+                    # the row somewhere.
+                    yield self._shards.pool(target).runInteraction(
+                        self._copy_rows_interaction, target_rows)
+                    names = [row['name'] for row in target_rows]
+                    yield pool.runOperation(
+                        "DELETE FROM databases WHERE name = ANY(%s);",
+                        (names,))
+                    moved[shard] += len(names)
+
+        for shard, count in sorted(moved.items()):
+            if count:
+                self.log("Moved %s databases off shard %s" % (count, shard))
+        defer.returnValue({"Err": None, "moved": moved})
+
+    def _copy_rows_interaction(self, cursor, rows):
+        """
+        Insert rows from another shard's databases table, skipping any that
+        are already here. This runs in a pool thread.
+        """
+        for row in rows:
+            columns = row.keys()
+            cursor.execute(
+                "INSERT INTO databases (%s) VALUES (%s)"
+                " ON CONFLICT (name) DO NOTHING;" % (
+                    ', '.join(columns), ', '.join(['%s'] * len(columns))),
+                [row[column] for column in columns])
+
+    @wait_for_setup
+    def call_rotate_key(self, args):
+        """
+        Re-encrypt every stored password that isn't encrypted with the
+        current key, a batch at a time. Once this has finished, the old keys
+        aren't needed any more.
+        """
+        return self._call_rotate_key(args)
+
+    @defer.inlineCallbacks
+    def _call_rotate_key(self, args):
+        batch_size = args.get('batch_size', self.list_max_page_size)
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise APIError("batch_size must be a positive integer")
+
+        tables = [(shard, 'databases') for shard in self._shards.names()]
+        tables.append((self._shards.primary, 'warm_databases'))
+        rotated = {'databases': 0, 'warm_databases': 0}
+        for shard, table in tables:
+            pool = self._shards.pool(shard)
+            after = ''
+            while True:
+                rows = yield pool.runQuery(
+                    "SELECT name, password FROM %s WHERE name > %%s"
+                    " ORDER BY name LIMIT %%s;" % (table,),
+                    (after, batch_size))
+                if not rows:
+                    break
+                after = rows[-1]['name']
+                stale = [row for row in rows
+                         if self._key_id_of(row['password']) != self.key_id]
+                if not stale:
+                    continue
+                passwords = self._encrypt_many(
+                    self._decrypt_many([row['password'] for row in stale]))
+                yield pool.runInteraction(
+                    self._update_passwords_interaction, table, [
+                        (password, row['name'], row['password'])
+                        for row, password in zip(stale, passwords)])
+                for row in stale:
+                    self._cache.invalidate(row['name'])
+                rotated[table] += len(stale)
+
+        self.log("Re-encrypted %s passwords with key %s" % (
+            sum(rotated.values()), self.key_id))
+        defer.returnValue({"Err": None, "rotated": rotated})
+
+    def _update_passwords_interaction(self, cursor, table, updates):
+        """
+        Replace several passwords, skipping any that have changed since we
+        read them. This runs in a pool thread.
+        """
+        for update in updates:
+            cursor.execute(
+                "UPDATE %s SET password = %%s WHERE name = %%s"
+                " AND password = %%s;" % (table,), update)
+
+    def call_pool_stats(self, args):
+        """
+        Report on the connection pools we're holding open.
+        """
+        pool = self._xylem_db()
+        return {
+            "Err": None,
+            "xylem": {
+                "min_size": pool.min,
+                "max_size": pool.max,
+                "connections": len(pool.connections),
+            },
+            "servers": self._server_pools.stats(),
+            "replicas": self._replicas.stats(),
+            "shards": dict((shard, {
+                "max_size": self._shards.pool(shard).max,
+                "connections": len(self._shards.pool(shard).connections),
+            }) for shard in self._shards.names()),
+        }
+
+    def call_cache_stats(self, args):
+        """
+        Report on the credential cache.
+        """
+        stats = self._cache.stats()
+        stats["Err"] = None
+        return stats
+
     def _build_db_response(self, row):
+        self._accessed.add(row['name'])
         return {
             "Err": None,
             "name": row['name'],
@@ -141,60 +1219,748 @@ class Plugin(RhumbaPlugin):
             "password": self._decrypt(row['password']),
         }
 
+    def _flush_access_times(self):
+        """
+        Record when the databases handed out since the last flush were
+        accessed. This is batched so that lookups don't need to write.
+        """
+        if not self._accessed:
+            return defer.succeed(None)
+        names, self._accessed = sorted(self._accessed), set()
+
+        def failed(f):
+            self.log("Unable to record access times: %s" % (
+                f.getErrorMessage().strip(),))
+
+        ds = []
+        for shard, shard_names in self._shards.group(names).items():
+            d = self._touch_dbs(shard, shard_names)
+            ds.append(d.addErrback(failed))
+        return defer.gatherResults(ds)
+
+    @defer.inlineCallbacks
+    def _touch_dbs(self, shard, names):
+        """
+        Record access times for databases whose names hash to `shard`,
+        including any whose rows are still on another shard.
+        """
+        query = (
+            "UPDATE databases SET last_accessed = now()"
+            " WHERE name = ANY(%s) RETURNING name;")
+        rows = yield self._shards.pool(shard).runQuery(query, (names,))
+        missing = set(names) - set(row['name'] for row in rows)
+        for other in self._shards.names():
+            if not missing:
+                break
+            if other == shard:
+                continue
+            rows = yield self._shards.pool(other).runQuery(
+                query, (sorted(missing),))
+            missing -= set(row['name'] for row in rows)
+
+    def _find_db(self, name):
+        """
+        Look up the row for a database we manage, or `None` if we don't know
+        about it.
+        """
+        d = self._find_dbs([name])
+        return d.addCallback(lambda found: found.get(name))
+
+    @defer.inlineCallbacks
+    def _find_dbs(self, names):
+        """
+        Look up the rows for several databases at once, returning a dict of
+        the ones we know about.
+        """
+        found = {}
+        todo = []
+        for name in names:
+            row = self._cache.get(name)
+            if row is None:
+                todo.append(name)
+            else:
+                found[name] = row
+        if todo:
+            ds = [self._find_dbs_on_shard(shard, shard_names)
+                  for shard, shard_names in self._shards.group(todo).items()]
+            results = yield defer.gatherResults(
+                ds, consumeErrors=True).addErrback(
+                    lambda f: f.value.subFailure)
+            for rows in results:
+                for row in rows:
+                    self._cache.put(row)
+                    found[row['name']] = row
+            todo = [name for name in todo if name not in found]
+        if todo and self._shards.enabled:
+            # A row may not have been moved to the shard it belongs on yet.
+            results = yield self._query_shards(FIND_DBS, (todo,))
+            for _, rows in results:
+                for row in rows:
+                    self._cache.put(row)
+                    found.setdefault(row['name'], row)
+        defer.returnValue(found)
+
+    @defer.inlineCallbacks
+    def _find_dbs_on_shard(self, shard, names):
+        rows = yield self._shard_reader(shard).runQuery(FIND_DBS, (names,))
+        missing = set(names) - set(row['name'] for row in rows)
+        if missing and shard == self._shards.primary and (
+                self._replicas.enabled):
+            # A replica may not have seen a database we only just created, so
+            # check the primary before we decide we don't know about it.
+            more = yield self._xylem_db().runQuery(
+                FIND_DBS, (sorted(missing),))
+            rows = list(rows) + list(more)
+        defer.returnValue(rows)
+
+    def _choose_server(self):
+        """
+        Pick a server to put a new database on, or `None` if they're all full.
+        """
+        return self._placement.choose([
+            s for s in self.servers if self._health.available(s['hostname'])])
+
+    def _refresh_placement(self):
+        """
+        Collect load stats from all servers concurrently. Servers we can't
+        reach are left out of the index until they answer again.
+        """
+        def update(rows, server):
+            [row] = rows
+            self._placement.update(
+                server['hostname'], int(row['db_count']),
+                int(row['total_size']), int(row['backends']))
+
+        def remove(f, server):
+            self._placement.remove(server['hostname'])
+            self.log("Unable to get stats for %s: %s" % (
+                server['hostname'], f.getErrorMessage()))
+
+        ds = []
+        for server in self.servers:
+            d = self._server_pools.runQuery(server, SERVER_STATS)
+            d.addCallbacks(
+                update, remove, callbackArgs=(server,), errbackArgs=(server,))
+            ds.append(d)
+        return defer.gatherResults(ds)
+
+    def call_placement_stats(self, args):
+        """
+        Report the load stats we use to place new databases.
+        """
+        return {"Err": None, "servers": self._placement.stats()}
+
+    def _create_user_sql(self, user, profile=None):
+        limit = self._connection_limit(profile)
+        if limit < 0:
+            return "CREATE USER %s WITH ENCRYPTED PASSWORD %%s;" % (user,)
+        return (
+            "CREATE USER %s WITH ENCRYPTED PASSWORD %%s"
+            " CONNECTION LIMIT %d;" % (user, limit))
+
+    def _check_profile(self, profile):
+        if profile is not None and profile not in self.resource_profiles:
+            raise APIError("Unknown resource profile: %s" % (profile,))
+        return profile
+
+    def _choose_profile(self, server, requested=None):
+        """
+        Which resource profile a new database on `server` gets.
+        """
+        if requested is None:
+            requested = server.get('resource_profile', self.resource_profile)
+        return self._check_profile(requested)
+
+    def _connection_limit(self, profile):
+        if profile is None:
+            return -1
+        return int(self.resource_profiles[profile].get(
+            'connection_limit', -1))
+
+    def _profile_sql(self, name, user, profile, new_user=False):
+        """
+        Statements (with their parameters) that apply a resource profile to a
+        database and its user. Settings the profile doesn't have are reset,
+        so this also undoes a previous profile. We skip the user's connection
+        limit if we've only just created it with one.
+        """
+        limit = self._connection_limit(profile)
+        settings = {}
+        if profile is not None:
+            settings = self.resource_profiles[profile]
+
+        statements = []
+        if not new_user:
+            statements.append(
+                ("ALTER ROLE %s CONNECTION LIMIT %d;" % (user, limit), None))
+        statements.append(
+            ("ALTER DATABASE %s CONNECTION LIMIT %d;" % (name, limit), None))
+        for setting in PROFILE_SETTINGS:
+            if setting in settings:
+                statements.append((
+                    "ALTER DATABASE %s SET %s = %%s;" % (name, setting),
+                    (str(settings[setting]),)))
+            else:
+                statements.append((
+                    "ALTER DATABASE %s RESET %s;" % (name, setting), None))
+        return statements
+
+    def _run_statements_interaction(self, cursor, statements):
+        """
+        Run several statements on one connection. This runs in a pool thread.
+        """
+        for sql, sql_args in statements:
+            cursor.execute(sql, sql_args)
+
+    def _create_db_sql(self, name, user, template=None):
+        if template is not None:
+            return (
+                "CREATE DATABASE %s TEMPLATE %s ENCODING 'UTF8' OWNER %s;" % (
+                    name, template, user))
+        return "CREATE DATABASE %s ENCODING 'UTF8' OWNER %s;" % (name, user)
+
+    def _server_id(self, server):
+        """
+        A stable identifier for a server, which defaults to its hostname.
+        """
+        return server.get('id', server['hostname'])
+
+    def _server_for_host(self, hostname):
+        for server in self.servers:
+            if server['hostname'] == hostname:
+                return server
+        return None
+
+    @defer.inlineCallbacks
+    def _run_in_db(self, server, dbname, sql, *args):
+        """
+        Run a statement as the server's admin user inside a particular
+        database. We don't keep pools around for these, because they're only
+        needed for unusual operations.
+        """
+        pool = self._get_connection(
+            dbname,
+            server.get('connect_addr', server['hostname']),
+            int(server.get('port', 5432)),
+            server.get('username', 'postgres'),
+            server.get('password'),
+            cp_max=1)
+        try:
+            yield pool.runOperation(sql, *args)
+        finally:
+            pool.close()
+
+    def _take_ownership(self, server, name, template_row, user):
+        """
+        Hand everything the template's owner owns in a cloned database over
+        to the clone's owner. REASSIGN OWNED also moves shared objects, which
+        includes the template database itself, so we give that back in the
+        same transaction.
+        """
+        return self._run_in_db(server, name, (
+            "REASSIGN OWNED BY %s TO %s; ALTER DATABASE %s OWNER TO %s;" % (
+                template_row['username'], user, template_row['name'],
+                template_row['username'])))
+
+    def _create_dbs_interaction(self, cursor, names, profile=None):
+        """
+        Create users and databases for all of `names` on a single connection.
+        This runs in a pool thread.
+
+        Returns a dict mapping each name to either a `(user, password)` tuple
+        or an error message.
+        """
+        cursor.execute(
+            "SELECT datname FROM pg_database WHERE datname = ANY(%s);",
+            (list(names),))
+        existing = set(row[0] for row in cursor.fetchall())
+
+        results = {}
+        for name in names:
+            if name in existing:
+                results[name] = 'Database exists but not known to xylem'
+                continue
+            user = self._create_username(name)
+            password = self._create_password()
+            try:
+                cursor.execute(
+                    self._create_user_sql(user, profile), (password,))
+                cursor.execute(self._create_db_sql(name, user))
+                if profile is not None:
+                    self._run_statements_interaction(
+                        cursor,
+                        self._profile_sql(name, user, profile, new_user=True))
+            except psycopg2.Error as e:
+                results[name] = str(e).strip()
+            else:
+                results[name] = (user, password)
+        return results
+
+    def _insert_dbs_interaction(self, cursor, entries, query=INSERT_DB):
+        """
+        Record several new databases. This runs in a pool thread.
+        """
+        rows = []
+        for entry in entries:
+            cursor.execute(query, entry)
+            rows.append(cursor.fetchone())
+        return rows
+
+    @defer.inlineCallbacks
+    def _call_create_databases(self, args):
+        names = args['names']
+        if not isinstance(names, list):
+            raise APIError("names must be a list")
+        requested_profile = self._check_profile(args.get('profile'))
+
+        results = {}
+        todo = []
+        for name in names:
+            if name in results or name in todo:
+                continue
+            if not valid_db_name(name):
+                results[name] = {"Err": "Database name must be alphanumeric"}
+            else:
+                todo.append(name)
+
+        rows = yield self._find_dbs(todo)
+        for name, row in rows.items():
+            results[name] = self._build_db_response(row)
+
+        # Claim the missing names so that concurrent requests for any of them
+        # wait for us, and wait for any that someone else has already claimed.
+        waiting = {}
+        claimed = {}
+        for name in todo:
+            if name in rows:
+                continue
+            if name not in self._inflight:
+                claimed[name] = defer.Deferred()
+            waiting[name] = self._inflight.run(
+                name, lambda d=claimed.get(name): d)
+
+        try:
+            created = yield self._provision_dbs(
+                sorted(claimed), requested_profile)
+        except Exception:
+            for d in claimed.values():
+                d.errback()
+            # Everyone waiting has been handed the failure, and we're about
+            # to raise it ourselves.
+            for d in waiting.values():
+                d.addErrback(lambda f: None)
+            raise
+        for name, d in claimed.items():
+            d.callback(created[name])
+
+        for name, d in waiting.items():
+            results[name] = yield d
+
+        defer.returnValue({"Err": None, "results": results})
+
+    @defer.inlineCallbacks
+    def _provision_dbs(self, names, requested_profile=None):
+        """
+        Create databases for all of `names`, grouping them by target server so
+        that each server only needs one connection. Returns a dict mapping
+        each name to its response.
+        """
+        results = {}
+        locked = []
+        try:
+            if self.advisory_locks and names:
+                for name in names:
+                    try:
+                        yield self._advisory_lock(name)
+                    except APIError as e:
+                        results[name] = {"Err": e.err_msg}
+                    else:
+                        locked.append(name)
+                # Other nodes may have created some while we waited.
+                rows = yield self._find_dbs(locked)
+                for name, row in rows.items():
+                    results[name] = self._build_db_response(row)
+                names = [n for n in locked if n not in rows]
+
+            groups = {}
+            for name in names:
+                server = self._choose_server()
+                if server is None:
+                    results[name] = {"Err": NO_SERVERS}
+                    continue
+                groups.setdefault(server['hostname'], (server, []))[1].append(
+                    name)
+
+            groups = groups.values()
+            ds = []
+            profiles = []
+            for server, group_names in groups:
+                profile = self._choose_profile(server, requested_profile)
+                profiles.append(profile)
+                ds.append(self._server_pools.runInteraction(
+                    server, self._create_dbs_interaction, group_names,
+                    profile))
+            outcomes = yield defer.DeferredList(ds, consumeErrors=True)
+
+            entries = []
+            for (server, group_names), profile, (ok, r) in zip(
+                    groups, profiles, outcomes):
+                if not ok:
+                    for name in group_names:
+                        results[name] = {"Err": r.getErrorMessage()}
+                    continue
+                for name in group_names:
+                    if isinstance(r[name], tuple):
+                        user, password = r[name]
+                        entries.append((
+                            name, server['hostname'], user,
+                            self._encrypt(password), self._server_id(server),
+                            profile))
+                    else:
+                        results[name] = {"Err": r[name]}
+
+            by_shard = {}
+            for entry in entries:
+                by_shard.setdefault(
+                    self._shards.shard_for(entry[0]), []).append(entry)
+            by_shard = sorted(by_shard.items())
+            ds = [self._shards.pool(shard).runInteraction(
+                      self._insert_dbs_interaction, shard_entries)
+                  for shard, shard_entries in by_shard]
+            inserted = yield defer.DeferredList(ds, consumeErrors=True)
+            for (shard, shard_entries), (ok, r) in zip(by_shard, inserted):
+                if not ok:
+                    # The databases exist, but we don't know about them.
+                    self.log("Unable to record databases on shard %s: %s" % (
+                        shard, r.getErrorMessage()))
+                    for entry in shard_entries:
+                        results[entry[0]] = {
+                            "Err": "Unable to record %s: %s" % (
+                                entry[0], r.getErrorMessage())}
+                    continue
+                for row in r:
+                    self._cache.put(row)
+                    results[row['name']] = self._build_db_response(row)
+        finally:
+            for name in locked:
+                yield self._advisory_unlock(name)
+
+        defer.returnValue(results)
+
+    def _warm_pool_size(self, server):
+        return int(server.get('warm_pool_size', self.warm_pool_size))
+
+    def _warm_pool_enabled(self):
+        return any(self._warm_pool_size(s) > 0 for s in self.servers)
+
+    @defer.inlineCallbacks
+    def _claim_warm_db(self, server, name, profile=None):
+        """
+        Turn one of the server's warm databases into `name` and record it.
+        Returns the new row, or `None` if there was nothing we could claim.
+        """
+        xylemdb = self._xylem_db()
+        rows = yield xylemdb.runQuery(CLAIM_WARM_DB, (server['hostname'],))
+        if not rows:
+            defer.returnValue(None)
+        warm = rows[0]
+
+        statements = [
+            ("ALTER DATABASE %s RENAME TO %s;" % (warm['name'], name), None)]
+        if profile is not None:
+            statements.extend(
+                self._profile_sql(name, warm['username'], profile))
+        try:
+            yield self._server_pools.runInteraction(
+                server, self._run_statements_interaction, statements)
+        except Exception as e:
+            self.log("Unable to claim warm database %s on %s: %s" % (
+                warm['name'], server['hostname'], str(e).strip()))
+            if getattr(e, 'pgcode', None) != errorcodes.INVALID_CATALOG_NAME:
+                # The warm database is still there, so put it back in the
+                # pool rather than losing track of it.
+                yield self._restore_warm_db(warm)
+            defer.returnValue(None)
+
+        rows = yield self._metadata_db(name).runQuery(
+            INSERT_DB,
+            (name, warm['host'], warm['username'], warm['password'],
+             self._server_id(server), profile))
+        self._cache.put(rows[0])
+        self._refill_warm_pool()
+        defer.returnValue(rows[0])
+
+    @defer.inlineCallbacks
+    def _restore_warm_db(self, warm):
+        """
+        Return a warm database we couldn't claim to the pool.
+        """
+        try:
+            yield self._xylem_db().runQuery(INSERT_WARM_DB, (
+                warm['name'], warm['host'], warm['username'],
+                warm['password']))
+        except Exception as e:
+            self.log("Unable to restore warm database %s: %s" % (
+                warm['name'], str(e).strip()))
+
+    def _refill_warm_pool(self):
+        """
+        Top up the warm pool on every server. Only one refill runs at a time;
+        if one is already running, another is started after it. The returned
+        Deferred fires once a refill that started after this call is done.
+        """
+        d = defer.Deferred()
+        self._warm_refill_next.append(d)
+        if self._warm_refill_current is None:
+            self._run_warm_refill()
+        return d
+
+    def _run_warm_refill(self):
+        self._warm_refill_current = self._warm_refill_next
+        self._warm_refill_next = []
+
+        def log_err(f):
+            self.log("Unable to refill warm pool: %s" % (
+                f.getErrorMessage(),))
+
+        d = self._fill_warm_pool()
+        d.addErrback(log_err)
+        d.addCallback(self._warm_refill_done)
+
+    def _warm_refill_done(self, _):
+        waiting = self._warm_refill_current
+        self._warm_refill_current = None
+        for d in waiting:
+            d.callback(None)
+        if self._warm_refill_next:
+            self._run_warm_refill()
+
+    @defer.inlineCallbacks
+    def _fill_warm_pool(self):
+        rows = yield self._xylem_db().runQuery(
+            "SELECT host, count(*) FROM warm_databases GROUP BY host;")
+        available = dict((row[0], row[1]) for row in rows)
+
+        groups = []
+        for server in self.servers:
+            missing = self._warm_pool_size(server) - available.get(
+                server['hostname'], 0)
+            if missing > 0:
+                names = ['xylem_warm_%s' % (uuid.uuid4().hex[:16],)
+                         for _ in range(missing)]
+                groups.append((server, names))
+
+        ds = []
+        for server, names in groups:
+            ds.append(self._server_pools.runInteraction(
+                server, self._create_dbs_interaction, names))
+        outcomes = yield defer.DeferredList(ds, consumeErrors=True)
+
+        entries = []
+        for (server, names), (ok, r) in zip(groups, outcomes):
+            if not ok:
+                self.log("Unable to create warm databases on %s: %s" % (
+                    server['hostname'], r.getErrorMessage()))
+                continue
+            for name in names:
+                if isinstance(r[name], tuple):
+                    user, password = r[name]
+                    entries.append((
+                        name, server['hostname'], user,
+                        self._encrypt(password)))
+
+        if entries:
+            yield self._xylem_db().runInteraction(
+                self._insert_dbs_interaction, entries, INSERT_WARM_DB)
+
+    @defer.inlineCallbacks
+    def _advisory_lock(self, name):
+        """
+        Take the advisory lock for `name`, polling until we get it or time
+        out. We never block in postgres, because that would tie up the only
+        connection we have for locks.
+        """
+        lock = "SELECT pg_try_advisory_lock(%s, hashtext(%s));"
+        deadline = reactor.seconds() + self.advisory_lock_timeout
+        while True:
+            [[locked]] = yield self._lock_pool.runQuery(
+                lock, (ADVISORY_LOCK_CLASS, name))
+            if locked:
+                return
+            if reactor.seconds() >= deadline:
+                raise APIError("Timed out waiting for lock on %s" % (name,))
+            yield task.deferLater(reactor, 0.1, lambda: None)
+
+    def _advisory_unlock(self, name):
+        unlock = "SELECT pg_advisory_unlock(%s, hashtext(%s));"
+        return self._lock_pool.runQuery(unlock, (ADVISORY_LOCK_CLASS, name))
+
     @defer.inlineCallbacks
     def _call_create_database(self, args, add_cleanup):
         # TODO: Validate args properly.
         name = args['name']
 
-        if not re.match('^\w+$', name):
+        if not valid_db_name(name):
             raise APIError("Database name must be alphanumeric")
+        requested_profile = self._check_profile(args.get('profile'))
 
-        xylemdb = self._get_xylem_db()
-        add_cleanup(cursor_closer(xylemdb))
+        xylemdb = self._metadata_db(name)
 
-        find_db = "SELECT name, host, username, password FROM databases"\
-            " WHERE name=%s"
+        row = yield self._find_db(name)
 
-        rows = yield xylemdb.runQuery(find_db, (name,))
+        if row is None and self.advisory_locks:
+            yield self._advisory_lock(name)
+            add_cleanup(lambda: self._advisory_unlock(name))
+            # Another node may have created it while we waited.
+            row = yield self._find_db(name)
 
-        if rows:
-            defer.returnValue(self._build_db_response(rows[0]))
+        if row is not None:
+            defer.returnValue(self._build_db_response(row))
 
         else:
-            server = random.choice(self.servers)
-            connect_addr = server.get('connect_addr', server['hostname'])
-
-            rdb = self._get_connection(
-                'postgres',
-                connect_addr,
-                int(server.get('port', 5432)),
-                server.get('username', 'postgres'),
-                server.get('password'))
-            add_cleanup(cursor_closer(rdb))
+            template = args.get('template')
+            if template is None:
+                template_row = None
+                server = self._choose_server()
+                if server is None:
+                    raise APIError(NO_SERVERS)
+            else:
+                # Clones have to live on the same server as their template.
+                if not valid_db_name(template):
+                    raise APIError("Database name must be alphanumeric")
+                template_row = yield self._find_db(template)
+                if template_row is None:
+                    raise APIError(
+                        "Template database %s not known to xylem" % (
+                            template,))
+                server = self._server_for_host(template_row['host'])
+                if server is None:
+                    raise APIError(
+                        "Template database %s is on unknown server %s" % (
+                            template, template_row['host']))
+                if not self._health.available(server['hostname']):
+                    raise APIError("Server %s is unavailable" % (
+                        server['hostname'],))
+            profile = self._choose_profile(server, requested_profile)
+            rdb = self._server_pools
 
             check = "SELECT * FROM pg_database WHERE datname=%s;"
-            r = yield rdb.runQuery(check, (name,))
+            r = yield rdb.runQuery(server, check, (name,))
+
+            if not r and template is None and self._warm_pool_size(server):
+                row = yield self._claim_warm_db(server, name, profile)
+                if row is not None:
+                    defer.returnValue(self._build_db_response(row))
 
             if not r:
                 user = self._create_username(name)
                 password = self._create_password()
 
-                create_u = "CREATE USER %s WITH ENCRYPTED PASSWORD %%s;" % user
-                yield rdb.runOperation(create_u, (password,))
-                create_d = "CREATE DATABASE %s ENCODING 'UTF8' OWNER %s;" % (
-                    name, user)
-                yield rdb.runOperation(create_d)
+                yield rdb.runOperation(
+                    server, self._create_user_sql(user, profile), (password,))
+                try:
+                    yield rdb.runOperation(
+                        server, self._create_db_sql(name, user, template))
+                except psycopg2.Error as e:
+                    if template is None:
+                        raise
+                    # Most likely someone is connected to the template.
+                    raise APIError("Unable to clone %s: %s" % (
+                        template, str(e).strip()))
+                if template_row is not None:
+                    yield self._take_ownership(
+                        server, name, template_row, user)
+                if profile is not None:
+                    yield rdb.runInteraction(
+                        server, self._run_statements_interaction,
+                        self._profile_sql(name, user, profile, new_user=True))
 
                 rows = yield xylemdb.runQuery(
-                    ("INSERT INTO databases (name, host, username, password)"
-                     " VALUES (%s, %s, %s, %s) RETURNING *;"),
-                    (name, server['hostname'], user, self._encrypt(password)))
+                    INSERT_DB,
+                    (name, server['hostname'], user, self._encrypt(password),
+                     self._server_id(server), profile))
+                self._cache.put(rows[0])
 
                 defer.returnValue(self._build_db_response(rows[0]))
             else:
+                rows = yield self._query_shards(
+                    "SELECT 1 FROM databases WHERE name = %s;", (name,))
+                if any(shard_rows for _, shard_rows in rows):
+                    raise APIError('Database is being dropped')
                 raise APIError('Database exists but not known to xylem')
 
 
+class Readiness(object):
+    """
+    Hold callers until setup has finished, up to a limited number of them.
+    """
+    def __init__(self, max_waiting):
+        self.max_waiting = max_waiting
+        self.ready = False
+        self.error = None
+        self._waiting = []
+
+    def wait(self):
+        """
+        Return a Deferred that fires when we're ready, or fails with an
+        APIError if setup has failed or too many callers are waiting.
+        """
+        if self.ready:
+            return defer.succeed(None)
+        if self.error is not None:
+            return defer.fail(APIError("Setup failed: %s" % (self.error,)))
+        if len(self._waiting) >= self.max_waiting:
+            return defer.fail(APIError("Not ready yet, try again later"))
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def set_ready(self):
+        self.ready = True
+        self.error = None
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def set_failed(self, error):
+        self.error = error
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(APIError("Setup failed: %s" % (error,)))
+
+
+class InFlight(object):
+    """
+    Share the result of a call between concurrent callers using the same key.
+    """
+    def __init__(self):
+        self._waiting = {}
+
+    def run(self, key, f, *args, **kw):
+        """
+        Call `f` unless a call for `key` is already in progress, in which case
+        wait for that one to finish and return its result.
+        """
+        if key in self._waiting:
+            d = defer.Deferred()
+            self._waiting[key].append(d)
+            return d
+        self._waiting[key] = []
+        d = defer.maybeDeferred(f, *args, **kw)
+        return d.addBoth(self._finish, key)
+
+    def _finish(self, r, key):
+        for d in self._waiting.pop(key):
+            d.callback(r)
+        return r
+
+    def __contains__(self, key):
+        return key in self._waiting
+
+    def __len__(self):
+        return len(self._waiting)
+
+
 def ignore_pg_error(d, pgcode):
     """
     Ignore a particular postgres error.
@@ -1,6 +1,11 @@
+import os
+import shutil
+import stat
+import tempfile
 from uuid import uuid4
 
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
 from seed.xylem import gluster
@@ -31,6 +36,21 @@ class FakeVolume(object):
             'performance.readdir-ahead: on',
         ]
 
+    def xml(self):
+        bricks = ''.join(
+            '<brick uuid="{0}">{1}<name>{1}</name>'
+            '<hostUuid>{0}</hostUuid></brick>'.format(self.volume_id, brick)
+            for brick in self.bricks)
+        return (
+            '<volume><name>{0}</name><id>{1}</id>'
+            '<status>{2}</status><statusStr>{3}</statusStr>'
+            '<brickCount>{4}</brickCount><typeStr>Distribute</typeStr>'
+            '<bricks>{5}</bricks><optCount>1</optCount><options><option>'
+            '<name>performance.readdir-ahead</name><value>on</value>'
+            '</option></options></volume>').format(
+                self.name, self.volume_id, int(self.status == 'Started'),
+                self.status, len(self.bricks), bricks)
+
 
 class FakeGluster(object):
     """
@@ -39,6 +59,7 @@ class FakeGluster(object):
     """
     def __init__(self):
         self.volumes = {}
+        self.calls = []
 
     def add_volume(self, name, *args, **kw):
         assert name not in self.volumes
@@ -55,6 +76,40 @@ class FakeGluster(object):
             vols = self.volumes.values()
         return sum([vol.info() for vol in vols], [])
 
+    def volume_info_xml(self, name=None):
+        if name and name not in self.volumes:
+            return (
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<cliOutput><opRet>-1</opRet><opErrno>30806</opErrno>'
+                '<opErrstr>Volume {0} does not exist</opErrstr>'
+                '</cliOutput>').format(name)
+        if name:
+            vols = [self.volumes[name]]
+        else:
+            vols = self.volumes.values()
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<cliOutput><opRet>0</opRet><opErrno>0</opErrno><opErrstr/>'
+            '<volInfo><volumes>{0}<count>{1}</count></volumes></volInfo>'
+            '</cliOutput>').format(
+                ''.join(vol.xml() for vol in vols), len(vols))
+
+    def stream(self, make_parser, cmd0, cmd1, *args):
+        """
+        Feed `volume info --xml` output to a new parser in small chunks, the
+        way it would arrive from the process.
+        """
+        self.calls.append((cmd0, cmd1) + args)
+        parser = make_parser()
+        assert (cmd0, cmd1, args[-1]) == ('volume', 'info', '--xml')
+        out = self.volume_info_xml(*args[:-1])
+        for i in range(0, len(out), 7):
+            parser.feed(out[i:i + 7])
+        vols = parser.close()
+        if parser.error is not None:
+            raise Exception(parser.error)
+        return vols
+
     def cmd_volume_create(self, name, *args):
         while args[0] in ['replica', 'stripe', 'arbiter', 'transport']:
             args = args[2:]
@@ -70,6 +125,7 @@ class FakeGluster(object):
         return []
 
     def call(self, cmd0, cmd1, *args):
+        self.calls.append((cmd0, cmd1) + args)
         meth = getattr(self, '_'.join(['cmd', cmd0, cmd1]))
         return meth(*args)
 
@@ -79,18 +135,31 @@ class FakeRhumbaClient(object):
     Fake rhumba client that successfully returns made up data for all
     (implemented) methods. This is to stub out the the path stuff in the volume
     creation tests below.
+
+    Results for particular nodes can be given in `results`, keyed by host. A
+    `None` result doesn't arrive until it's fired from `pending`.
     """
-    def __init__(self, plug):
+    def __init__(self, plug, hosts=('test',)):
         self.plug = plug
+        self.servers = [{'host': host, 'uuid': str(uuid4())} for host in hosts]
+        self.results = {}
+        self.pending = {}
+        self.queued = []
 
     def clusterQueues(self):
-        return defer.succeed({self.plug.queue_name: [{'uuid': str(uuid4())}]})
+        return defer.succeed({self.plug.queue_name: self.servers})
 
-    def queue(self, *args, **kw):
+    def queue(self, queue, message, params={}, uids=[]):
+        self.queued.append((message, params))
         return defer.succeed(str(uuid4()))
 
-    def waitForResult(self, *args, **kw):
-        return defer.succeed(None)
+    def waitForResult(self, queue, uid, timeout=3600, suid=None):
+        [host] = [s['host'] for s in self.servers if s['uuid'] == suid]
+        result = self.results.get(host, {'Err': None})
+        if result is None:
+            self.pending[host] = defer.Deferred()
+            return self.pending[host]
+        return defer.succeed({'result': result, 'time': 0})
 
 
 class TestGlusterPlugin(TestCase):
@@ -100,11 +169,14 @@ class TestGlusterPlugin(TestCase):
             'gluster_nodes': ['test'],
             'gluster_mounts': ['/data'],
         }, None)
+        self.addCleanup(self.plug._shutdown)
         self.plug.client = FakeRhumbaClient(self.plug)
 
         self.fake_gluster = FakeGluster()
         self.plug.callGluster = lambda *args: defer.maybeDeferred(
             self.fake_gluster.call, *args)
+        self.plug.streamGluster = lambda *args: defer.maybeDeferred(
+            self.fake_gluster.stream, *args)
 
     @defer.inlineCallbacks
     def test_volume_info(self):
@@ -147,6 +219,43 @@ class TestGlusterPlugin(TestCase):
         vol = yield self.plug.getVolume('gv1')
         self.assertEqual(vol, None)
 
+    @defer.inlineCallbacks
+    def test_volume_info_xml(self):
+        """
+        Volume info parsed from XML has the bricks and options of each volume.
+        """
+        gv0 = self.fake_gluster.add_volume(
+            'gv0', ['node1:/data/testbrick', 'node2:/data/testbrick'],
+            status='Stopped')
+
+        vols = yield self.plug.getVolumes()
+        self.assertEqual(vols['gv0']['id'], gv0.volume_id)
+        self.assertEqual(vols['gv0']['running'], False)
+        self.assertEqual(vols['gv0']['bricks'], [
+            'node1:/data/testbrick', 'node2:/data/testbrick'])
+        self.assertEqual(vols['gv0']['options'], {
+            'performance.readdir-ahead': 'on'})
+        self.assertEqual(
+            self.fake_gluster.calls, [('volume', 'info', '--xml')])
+
+    @defer.inlineCallbacks
+    def test_volume_info_text(self):
+        """
+        With gluster_xml off, we parse the human readable volume info.
+        """
+        self.plug.gluster_xml = False
+        gv0 = self.fake_gluster.add_volume(
+            'gv0', ['qa-mesos-persistence:/data/testbrick'])
+
+        vols = yield self.plug.getVolumes()
+        self.assertEqual(vols['gv0']['id'], gv0.volume_id)
+        self.assertEqual(vols['gv0']['bricks'], [
+            'qa-mesos-persistence:/data/testbrick'])
+        missing = yield self.plug.getVolume('gv1')
+        self.assertEqual(missing, None)
+        self.assertEqual(self.fake_gluster.calls, [
+            ('volume', 'info'), ('volume', 'info', 'gv1')])
+
     @defer.inlineCallbacks
     def test_volume_create(self):
         """
@@ -196,3 +305,286 @@ class TestGlusterPlugin(TestCase):
 
         vol = self.fake_gluster.volumes['testvol']
         self.assertEqual(vol.status, 'Started')
+
+    @defer.inlineCallbacks
+    def test_volume_create_cached(self):
+        """
+        Once we know a volume is running, we don't ask gluster about it again.
+        """
+        self.fake_gluster.add_volume('testvol', bricks=['test:/data/testvol'])
+        self.fake_gluster.add_volume('othervol', bricks=['test:/data/other'])
+        yield self.plug.refreshVolumes()
+        self.assertEqual(
+            self.fake_gluster.calls, [('volume', 'info', '--xml')])
+
+        vol = yield self.plug.call_createvolume({'name': 'testvol'})
+        self.assertEqual(vol['running'], True)
+        self.assertEqual(
+            self.fake_gluster.calls, [('volume', 'info', '--xml')])
+
+    @defer.inlineCallbacks
+    def test_volume_create_updates_cache(self):
+        """
+        Creating a volume only looks up that volume, and remembers it.
+        """
+        vol = yield self.plug.call_createvolume({'name': 'testvol'})
+        self.assertEqual(vol['running'], True)
+        self.assertEqual(self.fake_gluster.calls, [
+            ('volume', 'info', 'testvol', '--xml'),
+            ('volume', 'create', 'testvol', 'test:/data/xylem-testvol',
+             'force'),
+            ('volume', 'start', 'testvol'),
+            ('volume', 'info', 'testvol', '--xml'),
+        ])
+
+        yield self.plug.call_createvolume({'name': 'testvol'})
+        self.assertEqual(len(self.fake_gluster.calls), 4)
+
+    @defer.inlineCallbacks
+    def test_volume_create_stopped_cached(self):
+        """
+        A volume we think is stopped is checked again before we start it, and
+        then updated in place.
+        """
+        self.fake_gluster.add_volume(
+            'testvol', status='Stopped', bricks=['test:/data/testvol'])
+        yield self.plug.refreshVolumes()
+        self.fake_gluster.volumes['testvol'].status = 'Started'
+
+        vol = yield self.plug.call_createvolume({'name': 'testvol'})
+        self.assertEqual(vol['running'], True)
+        self.assertEqual(self.fake_gluster.calls, [
+            ('volume', 'info', '--xml'),
+            ('volume', 'info', 'testvol', '--xml'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_volume_cache_disabled(self):
+        """
+        With a refresh interval of 0, we always ask gluster.
+        """
+        self.plug.volume_refresh_interval = 0
+        self.fake_gluster.add_volume('testvol', bricks=['test:/data/testvol'])
+        yield self.plug.refreshVolumes()
+        yield self.plug.call_createvolume({'name': 'testvol'})
+        self.assertEqual(self.fake_gluster.calls, [
+            ('volume', 'info', '--xml'),
+            ('volume', 'info', 'testvol', '--xml'),
+        ])
+
+    @defer.inlineCallbacks
+    def test_volume_create_waits_concurrently(self):
+        """
+        We wait for every node to create its directories at the same time.
+        """
+        hosts = ['node1', 'node2', 'node3']
+        self.plug.client = FakeRhumbaClient(self.plug, hosts=hosts)
+        self.plug.client.results = dict((host, None) for host in hosts)
+
+        d = self.plug.call_createvolume({'name': 'testvol'})
+        self.assertNoResult(d)
+        self.assertEqual(sorted(self.plug.client.pending), hosts)
+        for wait in self.plug.client.pending.values():
+            wait.callback({'result': {'Err': None}, 'time': 0})
+        vol = yield d
+        self.assertEqual(vol['running'], True)
+
+    @defer.inlineCallbacks
+    def test_volume_create_dirs_failed(self):
+        """
+        If a node can't create its directories, we don't create the volume
+        and say which node failed.
+        """
+        self.plug.client = FakeRhumbaClient(
+            self.plug, hosts=['node1', 'node2', 'node3'])
+        self.plug.client.results['node2'] = {'Err': 'Permission denied'}
+
+        f = yield self.assertFailure(
+            self.plug.call_createvolume({'name': 'testvol'}), Exception)
+        self.assertEqual(
+            str(f),
+            'Unable to create directories for testvol: '
+            'node2: Permission denied')
+        self.assertEqual(
+            self.fake_gluster.calls, [('volume', 'info', 'testvol', '--xml')])
+
+    def test_volume_create_dirs_timeout(self):
+        """
+        Nodes that don't answer before the deadline count as failures.
+        """
+        self.plug.clock = Clock()
+        self.plug.client = FakeRhumbaClient(
+            self.plug, hosts=['node1', 'node2'])
+        self.plug.client.results['node2'] = None
+
+        d = self.plug.call_createvolume({'name': 'testvol'})
+        self.plug.clock.advance(59)
+        self.assertNoResult(d)
+        self.plug.clock.advance(1)
+        f = self.failureResultOf(d)
+        self.assertEqual(
+            str(f.value),
+            'Unable to create directories for testvol: '
+            'node2: No result after 60.0s')
+        self.assertEqual(self.plug.clock.getDelayedCalls(), [])
+
+    def make_mounts(self, count=2):
+        base = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base)
+        mounts = [os.path.join(base, 'data%s' % (i,)) for i in range(count)]
+        for mount in mounts:
+            os.makedirs(mount)
+        self.plug.gluster_mounts = mounts
+        return mounts
+
+    @defer.inlineCallbacks
+    def test_createdirs(self):
+        """
+        Directories are created on every mount, and we get told how long each
+        one took.
+        """
+        mounts = self.make_mounts()
+        result = yield self.plug.call_createdirs({'name': 'testvol'})
+        self.assertEqual(result['Err'], None)
+        self.assertEqual(sorted(result['mounts']), mounts)
+        for mount in mounts:
+            self.assertTrue(os.path.isdir(os.path.join(mount, 'testvol')))
+            self.assertEqual(result['mounts'][mount]['Err'], None)
+            self.assertTrue(result['mounts'][mount]['time'] >= 0)
+
+        # Doing it again is fine.
+        result = yield self.plug.call_createdirs({'name': 'testvol'})
+        self.assertEqual(result['Err'], None)
+
+    @defer.inlineCallbacks
+    def test_createdirs_error(self):
+        """
+        A mount we can't create the directory on is reported, without
+        stopping the others.
+        """
+        mounts = self.make_mounts()
+        open(os.path.join(mounts[1], 'testvol'), 'w').close()
+
+        result = yield self.plug.call_createdirs({'name': 'testvol'})
+        self.assertTrue(result['Err'].startswith(mounts[1] + ': '))
+        self.assertEqual(result['mounts'][mounts[0]]['Err'], None)
+        self.assertNotEqual(result['mounts'][mounts[1]]['Err'], None)
+        self.assertTrue(os.path.isdir(os.path.join(mounts[0], 'testvol')))
+
+    @defer.inlineCallbacks
+    def test_createdirs_setup(self):
+        """
+        New directories get the mode, ownership and xattrs we ask for.
+        """
+        [mount] = self.make_mounts(1)
+        xattr_calls = []
+        self.patch(gluster.subprocess, 'check_call', xattr_calls.append)
+        self.plug.createdirs_mode = 0o750
+        self.plug.createdirs_owner = os.getuid()
+        self.plug.createdirs_group = os.getgid()
+        self.plug.createdirs_xattrs = {'trusted.xylem': 'brick'}
+
+        result = yield self.plug.call_createdirs({'name': 'testvol'})
+        self.assertEqual(result['Err'], None)
+        path = os.path.join(mount, 'testvol')
+        st = os.stat(path)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o750)
+        self.assertEqual((st.st_uid, st.st_gid), (os.getuid(), os.getgid()))
+        self.assertEqual(xattr_calls, [
+            ['setfattr', '-n', 'trusted.xylem', '-v', 'brick', path]])
+
+    @defer.inlineCallbacks
+    def test_createdirs_many(self):
+        """
+        Directories for several volumes can be created at once, and we're
+        told which volumes failed.
+        """
+        mounts = self.make_mounts()
+        open(os.path.join(mounts[0], 'vol2'), 'w').close()
+
+        result = yield self.plug.call_createdirs({'names': ['vol1', 'vol2']})
+        self.assertEqual(sorted(result['failed']), ['vol2'])
+        self.assertTrue(result['failed']['vol2'].startswith(mounts[0]))
+        self.assertEqual(result['mounts'][mounts[1]]['Err'], None)
+        for mount in mounts:
+            self.assertTrue(os.path.isdir(os.path.join(mount, 'vol1')))
+
+    @defer.inlineCallbacks
+    def test_createvolumes(self):
+        """
+        Many volumes can be provisioned at once, with one volume info to find
+        out what's there, one createdirs fan-out and one volume info at the
+        end.
+        """
+        self.fake_gluster.add_volume('running', bricks=['test:/data/r'])
+        self.fake_gluster.add_volume(
+            'stopped', bricks=['test:/data/s'], status='Stopped')
+
+        result = yield self.plug.call_createvolumes({
+            'names': ['running', 'stopped', 'new1', 'new2', 'new1']})
+        self.assertEqual(result['Err'], None)
+        vols = result['volumes']
+        self.assertEqual(
+            dict((name, r['status']) for name, r in vols.items()), {
+                'running': 'exists',
+                'stopped': 'started',
+                'new1': 'created',
+                'new2': 'created',
+            })
+        for name, r in vols.items():
+            self.assertEqual(r['volume']['running'], True)
+            self.assertEqual(
+                self.fake_gluster.volumes[name].status, 'Started')
+
+        self.assertEqual(self.plug.client.queued, [
+            ('createdirs', {'names': ['new1', 'new2']})])
+        info_calls = [c for c in self.fake_gluster.calls if c[1] == 'info']
+        self.assertEqual(info_calls, [('volume', 'info', '--xml')] * 2)
+
+    @defer.inlineCallbacks
+    def test_createvolumes_dirs_failed(self):
+        """
+        Volumes whose directories couldn't be created on some node aren't
+        created, but the rest are.
+        """
+        self.plug.client = FakeRhumbaClient(
+            self.plug, hosts=['node1', 'node2'])
+        self.plug.client.results['node2'] = {
+            'Err': '/data: Permission denied',
+            'failed': {'vol2': '/data: Permission denied'},
+        }
+
+        result = yield self.plug.call_createvolumes({
+            'names': ['vol1', 'vol2']})
+        self.assertEqual(result['Err'], 'Unable to provision vol2')
+        self.assertEqual(result['volumes']['vol1']['status'], 'created')
+        self.assertEqual(result['volumes']['vol2'], {
+            'Err': 'Unable to create directories: '
+                   'node2: /data: Permission denied'})
+        self.assertEqual(sorted(self.fake_gluster.volumes), ['vol1'])
+
+    @defer.inlineCallbacks
+    def test_createvolumes_pipeline(self):
+        """
+        Only `createvolumes_pipeline` volumes are created at once.
+        """
+        self.plug.createvolumes_pipeline = 2
+        creating = []
+
+        def createVolume(name, dirs=True):
+            d = defer.Deferred()
+            creating.append((name, d))
+            return d
+        self.plug.createVolume = createVolume
+
+        d = self.plug.call_createvolumes({'names': ['v1', 'v2', 'v3']})
+        self.assertEqual([name for name, _ in creating], ['v1', 'v2'])
+        creating[0][1].callback(None)
+        self.assertEqual([name for name, _ in creating], ['v1', 'v2', 'v3'])
+        creating[1][1].callback(None)
+        creating[2][1].callback(None)
+
+        result = yield d
+        self.assertEqual(
+            sorted(name for name, r in result['volumes'].items()
+                   if r['status'] == 'created'), ['v1', 'v2', 'v3'])
@@ -0,0 +1,205 @@
+from twisted.internet import error
+from twisted.internet.task import Clock
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.gluster_exec import GlusterExecutor
+
+
+class FakeTransport(object):
+    def __init__(self, proto):
+        self.proto = proto
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+        self.proto.processEnded(failure.Failure(
+            error.ProcessTerminated(signal=9)))
+
+
+class FakeProcessReactor(Clock):
+    """
+    A clock that also pretends to spawn processes.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.processes = []
+
+    def spawnProcess(self, proto, executable, args, env=None):
+        transport = FakeTransport(proto)
+        proto.makeConnection(transport)
+        self.processes.append((proto, args))
+        return transport
+
+    def finish(self, out='', err='', code=0, signal=None):
+        """
+        End the oldest process we've started.
+        """
+        proto, _ = self.processes.pop(0)
+        if out:
+            proto.outReceived(out)
+        if err:
+            proto.errReceived(err)
+        if signal is not None:
+            reason = error.ProcessTerminated(signal=signal)
+        elif code:
+            reason = error.ProcessTerminated(exitCode=code)
+        else:
+            reason = error.ProcessDone(0)
+        proto.processEnded(failure.Failure(reason))
+
+
+class FakeParser(object):
+    def __init__(self):
+        self.data = []
+        self.error = None
+
+    def feed(self, data):
+        self.data.append(data)
+
+    def close(self):
+        return ''.join(self.data)
+
+
+class TestGlusterExecutor(TestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+
+    def get_executor(self, **kw):
+        return GlusterExecutor('/usr/sbin/gluster', clock=self.reactor, **kw)
+
+    def test_output(self):
+        """
+        We get the lines of output a command gives.
+        """
+        executor = self.get_executor()
+        d = executor.run(('volume', 'info'))
+        [(_, args)] = self.reactor.processes
+        self.assertEqual(args, ('/usr/sbin/gluster', 'volume', 'info'))
+        self.reactor.finish(out='line 1\nline 2\n')
+        self.assertEqual(self.successResultOf(d), ['line 1', 'line 2'])
+
+    def test_parser(self):
+        """
+        Output can be given to a parser as it arrives.
+        """
+        executor = self.get_executor()
+        d = executor.run(('volume', 'info', '--xml'), FakeParser)
+        proto, _ = self.reactor.processes[0]
+        proto.outReceived('<a>')
+        proto.outReceived('</a>')
+        self.reactor.finish()
+        self.assertEqual(self.successResultOf(d), '<a></a>')
+
+    def test_error(self):
+        """
+        A command that fails gives us its error output.
+        """
+        executor = self.get_executor()
+        d = executor.run(('volume', 'start', 'gv0'))
+        self.reactor.finish(err='volume start: gv0: failed', code=1)
+        f = self.failureResultOf(d)
+        self.assertEqual(str(f.value), 'volume start: gv0: failed')
+        self.assertEqual(executor.stats()['commands']['volume start'][
+            'errors'], 1)
+
+    def test_killed(self):
+        """
+        A command killed by a signal has failed, even if it gave us some
+        output first.
+        """
+        executor = self.get_executor()
+        d = executor.run(('volume', 'create', 'gv0'))
+        self.reactor.finish(out='partial\n', signal=11)
+        f = self.failureResultOf(d)
+        self.assertIn('signal 11', str(f.value))
+        self.assertEqual(executor.stats()['commands']['volume create'][
+            'errors'], 1)
+
+    def test_concurrency(self):
+        """
+        Only `concurrency` commands run at once, and the rest go in order as
+        the running ones finish.
+        """
+        executor = self.get_executor(concurrency=2)
+        ds = [executor.run(('volume', 'info', name))
+              for name in ['gv0', 'gv1', 'gv2']]
+        self.assertEqual(len(self.reactor.processes), 2)
+        self.assertEqual(executor.running, 2)
+        self.assertEqual(executor.queued, 1)
+
+        self.reactor.finish(out='gv0')
+        self.assertEqual(
+            [args[-1] for _, args in self.reactor.processes], ['gv1', 'gv2'])
+        self.reactor.finish(out='gv1')
+        self.reactor.finish(out='gv2')
+        self.assertEqual(
+            [self.successResultOf(d) for d in ds],
+            [['gv0'], ['gv1'], ['gv2']])
+        self.assertEqual(executor.running, 0)
+
+    def test_timeout(self):
+        """
+        A command that takes too long is killed.
+        """
+        executor = self.get_executor(timeout=30)
+        d = executor.run(('volume', 'create', 'gv0'))
+        proto, _ = self.reactor.processes[0]
+        self.reactor.advance(29)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.assertEqual(proto.transport.signals, ['KILL'])
+        f = self.failureResultOf(d)
+        self.assertEqual(
+            str(f.value), 'gluster volume create gv0 timed out after 30s')
+
+        stats = executor.stats()['commands']['volume create']
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['max_time'], 30)
+
+    def test_retry_locked(self):
+        """
+        Commands that fail because another holds the lock are retried after
+        a delay that grows each time.
+        """
+        executor = self.get_executor(retry_delay=1)
+        d = executor.run(('volume', 'info', '--xml'), FakeParser)
+        self.reactor.finish(
+            err='Another transaction is in progress. Please try again.',
+            code=1)
+        self.assertEqual(self.reactor.processes, [])
+        self.reactor.advance(1)
+        self.reactor.finish(err='Locking failed on node2', code=1)
+        self.reactor.advance(1)
+        self.assertEqual(self.reactor.processes, [])
+        self.reactor.advance(1)
+        self.reactor.finish(out='<a/>')
+        self.assertEqual(self.successResultOf(d), '<a/>')
+
+        stats = executor.stats()['commands']['volume info']
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['retries'], 2)
+
+    def test_retry_limit(self):
+        """
+        We stop retrying after `retries` attempts.
+        """
+        executor = self.get_executor(retries=1, retry_delay=1)
+        d = executor.run(('volume', 'start', 'gv0'))
+        self.reactor.finish(err='Another transaction is in progress', code=1)
+        self.reactor.advance(1)
+        self.reactor.finish(err='Another transaction is in progress', code=1)
+        f = self.failureResultOf(d)
+        self.assertEqual(str(f.value), 'Another transaction is in progress')
+
+    def test_no_retry(self):
+        """
+        Other errors aren't retried.
+        """
+        executor = self.get_executor()
+        d = executor.run(('volume', 'info', 'gv1'))
+        self.reactor.finish(err='Volume gv1 does not exist', code=1)
+        self.failureResultOf(d)
+        self.assertEqual(
+            executor.stats()['commands']['volume info']['retries'], 0)
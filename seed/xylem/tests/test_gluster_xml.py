@@ -0,0 +1,115 @@
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.gluster_xml import VolumeInfoParser
+
+
+VOLUME_INFO = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cliOutput>
+  <opRet>0</opRet>
+  <opErrno>0</opErrno>
+  <opErrstr/>
+  <volInfo>
+    <volumes>
+      <volume>
+        <name>gv0</name>
+        <id>e2a6b5c2-0000-4000-8000-000000000000</id>
+        <status>1</status>
+        <statusStr>Started</statusStr>
+        <brickCount>2</brickCount>
+        <typeStr>Replicate</typeStr>
+        <bricks>
+          <brick uuid="aaaa">node1:/data/xylem-gv0
+            <name>node1:/data/xylem-gv0</name>
+            <hostUuid>aaaa</hostUuid>
+          </brick>
+          <brick uuid="bbbb">node2:/data/xylem-gv0
+            <name>node2:/data/xylem-gv0</name>
+            <hostUuid>bbbb</hostUuid>
+          </brick>
+        </bricks>
+        <optCount>1</optCount>
+        <options>
+          <option>
+            <name>performance.readdir-ahead</name>
+            <value>on</value>
+          </option>
+        </options>
+      </volume>
+      <volume>
+        <name>gv1</name>
+        <id>e2a6b5c2-0000-4000-8000-000000000001</id>
+        <status>2</status>
+        <statusStr>Stopped</statusStr>
+        <brickCount>1</brickCount>
+        <typeStr>Distribute</typeStr>
+        <bricks>
+          <brick>node1:/data/xylem-gv1</brick>
+        </bricks>
+        <optCount>0</optCount>
+        <options/>
+      </volume>
+      <count>2</count>
+    </volumes>
+  </volInfo>
+</cliOutput>
+"""
+
+MISSING_VOLUME = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<cliOutput>
+  <opRet>-1</opRet>
+  <opErrno>30806</opErrno>
+  <opErrstr>Volume gv2 does not exist</opErrstr>
+</cliOutput>
+"""
+
+
+class TestVolumeInfoParser(TestCase):
+    def feed(self, parser, data, size=5):
+        for i in range(0, len(data), size):
+            parser.feed(data[i:i + size])
+        return parser.close()
+
+    def test_volumes(self):
+        """
+        Each volume is parsed, however the output is split up.
+        """
+        parser = VolumeInfoParser()
+        vols = self.feed(parser, VOLUME_INFO)
+        self.assertEqual(parser.error, None)
+        self.assertEqual(sorted(vols), ['gv0', 'gv1'])
+        self.assertEqual(vols['gv0'], {
+            'id': 'e2a6b5c2-0000-4000-8000-000000000000',
+            'running': True,
+            'type': 'Replicate',
+            'brick_count': 2,
+            'bricks': ['node1:/data/xylem-gv0', 'node2:/data/xylem-gv0'],
+            'brick_uuids': {
+                'node1:/data/xylem-gv0': 'aaaa',
+                'node2:/data/xylem-gv0': 'bbbb',
+            },
+            'options': {'performance.readdir-ahead': 'on'},
+        })
+        self.assertEqual(vols['gv1']['running'], False)
+        self.assertEqual(vols['gv1']['bricks'], ['node1:/data/xylem-gv1'])
+        self.assertEqual(vols['gv1']['options'], {})
+
+    def test_callback(self):
+        """
+        With a callback, volumes are handed over as soon as they are parsed.
+        """
+        seen = []
+        parser = VolumeInfoParser(lambda name, vol: seen.append(name))
+        end = VOLUME_INFO.index('</volume>') + len('</volume>')
+        parser.feed(VOLUME_INFO[:end])
+        self.assertEqual(seen, ['gv0'])
+        parser.feed(VOLUME_INFO[end:])
+        self.assertEqual(parser.close(), {})
+        self.assertEqual(seen, ['gv0', 'gv1'])
+
+    def test_error(self):
+        """
+        Errors reported by gluster are available once parsed.
+        """
+        parser = VolumeInfoParser()
+        self.assertEqual(self.feed(parser, MISSING_VOLUME), {})
+        self.assertEqual(parser.error, 'Volume gv2 does not exist')
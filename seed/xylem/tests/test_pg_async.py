@@ -0,0 +1,192 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_async import AsyncConnectionPool
+from seed.xylem.pg_compat import psycopg2, extensions
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.readers = set()
+        self.writers = set()
+
+    def addReader(self, reader):
+        self.readers.add(reader)
+
+    def removeReader(self, reader):
+        self.readers.discard(reader)
+
+    def addWriter(self, writer):
+        self.writers.add(writer)
+
+    def removeWriter(self, writer):
+        self.writers.discard(writer)
+
+    def ready(self):
+        """
+        Let everything we're watching continue.
+        """
+        for reader in list(self.readers):
+            reader.doRead()
+        for writer in list(self.writers):
+            writer.doWrite()
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.executed.append((sql, args))
+        self.conn.states = [extensions.POLL_READ, extensions.POLL_OK]
+
+    def fetchall(self):
+        return [(self.conn.executed[-1][0],)]
+
+
+class FakeConnection(object):
+    def __init__(self, **kw):
+        self.kw = kw
+        self.closed = 0
+        self.executed = []
+        self.states = [extensions.POLL_WRITE, extensions.POLL_OK]
+
+    def fileno(self):
+        return 42
+
+    def poll(self):
+        state = self.states.pop(0)
+        if isinstance(state, Exception):
+            self.closed = 2
+            raise state
+        return state
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class TestAsyncConnectionPool(TestCase):
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.conns = []
+
+    def connect(self, **kw):
+        conn = FakeConnection(**kw)
+        self.conns.append(conn)
+        return conn
+
+    def get_pool(self, cp_max=2, **kw):
+        pool = AsyncConnectionPool(
+            cp_max=cp_max, connect=self.connect, clock=self.reactor,
+            database='xylem', **kw)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_query(self):
+        """
+        Queries wait for the reactor to say the connection is ready, without
+        using a thread.
+        """
+        pool = self.get_pool()
+        d = pool.runQuery("SELECT 1;")
+        self.assertNoResult(d)
+        [conn] = self.conns
+        self.assertEqual(conn.kw, {'database': 'xylem'})
+        self.reactor.ready()
+        self.assertNoResult(d)
+        self.reactor.ready()
+        self.assertEqual(self.successResultOf(d), [("SELECT 1;",)])
+        self.assertEqual(self.reactor.readers, set())
+        self.assertEqual(self.reactor.writers, set())
+
+        d = pool.runOperation("SELECT %s;", (2,))
+        self.reactor.ready()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(conn.executed[-1], ("SELECT %s;", (2,)))
+        self.assertEqual(len(self.conns), 1)
+
+    def test_limited(self):
+        """
+        Only `cp_max` connections are opened, and further queries wait for
+        one of them.
+        """
+        pool = self.get_pool(cp_max=1)
+        d1 = pool.runQuery("SELECT 1;")
+        d2 = pool.runQuery("SELECT 2;")
+        self.assertEqual(len(pool.connections), 1)
+        self.reactor.ready()
+        self.reactor.ready()
+        self.assertEqual(self.successResultOf(d1), [("SELECT 1;",)])
+        self.assertNoResult(d2)
+        self.reactor.ready()
+        self.assertEqual(self.successResultOf(d2), [("SELECT 2;",)])
+        self.assertEqual(len(self.conns), 1)
+
+    def test_broken_connection(self):
+        """
+        A connection that breaks is dropped, and replaced on next use.
+        """
+        pool = self.get_pool()
+        d = pool.runQuery("SELECT 1;")
+        self.reactor.ready()
+        self.reactor.ready()
+        self.successResultOf(d)
+        [conn] = self.conns
+
+        d = pool.runQuery("SELECT 2;")
+        conn.states = [psycopg2.OperationalError("gone")]
+        self.reactor.ready()
+        self.failureResultOf(d, psycopg2.OperationalError)
+        self.assertEqual(pool.connections, [])
+
+        pool.runQuery("SELECT 3;")
+        self.assertEqual(len(self.conns), 2)
+
+    def test_close(self):
+        """
+        Closing the pool closes idle connections and fails waiting queries.
+        """
+        pool = self.get_pool(cp_max=1)
+        d1 = pool.runQuery("SELECT 1;")
+        d2 = pool.runQuery("SELECT 2;")
+        pool.close()
+        self.failureResultOf(d2, psycopg2.InterfaceError)
+        self.reactor.ready()
+        self.reactor.ready()
+        self.successResultOf(d1)
+        self.assertEqual(pool.connections, [])
+        self.assertEqual(self.conns[0].closed, 1)
+        self.failureResultOf(
+            pool.runQuery("SELECT 3;"), psycopg2.InterfaceError)
+
+    def test_connect_timeout(self):
+        """
+        A connection that takes longer than `connect_timeout` to establish
+        is closed, and the query fails.
+        """
+        pool = self.get_pool(connect_timeout=5)
+        d = pool.runQuery("SELECT 1;")
+        [conn] = self.conns
+        self.assertEqual(conn.kw, {'database': 'xylem', 'connect_timeout': 5})
+        self.reactor.advance(4)
+        self.assertNoResult(d)
+        self.reactor.advance(1)
+        self.failureResultOf(d, psycopg2.OperationalError)
+        self.assertEqual(conn.closed, 1)
+        self.assertEqual(pool.connections, [])
+        self.assertEqual(self.reactor.writers, set())
+
+    def test_connect_timeout_connected(self):
+        """
+        Once we're connected, the connect timeout no longer applies.
+        """
+        pool = self.get_pool(connect_timeout=5)
+        d = pool.runQuery("SELECT 1;")
+        self.reactor.ready()
+        self.reactor.ready()
+        self.successResultOf(d)
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
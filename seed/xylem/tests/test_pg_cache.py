@@ -0,0 +1,80 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_cache import CredentialCache
+
+
+def mkrow(name, password='encrypted'):
+    return {
+        'name': name,
+        'host': 'localhost',
+        'username': 'user_%s' % (name,),
+        'password': password,
+    }
+
+
+class TestCredentialCache(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = CredentialCache(max_size=2, ttl=60, clock=self.clock)
+
+    def test_get_missing(self):
+        """
+        Looking up something we don't have counts as a miss.
+        """
+        self.assertEqual(self.cache.get('db1'), None)
+        self.assertEqual(self.cache.stats(), {
+            'size': 0, 'max_size': 2, 'hits': 0, 'misses': 1})
+
+    def test_put_get(self):
+        """
+        Cached rows are returned as plain dicts with the password left as we
+        stored it.
+        """
+        self.cache.put(dict(mkrow('db1'), extra='ignored'))
+        self.assertEqual(self.cache.get('db1'), mkrow('db1'))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_expiry(self):
+        """
+        Rows older than the TTL are treated as missing.
+        """
+        self.cache.put(mkrow('db1'))
+        self.clock.advance(59)
+        self.assertEqual(self.cache.get('db1'), mkrow('db1'))
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get('db1'), None)
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        """
+        When we're full, the least recently used row is evicted.
+        """
+        self.cache.put(mkrow('db1'))
+        self.cache.put(mkrow('db2'))
+        self.cache.get('db1')
+        self.cache.put(mkrow('db3'))
+        self.assertEqual(self.cache.get('db2'), None)
+        self.assertEqual(self.cache.get('db1'), mkrow('db1'))
+        self.assertEqual(self.cache.get('db3'), mkrow('db3'))
+
+    def test_invalidate(self):
+        """
+        We can drop individual rows or everything.
+        """
+        self.cache.put(mkrow('db1'))
+        self.cache.put(mkrow('db2'))
+        self.cache.invalidate('db1')
+        self.cache.invalidate('missing')
+        self.assertEqual(self.cache.get('db1'), None)
+        self.assertEqual(self.cache.get('db2'), mkrow('db2'))
+        self.cache.clear()
+        self.assertEqual(self.cache.get('db2'), None)
+
+    def test_disabled(self):
+        """
+        A cache with no space never stores anything.
+        """
+        cache = CredentialCache(max_size=0, clock=self.clock)
+        cache.put(mkrow('db1'))
+        self.assertEqual(cache.get('db1'), None)
@@ -0,0 +1,72 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_health import ServerHealth, CLOSED, OPEN, HALF_OPEN
+
+
+class TestServerHealth(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.health = ServerHealth(
+            failure_threshold=2, reset_timeout=30, clock=self.clock)
+
+    def test_unknown(self):
+        """
+        Servers we haven't checked yet are assumed to be fine.
+        """
+        self.assertEqual(self.health.state('db1'), CLOSED)
+        self.assertTrue(self.health.available('db1'))
+        self.assertTrue(self.health.should_check('db1'))
+        self.assertEqual(self.health.stats(), {})
+
+    def test_opens_after_failures(self):
+        """
+        Enough consecutive failures open the circuit.
+        """
+        self.health.record_failure('db1', 'nope')
+        self.assertEqual(self.health.state('db1'), CLOSED)
+        self.health.record_success('db1', 0.1)
+        self.health.record_failure('db1', 'nope')
+        self.assertEqual(self.health.state('db1'), CLOSED)
+        self.health.record_failure('db1', 'nope')
+        self.assertEqual(self.health.state('db1'), OPEN)
+        self.assertFalse(self.health.available('db1'))
+        self.assertFalse(self.health.should_check('db1'))
+
+    def test_half_open(self):
+        """
+        After the reset timeout we check again. Success closes the circuit,
+        failure opens it again immediately.
+        """
+        for _ in range(2):
+            self.health.record_failure('db1', 'nope')
+        self.clock.advance(30)
+        self.assertEqual(self.health.state('db1'), HALF_OPEN)
+        self.assertFalse(self.health.available('db1'))
+        self.assertTrue(self.health.should_check('db1'))
+
+        self.health.record_failure('db1', 'still nope')
+        self.assertEqual(self.health.state('db1'), OPEN)
+
+        self.clock.advance(30)
+        self.health.record_success('db1', 0.2)
+        self.assertEqual(self.health.state('db1'), CLOSED)
+        self.assertTrue(self.health.available('db1'))
+
+    def test_stats(self):
+        """
+        We can see the health of every server we've checked.
+        """
+        self.clock.advance(5)
+        self.health.record_success('db1', 0.01)
+        self.health.record_failure('db2', 'refused')
+        self.assertEqual(self.health.stats(), {
+            'db1': {
+                'state': CLOSED, 'failures': 0, 'latency': 0.01,
+                'last_error': None, 'last_checked': 5,
+            },
+            'db2': {
+                'state': CLOSED, 'failures': 1, 'latency': None,
+                'last_error': 'refused', 'last_checked': 5,
+            },
+        })
@@ -0,0 +1,76 @@
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_migrations import MIGRATIONS, current_version, migrate
+
+
+class FakeCursor(object):
+    def __init__(self, applied=(), fail_on=None):
+        self.applied = list(applied)
+        self.fail_on = fail_on
+        self.statements = []
+
+    def execute(self, sql, args=None):
+        if sql == self.fail_on:
+            raise ValueError("failed: %s" % (sql,))
+        self.statements.append(sql)
+
+    def fetchall(self):
+        return [(v,) for v in self.applied]
+
+
+MIGRATIONS_FOR_TESTS = [
+    (1, "one", ["CREATE one;"]),
+    (2, "two", ["CREATE two;", "ALTER two;"]),
+    (3, "three", ["CREATE three;"]),
+]
+
+
+class TestMigrations(TestCase):
+    def test_versions_ascending(self):
+        """
+        Migration versions are unique and in order.
+        """
+        versions = [version for version, _, _ in MIGRATIONS]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(current_version(), versions[-1])
+
+    def test_migrate_all(self):
+        """
+        A fresh database gets every migration, in order, in one transaction.
+        """
+        cursor = FakeCursor()
+        self.assertEqual(migrate(cursor, MIGRATIONS_FOR_TESTS), [1, 2, 3])
+        statements = cursor.statements
+        self.assertEqual(statements[0], "BEGIN;")
+        self.assertEqual(statements[-1], "COMMIT;")
+        self.assertEqual(
+            [s for s in statements if s.startswith(("CREATE ", "ALTER "))
+             and "xylem_schema" not in s],
+            ["CREATE one;", "CREATE two;", "ALTER two;", "CREATE three;"])
+
+    def test_migrate_pending(self):
+        """
+        Migrations that have already been applied are skipped.
+        """
+        cursor = FakeCursor(applied=[1, 2])
+        self.assertEqual(migrate(cursor, MIGRATIONS_FOR_TESTS), [3])
+        self.assertNotIn("CREATE one;", cursor.statements)
+        self.assertNotIn("CREATE two;", cursor.statements)
+        self.assertIn("CREATE three;", cursor.statements)
+
+    def test_migrate_nothing(self):
+        """
+        If everything has been applied, nothing happens.
+        """
+        cursor = FakeCursor(applied=[1, 2, 3])
+        self.assertEqual(migrate(cursor, MIGRATIONS_FOR_TESTS), [])
+        self.assertEqual(cursor.statements[-1], "COMMIT;")
+
+    def test_migrate_failure(self):
+        """
+        If a migration fails, the whole transaction is rolled back.
+        """
+        cursor = FakeCursor(fail_on="ALTER two;")
+        self.assertRaises(ValueError, migrate, cursor, MIGRATIONS_FOR_TESTS)
+        self.assertEqual(cursor.statements[-1], "ROLLBACK;")
+        self.assertNotIn("COMMIT;", cursor.statements)
@@ -0,0 +1,97 @@
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_placement import Placement
+
+
+def first(seq):
+    return seq[0]
+
+
+class TestPlacement(TestCase):
+    def setUp(self):
+        self.placement = Placement(choice=first)
+        self.servers = [
+            {'hostname': 'db1'},
+            {'hostname': 'db2'},
+            {'hostname': 'db3'},
+        ]
+
+    def test_no_stats(self):
+        """
+        Without any stats, we fall back to the chooser.
+        """
+        self.assertEqual(
+            self.placement.choose(self.servers), {'hostname': 'db1'})
+
+    def test_no_servers(self):
+        """
+        With no servers to choose from, we choose nothing.
+        """
+        self.assertEqual(self.placement.choose([]), None)
+
+    def test_least_loaded(self):
+        """
+        We choose the server with the least load.
+        """
+        self.placement.update('db1', 10, 1000, 5)
+        self.placement.update('db2', 5, 200, 1)
+        self.placement.update('db3', 5, 900, 1)
+        self.assertEqual(
+            self.placement.choose(self.servers), {'hostname': 'db2'})
+
+    def test_unknown_servers_skipped(self):
+        """
+        Once we have stats, servers without any aren't chosen.
+        """
+        self.placement.update('db3', 100, 100000, 50)
+        self.assertEqual(
+            self.placement.choose(self.servers), {'hostname': 'db3'})
+
+    def test_weight(self):
+        """
+        A heavier weight lets a server take more load.
+        """
+        servers = [{'hostname': 'db1'}, {'hostname': 'db2', 'weight': 4}]
+        self.placement.update('db1', 5, 100, 5)
+        self.placement.update('db2', 10, 200, 10)
+        self.assertEqual(self.placement.choose(servers)['hostname'], 'db2')
+
+    def test_max_databases(self):
+        """
+        Full servers aren't eligible, and if everything is full we have
+        nowhere to put anything.
+        """
+        servers = [
+            {'hostname': 'db1', 'max_databases': 2},
+            {'hostname': 'db2', 'max_databases': 10},
+        ]
+        self.placement.update('db1', 1, 0, 0)
+        self.placement.update('db2', 9, 5000, 20)
+        self.assertEqual(self.placement.choose(servers)['hostname'], 'db1')
+        self.assertEqual(self.placement.choose(servers)['hostname'], 'db2')
+        self.assertEqual(self.placement.choose(servers), None)
+
+    def test_choice_counts(self):
+        """
+        Choosing a server counts the new database against it, so we spread
+        new databases out between refreshes.
+        """
+        self.placement.update('db1', 3, 0, 0)
+        self.placement.update('db2', 4, 0, 0)
+        self.placement.update('db3', 5, 0, 0)
+        chosen = [self.placement.choose(self.servers)['hostname']
+                  for _ in range(6)]
+        self.assertEqual(chosen, ['db1', 'db1', 'db2', 'db1', 'db2', 'db3'])
+
+    def test_remove(self):
+        """
+        Removed servers are no longer considered.
+        """
+        self.placement.update('db1', 1, 0, 0)
+        self.placement.update('db2', 2, 0, 0)
+        self.placement.remove('db1')
+        self.placement.remove('missing')
+        self.assertEqual(self.placement.stats(), {
+            'db2': {'db_count': 2, 'total_size': 0, 'backends': 0}})
+        self.assertEqual(
+            self.placement.choose(self.servers)['hostname'], 'db2')
@@ -0,0 +1,129 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_pools import ServerPools
+
+
+class FakePool(object):
+    def __init__(self, server, max_size):
+        self.server = server
+        self.max_size = max_size
+        self.connections = {}
+        self.closed = False
+        self.pending = None
+
+    def runQuery(self, *args, **kw):
+        if self.pending is not None:
+            return self.pending
+        return succeed(('query', args, kw))
+
+    def runOperation(self, *args, **kw):
+        return succeed(('operation', args, kw))
+
+    def close(self):
+        self.closed = True
+
+
+class TestServerPools(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.created = []
+        self.pools = ServerPools(
+            self.connect, max_size=2, idle_timeout=60, clock=self.clock)
+
+    def connect(self, server, max_size):
+        pool = FakePool(server, max_size)
+        self.created.append(pool)
+        return pool
+
+    def test_lazy_and_shared(self):
+        """
+        Pools are only created when a server is first used, and then reused.
+        """
+        server = {'hostname': 'db1'}
+        self.assertEqual(self.created, [])
+        r = self.successResultOf(self.pools.runQuery(server, "SELECT 1;"))
+        self.assertEqual(r, ('query', ("SELECT 1;",), {}))
+        self.successResultOf(self.pools.runOperation(server, "SELECT 2;"))
+        self.assertEqual(len(self.created), 1)
+
+        self.successResultOf(
+            self.pools.runQuery({'hostname': 'db2'}, "SELECT 1;"))
+        self.assertEqual(len(self.created), 2)
+
+    def test_per_server_max_size(self):
+        """
+        Servers can override the default maximum pool size.
+        """
+        self.pools.runQuery({'hostname': 'db1'}, "SELECT 1;")
+        self.pools.runQuery({'hostname': 'db2', 'pool_max': 5}, "SELECT 1;")
+        self.assertEqual([p.max_size for p in self.created], [2, 5])
+
+    def test_evict_idle(self):
+        """
+        Pools that have been idle for too long are closed and recreated on
+        next use.
+        """
+        server = {'hostname': 'db1'}
+        self.pools.runQuery(server, "SELECT 1;")
+        [pool] = self.created
+
+        self.clock.advance(59)
+        self.pools.evict_idle()
+        self.assertFalse(pool.closed)
+
+        self.clock.advance(1)
+        self.pools.evict_idle()
+        self.assertTrue(pool.closed)
+        self.assertEqual(self.pools.stats(), {})
+
+        self.pools.runQuery(server, "SELECT 1;")
+        self.assertEqual(len(self.created), 2)
+
+    def test_evict_idle_in_use(self):
+        """
+        Pools with requests in flight are never evicted.
+        """
+        server = {'hostname': 'db1'}
+        self.pools.runQuery(server, "SELECT 1;")
+        [pool] = self.created
+        pool.pending = Deferred()
+        d = self.pools.runQuery(server, "SELECT 1;")
+
+        self.clock.advance(120)
+        self.pools.evict_idle()
+        self.assertFalse(pool.closed)
+
+        pool.pending.callback('done')
+        self.assertEqual(self.successResultOf(d), 'done')
+        self.clock.advance(60)
+        self.pools.evict_idle()
+        self.assertTrue(pool.closed)
+
+    def test_stats(self):
+        """
+        We can get usage information for each pool.
+        """
+        server = {'hostname': 'db1'}
+        self.pools.runQuery(server, "SELECT 1;")
+        self.pools.runQuery(server, "SELECT 1;")
+        self.clock.advance(10)
+        self.assertEqual(self.pools.stats(), {'db1': {
+            'max_size': 2,
+            'connections': 0,
+            'in_use': 0,
+            'requests': 2,
+            'age': 10,
+            'idle': 10,
+        }})
+
+    def test_close(self):
+        """
+        Closing the registry closes every pool.
+        """
+        self.pools.runQuery({'hostname': 'db1'}, "SELECT 1;")
+        self.pools.runQuery({'hostname': 'db2'}, "SELECT 1;")
+        self.pools.close()
+        self.assertEqual([p.closed for p in self.created], [True, True])
+        self.assertEqual(self.pools.stats(), {})
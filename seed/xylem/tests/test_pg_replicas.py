@@ -0,0 +1,104 @@
+from twisted.internet.defer import fail, succeed
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_replicas import ReadReplicas
+
+
+class FakePool(object):
+    def __init__(self, name, lag=0, broken=False):
+        self.name = name
+        self.lag = lag
+        self.broken = broken
+        self.queries = []
+        self.closed = False
+
+    def runQuery(self, query, *args):
+        self.queries.append(query)
+        if self.broken:
+            return fail(Exception('%s is broken' % (self.name,)))
+        if query.startswith('SELECT CASE WHEN NOT pg_is_in_recovery()'):
+            return succeed([[self.lag]])
+        return succeed(self.name)
+
+    def close(self):
+        self.closed = True
+
+
+class TestReadReplicas(TestCase):
+    def setUp(self):
+        self.primary = FakePool('primary')
+        self.replicas = ReadReplicas(self.primary, max_lag=5)
+
+    def test_no_replicas(self):
+        """
+        Without replicas, everything goes to the primary.
+        """
+        self.assertFalse(self.replicas.enabled)
+        d = self.replicas.runQuery("SELECT 1;")
+        self.assertEqual(self.successResultOf(d), 'primary')
+
+    def test_unchecked_replicas_unused(self):
+        """
+        We don't use replicas until we know their lag.
+        """
+        self.replicas.add('r1', FakePool('r1'))
+        self.assertTrue(self.replicas.enabled)
+        d = self.replicas.runQuery("SELECT 1;")
+        self.assertEqual(self.successResultOf(d), 'primary')
+
+    def test_round_robin(self):
+        """
+        Reads are spread over replicas that are keeping up.
+        """
+        self.replicas.add('r1', FakePool('r1'))
+        self.replicas.add('r2', FakePool('r2', lag=1))
+        self.replicas.add('r3', FakePool('r3', lag=10))
+        self.successResultOf(self.replicas.check_lag())
+
+        results = [self.successResultOf(self.replicas.runQuery("SELECT 1;"))
+                   for _ in range(4)]
+        self.assertEqual(sorted(results), ['r1', 'r1', 'r2', 'r2'])
+        stats = self.replicas.stats()
+        self.assertEqual(stats['primary_queries'], 0)
+        self.assertEqual(stats['replicas']['r3'], {
+            'lag': 10.0, 'usable': False, 'queries': 0, 'last_error': None})
+
+    def test_fallback(self):
+        """
+        If a replica query fails, we ask the primary instead.
+        """
+        replica = FakePool('r1')
+        self.replicas.add('r1', replica)
+        self.successResultOf(self.replicas.check_lag())
+        replica.broken = True
+
+        d = self.replicas.runQuery("SELECT 1;")
+        self.assertEqual(self.successResultOf(d), 'primary')
+        self.assertEqual(
+            self.replicas.stats()['replicas']['r1']['last_error'],
+            'r1 is broken')
+
+    def test_failed_check(self):
+        """
+        A replica whose lag we can't check isn't used.
+        """
+        replica = FakePool('r1')
+        self.replicas.add('r1', replica)
+        self.successResultOf(self.replicas.check_lag())
+        replica.broken = True
+        self.successResultOf(self.replicas.check_lag())
+        replica.broken = False
+
+        d = self.replicas.runQuery("SELECT 1;")
+        self.assertEqual(self.successResultOf(d), 'primary')
+
+    def test_close(self):
+        """
+        Closing closes the replica pools, but not the primary.
+        """
+        replica = FakePool('r1')
+        self.replicas.add('r1', replica)
+        self.replicas.close()
+        self.assertTrue(replica.closed)
+        self.assertFalse(self.primary.closed)
+        self.assertFalse(self.replicas.enabled)
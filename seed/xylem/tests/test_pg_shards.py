@@ -0,0 +1,103 @@
+from twisted.trial.unittest import TestCase
+
+from seed.xylem.pg_shards import HashRing, MetadataShards
+
+
+class FakePool(object):
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+NAMES = ['db_%s' % (i,) for i in range(1000)]
+
+
+class TestHashRing(TestCase):
+    def test_empty(self):
+        """
+        With no nodes, keys don't go anywhere.
+        """
+        self.assertEqual(HashRing().get('db_1'), None)
+
+    def test_stable(self):
+        """
+        The same key always maps to the same node, whatever order the nodes
+        were added in.
+        """
+        ring1 = HashRing()
+        ring2 = HashRing()
+        for node in ['a', 'b', 'c']:
+            ring1.add(node)
+        for node in ['c', 'a', 'b']:
+            ring2.add(node)
+        self.assertEqual(
+            [ring1.get(n) for n in NAMES], [ring2.get(n) for n in NAMES])
+
+    def test_spread(self):
+        """
+        Keys are spread over every node.
+        """
+        ring = HashRing()
+        for node in ['a', 'b', 'c']:
+            ring.add(node)
+        counts = {}
+        for name in NAMES:
+            node = ring.get(name)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(sorted(counts), ['a', 'b', 'c'])
+        self.assertTrue(min(counts.values()) > 200)
+
+    def test_add_node(self):
+        """
+        Adding a node only moves keys to the new node.
+        """
+        ring = HashRing()
+        ring.add('a')
+        ring.add('b')
+        before = dict((name, ring.get(name)) for name in NAMES)
+        ring.add('c')
+        moved = [name for name in NAMES if ring.get(name) != before[name]]
+        self.assertNotEqual(moved, [])
+        self.assertEqual(set(ring.get(name) for name in moved), set(['c']))
+
+
+class TestMetadataShards(TestCase):
+    def test_primary_only(self):
+        """
+        With just the primary, everything lives there.
+        """
+        primary = FakePool('main')
+        shards = MetadataShards('main', primary)
+        self.assertFalse(shards.enabled)
+        self.assertEqual(shards.shard_for('db_1'), 'main')
+        self.assertEqual(shards.group(['db_1', 'db_2']),
+                         {'main': ['db_1', 'db_2']})
+
+    def test_group(self):
+        """
+        Keys are grouped by the shard they belong on.
+        """
+        shards = MetadataShards('main', FakePool('main'))
+        shards.add('other', FakePool('other'))
+        self.assertTrue(shards.enabled)
+        groups = shards.group(NAMES)
+        self.assertEqual(sorted(groups), ['main', 'other'])
+        for shard, names in groups.items():
+            self.assertEqual(
+                set(shards.shard_for(name) for name in names), set([shard]))
+            self.assertEqual(shards.pool(shard).name, shard)
+
+    def test_close(self):
+        """
+        Closing closes every pool but the primary's.
+        """
+        primary = FakePool('main')
+        other = FakePool('other')
+        shards = MetadataShards('main', primary)
+        shards.add('other', other)
+        shards.close()
+        self.assertFalse(primary.closed)
+        self.assertTrue(other.closed)
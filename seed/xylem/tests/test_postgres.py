@@ -1,8 +1,13 @@
-from twisted.internet.defer import inlineCallbacks, succeed, fail
+from twisted.internet.defer import (
+    Deferred, gatherResults, inlineCallbacks, returnValue, succeed, fail)
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
 from twisted.trial.unittest import TestCase
 
-from seed.xylem import postgres
-from seed.xylem.postgres import ignore_pg_error, cursor_closer
+from seed.xylem import pg_migrations, postgres
+from seed.xylem.pg_async import AsyncConnectionPool
+from seed.xylem.postgres import (
+    ignore_pg_error, cursor_closer, APIError, InFlight, Readiness)
 from seed.xylem.pg_compat import psycopg2, errorcodes
 
 
@@ -41,6 +46,95 @@ class TestPostgresHelpers(TestCase):
         self.assertEqual(self.failureResultOf(d).value, err)
 
 
+class TestInFlight(TestCase):
+    def test_single_call(self):
+        """
+        A call with no competition just returns its own result.
+        """
+        inflight = InFlight()
+        d = inflight.run('a', lambda x: x * 2, 21)
+        self.assertEqual(self.successResultOf(d), 42)
+        self.assertEqual(len(inflight), 0)
+
+    def test_shared_result(self):
+        """
+        Concurrent calls for the same key share the first call's result.
+        """
+        inflight = InFlight()
+        calls = []
+
+        def f(x):
+            calls.append(x)
+            return pending
+
+        pending = Deferred()
+        d1 = inflight.run('a', f, 1)
+        d2 = inflight.run('a', f, 2)
+        d3 = inflight.run('b', lambda: 'b')
+        self.assertEqual(self.successResultOf(d3), 'b')
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+
+        pending.callback('done')
+        self.assertEqual(calls, [1])
+        self.assertEqual(self.successResultOf(d1), 'done')
+        self.assertEqual(self.successResultOf(d2), 'done')
+        self.assertEqual(len(inflight), 0)
+
+    def test_shared_failure(self):
+        """
+        Failures are shared too.
+        """
+        inflight = InFlight()
+        pending = Deferred()
+        d1 = inflight.run('a', lambda: pending)
+        d2 = inflight.run('a', lambda: pending)
+        pending.errback(ValueError('boom'))
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+
+class TestReadiness(TestCase):
+    def test_ready(self):
+        """
+        Callers wait until we're ready, after which they don't wait at all.
+        """
+        readiness = Readiness(10)
+        d = readiness.wait()
+        self.assertNoResult(d)
+        readiness.set_ready()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(self.successResultOf(readiness.wait()), None)
+
+    def test_failed(self):
+        """
+        If setup fails, waiting callers and new ones get an error straight
+        away, until setup succeeds.
+        """
+        readiness = Readiness(10)
+        d = readiness.wait()
+        readiness.set_failed("boom")
+        f = self.failureResultOf(d, APIError)
+        self.assertEqual(f.value.err_msg, "Setup failed: boom")
+        f = self.failureResultOf(readiness.wait(), APIError)
+        self.assertEqual(f.value.err_msg, "Setup failed: boom")
+        readiness.set_ready()
+        self.successResultOf(readiness.wait())
+
+    def test_bounded(self):
+        """
+        Only a limited number of callers may wait.
+        """
+        readiness = Readiness(2)
+        d1 = readiness.wait()
+        d2 = readiness.wait()
+        f = self.failureResultOf(readiness.wait(), APIError)
+        self.assertEqual(f.value.err_msg, "Not ready yet, try again later")
+        readiness.set_ready()
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+
+
 class TestPostgresPlugin(TestCase):
     def get_plugin_no_setup(self, config_override={}):
         """
@@ -55,7 +149,9 @@ class TestPostgresPlugin(TestCase):
             }]
         }
         config.update(config_override)
-        return postgres.Plugin(config, None, setup_db=False)
+        plug = postgres.Plugin(config, None, setup_db=False)
+        self.addCleanup(plug._shutdown)
+        return plug
 
     def get_plugin(self, config_override={}):
         """
@@ -69,14 +165,26 @@ class TestPostgresPlugin(TestCase):
         """
         plug = self.get_plugin_no_setup(config_override=config_override)
         d = self.cleanup_databases_table(plug)
+        d.addCallback(lambda _: self.cleanup_warm_pool(plug))
         d.addCallback(lambda _: plug._setup_db())
         d.addCallback(lambda _: plug)
         return d
 
+    @inlineCallbacks
     def cleanup_databases_table(self, plug):
-        d = self.run_operation(plug, "DROP TABLE databases;")
-        ignore_pg_error(d, errorcodes.UNDEFINED_TABLE)
-        return d
+        # Without the schema version table, setup starts from scratch.
+        for table in ["databases", "warm_databases", "xylem_schema"]:
+            d = self.run_operation(plug, "DROP TABLE %s;" % (table,))
+            yield ignore_pg_error(d, errorcodes.UNDEFINED_TABLE)
+
+    @inlineCallbacks
+    def cleanup_warm_pool(self, plug):
+        dbs = yield self.list_dbs(plug)
+        for dbname in dbs:
+            if dbname.startswith("xylem_warm_"):
+                yield self._dropdb(plug, dbname)
+        d = self.run_operation(plug, "DROP TABLE warm_databases;")
+        yield ignore_pg_error(d, errorcodes.UNDEFINED_TABLE)
 
     def dropdb(self, plug, dbname):
         self.addCleanup(self._dropdb, plug, dbname)
@@ -104,6 +212,17 @@ class TestPostgresPlugin(TestCase):
             plug, "SELECT datname FROM pg_database WHERE NOT datistemplate;")
         return d.addCallback(lambda r: [x[0] for x in r])
 
+    def no_background_checks(self, plug):
+        """
+        Stop the plugin's background checks from doing anything, for tests
+        that run them by hand.
+        """
+        plug._health_checker.f = lambda: None
+        plug._placement_refresher.f = lambda: None
+
+    def server_requests(self, plug):
+        return sum(s["requests"] for s in plug._server_pools.stats().values())
+
     @inlineCallbacks
     def assert_pg_error(self, d, exc_type, pgcode=None):
         e = yield self.assertFailure(d, exc_type)
@@ -123,6 +242,235 @@ class TestPostgresPlugin(TestCase):
         dec = plug._decrypt(enc)
         self.assertEqual(dec, 'Test string')
 
+    def test_pwgens_many(self):
+        """
+        We can encrypt and decrypt several passwords at once, and each gets
+        its own IV.
+        """
+        plug = self.get_plugin_no_setup()
+        enc = plug._encrypt_many(['one', 'two', 'one'])
+        self.assertNotEqual(enc[0], enc[2])
+        self.assertEqual(plug._decrypt_many(enc), ['one', 'two', 'one'])
+        self.assertEqual(plug._decrypt_many([]), [])
+
+    def test_pwgens_key_ids(self):
+        """
+        Passwords record which key they were encrypted with, so we can still
+        decrypt them after the key changes.
+        """
+        plug = self.get_plugin_no_setup()
+        unversioned = plug._encrypt('first')
+        plug = self.get_plugin_no_setup({'key': 'second', 'key_id': 2})
+        second = plug._encrypt('second')
+        self.assertTrue(second.startswith('2$'))
+
+        plug = self.get_plugin_no_setup({
+            'key': 'third',
+            'key_id': 3,
+            'old_keys': {2: 'second'},
+            'unversioned_key': 'mysecretkey',
+        })
+        self.assertEqual(
+            plug._decrypt_many([unversioned, second]), ['first', 'second'])
+        e = self.assertRaises(APIError, plug._decrypt, '4$AAAA')
+        self.assertEqual(e.err_msg, "Unknown encryption key: 4")
+
+    def test_xylem_db_shared(self):
+        """
+        We only ever build one pool for xylem's internal DB.
+        """
+        plug = self.get_plugin_no_setup({'db_pool_max': 3})
+        pool = plug._xylem_db()
+        self.assertIdentical(plug._xylem_db(), pool)
+        self.assertEqual(pool.max, 3)
+
+    @inlineCallbacks
+    def test_xylem_db_health_check(self):
+        """
+        Health checks start with the plugin and exercise the shared pool.
+        """
+        plug = self.get_plugin_no_setup()
+        pool = plug._xylem_db()
+        result = yield plug._check_xylem_db()
+        self.assertEqual(result, None)
+        self.assertTrue(pool.running)
+        self.assertTrue(plug._xylem_pool_checker.running)
+
+    @inlineCallbacks
+    def test_xylem_db_reconnect(self):
+        """
+        If the backend behind a pooled connection goes away, the health check
+        reports it and the pool reconnects for the next query.
+        """
+        plug = self.get_plugin_no_setup({'db_pool_max': 1})
+        logs = []
+        plug.log = logs.append
+        pool = plug._xylem_db()
+        [[pid]] = yield pool.runQuery("SELECT pg_backend_pid();")
+
+        yield self.run_query(plug, "SELECT pg_terminate_backend(%s);", (pid,))
+        yield plug._check_xylem_db()
+        self.assertEqual(len(logs), 1)
+        self.assertTrue(logs[0].startswith("xylem DB health check failed"))
+        # adbapi logs the failed rollback when it drops the connection.
+        self.flushLoggedErrors()
+
+        [[new_pid]] = yield pool.runQuery("SELECT pg_backend_pid();")
+        self.assertNotEqual(new_pid, pid)
+        self.assertIdentical(plug._xylem_db(), pool)
+
+    @inlineCallbacks
+    def test_shutdown(self):
+        """
+        Shutting down stops health checks and closes the shared pool, and is
+        safe to do more than once.
+        """
+        plug = self.get_plugin_no_setup()
+        pool = plug._xylem_db()
+        checker = plug._xylem_pool_checker
+        yield pool.runQuery("SELECT 1;")
+        self.assertTrue(pool.running)
+        self.assertTrue(pool.threadpool.started)
+
+        plug._shutdown()
+        self.assertFalse(checker.running)
+        self.assertFalse(pool.running)
+        self.assertEqual(pool.startID, None)
+        self.assertFalse(pool.threadpool.started)
+        self.assertEqual(pool.threadpool.workers, 0)
+        self.assertEqual(plug._xylem_db(), None)
+        plug._shutdown()
+
+    def test_shutdown_before_start(self):
+        """
+        A plugin shut down before its pool starts never starts it.
+        """
+        plug = self.get_plugin_no_setup()
+        pool = plug._xylem_db()
+        plug._shutdown()
+        self.assertEqual(pool.startID, None)
+        self.assertFalse(pool.running)
+
+    @inlineCallbacks
+    def test_server_pools_reused(self):
+        """
+        Target server admin pools are kept open and reused across requests.
+        """
+        dbname1 = "xylem_test_pool_reuse1"
+        dbname2 = "xylem_test_pool_reuse2"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname1)
+        yield self.dropdb(plug, dbname2)
+
+        yield plug.call_create_database({"name": dbname1})
+        [pool_entry] = plug._server_pools._pools.values()
+        requests = self.server_requests(plug)
+        yield plug.call_create_database({"name": dbname2})
+        self.assertEqual(plug._server_pools._pools.values(), [pool_entry])
+        self.assertTrue(pool_entry.pool.running)
+
+        stats = plug.call_pool_stats({})
+        self.assertEqual(stats["Err"], None)
+        self.assertEqual(stats["xylem"]["max_size"], 5)
+        # Checking, creating the user and creating the database.
+        self.assertEqual(
+            stats["servers"]["localhost"]["requests"], requests + 3)
+        self.assertEqual(stats["servers"]["localhost"]["in_use"], 0)
+
+        plug._shutdown()
+        self.assertFalse(pool_entry.pool.running)
+
+    @inlineCallbacks
+    def test_refresh_placement(self):
+        """
+        We collect load stats from reachable servers and leave out the ones we
+        can't reach.
+        """
+        plug = self.get_plugin_no_setup({'servers': [
+            {"hostname": "localhost"},
+            {"hostname": "down.example.com", "connect_addr": "localhost",
+             "port": 1},
+        ]})
+        self.no_background_checks(plug)
+        logs = []
+        plug.log = logs.append
+        yield plug._refresh_placement()
+
+        stats = plug.call_placement_stats({})
+        self.assertEqual(stats["Err"], None)
+        self.assertEqual(stats["servers"].keys(), ["localhost"])
+        local = stats["servers"]["localhost"]
+        self.assertTrue(local["db_count"] >= 2)
+        self.assertTrue(local["total_size"] > 0)
+        self.assertTrue(local["backends"] >= 1)
+        self.assertEqual(len(logs), 1)
+        self.assertTrue(logs[0].startswith(
+            "Unable to get stats for down.example.com"))
+
+        # Only the reachable server gets new databases.
+        for _ in range(3):
+            self.assertEqual(plug._choose_server()["hostname"], "localhost")
+
+    @inlineCallbacks
+    def test_check_servers(self):
+        """
+        We check every server, and stop placing databases on servers that
+        keep failing.
+        """
+        plug = self.get_plugin_no_setup({
+            'health_failure_threshold': 2,
+            'servers': [
+                {"hostname": "localhost"},
+                {"hostname": "down.example.com", "connect_addr": "localhost",
+                 "port": 1},
+            ]})
+        self.no_background_checks(plug)
+        logs = []
+        plug.log = logs.append
+        # Pretend we have load stats for both, so only health matters.
+        plug._placement.update("localhost", 1000, 0, 0)
+        plug._placement.update("down.example.com", 0, 0, 0)
+
+        yield plug._check_servers()
+        self.assertEqual(plug._choose_server()["hostname"], "down.example.com")
+        yield plug._check_servers()
+        self.assertEqual(plug._choose_server()["hostname"], "localhost")
+
+        health = plug.call_server_health({})
+        self.assertEqual(health["Err"], None)
+        local = health["servers"]["localhost"]
+        down = health["servers"]["down.example.com"]
+        self.assertEqual(local["state"], "closed")
+        self.assertTrue(local["latency"] > 0)
+        self.assertEqual(down["state"], "open")
+        self.assertEqual(down["failures"], 2)
+        self.assertNotEqual(down["last_error"], None)
+        self.assertTrue(
+            logs[0].startswith("Health check failed for down.example.com"))
+
+        # Open circuits aren't checked again until they're half-open.
+        yield plug._check_servers()
+        self.assertEqual(
+            plug.call_server_health({})["servers"]["down.example.com"][
+                "failures"], 2)
+
+    @inlineCallbacks
+    def test_call_create_database_no_servers(self):
+        """
+        If every server is full, we can't create anything.
+        """
+        dbname = "xylem_test_create_full"
+        plug = yield self.get_plugin({'servers': [
+            {"hostname": "localhost", "max_databases": 1},
+        ]})
+        yield plug._refresh_placement()
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(
+            result, {"Err": "No servers available for new databases"})
+        result = yield plug.call_create_databases({"names": [dbname]})
+        self.assertEqual(result["results"], {
+            dbname: {"Err": "No servers available for new databases"}})
+
     @inlineCallbacks
     def test_setup_db(self):
         """
@@ -139,6 +487,47 @@ class TestPostgresPlugin(TestCase):
         rows = yield self.run_query(plug, "SELECT * FROM databases")
         self.assertEqual(rows, [])
 
+    @inlineCallbacks
+    def test_requests_wait_for_setup(self):
+        """
+        Requests that arrive before setup finishes wait for it.
+        """
+        dbname = "xylem_test_create_before_setup"
+        plug = self.get_plugin_no_setup()
+        yield self.cleanup_databases_table(plug)
+        yield self.dropdb(plug, dbname)
+
+        d = plug.call_create_database({"name": dbname})
+        self.assertNoResult(d)
+        yield plug._setup_db()
+        result = yield d
+        self.assertEqual(result["Err"], None)
+
+    @inlineCallbacks
+    def test_setup_db_failure(self):
+        """
+        If setup fails, requests are rejected immediately and setup is
+        retried later.
+        """
+        plug = self.get_plugin_no_setup(
+            {"db_port": 1, "setup_retry_interval": 60})
+        logs = []
+        plug.log = logs.append
+        waiting = plug.call_create_database({"name": "xylem_test_nope"})
+
+        yield plug._setup_db()
+        self.assertTrue(logs[0].startswith("Setup failed, retrying in 60.0s"))
+        self.assertTrue(plug._setup_retry.active())
+
+        result = yield waiting
+        self.assertTrue(result["Err"].startswith("Setup failed: "))
+        result = yield plug.call_create_databases({"names": ["x"]})
+        self.assertTrue(result["Err"].startswith("Setup failed: "))
+
+        retry = plug._setup_retry
+        plug._shutdown()
+        self.assertFalse(retry.active())
+
     @inlineCallbacks
     def test_setup_db_again(self):
         """
@@ -153,6 +542,64 @@ class TestPostgresPlugin(TestCase):
         rows = yield self.run_query(plug, "SELECT * FROM databases")
         self.assertEqual(rows, [])
 
+    @inlineCallbacks
+    def test_setup_db_schema_version(self):
+        """
+        Setup records the migrations it has applied.
+        """
+        plug = yield self.get_plugin()
+        rows = yield self.run_query(
+            plug, "SELECT version FROM xylem_schema ORDER BY version")
+        self.assertEqual(
+            [r[0] for r in rows],
+            [v for v, _, _ in pg_migrations.MIGRATIONS])
+
+    @inlineCallbacks
+    def test_setup_db_upgrade(self):
+        """
+        Tables from before we tracked schema versions are upgraded in place.
+        """
+        plug = self.get_plugin_no_setup()
+        yield self.cleanup_databases_table(plug)
+        yield self.run_operation(
+            plug,
+            "CREATE TABLE databases (name varchar(66) UNIQUE, host"
+            " varchar(256), username varchar(256), password varchar(256));")
+        yield self.run_operation(
+            plug, "INSERT INTO databases VALUES (%s, %s, %s, %s);",
+            ("xylem_test_old", "localhost", "u", plug._encrypt("p")))
+        yield plug._setup_db()
+        rows = yield self.run_query(
+            plug, "SELECT name, server_id FROM databases")
+        self.assertEqual([list(r) for r in rows],
+                         [["xylem_test_old", "localhost"]])
+
+    @inlineCallbacks
+    def test_created_database_metadata(self):
+        """
+        New databases are recorded with their server id and creation time,
+        and access times are written out in batches.
+        """
+        dbname = "xylem_test_metadata"
+        plug = yield self.get_plugin({"servers": [
+            {"hostname": "localhost", "id": "local"}]})
+        yield self.dropdb(plug, dbname)
+        yield plug.call_create_database({"name": dbname})
+        rows = yield self.run_query(
+            plug, "SELECT server_id, created_at, last_accessed"
+            " FROM databases WHERE name = %s", (dbname,))
+        [(server_id, created_at, last_accessed)] = rows
+        self.assertEqual(server_id, "local")
+        self.assertNotEqual(created_at, None)
+        self.assertEqual(last_accessed, None)
+
+        yield plug._flush_access_times()
+        self.assertEqual(plug._accessed, set())
+        rows = yield self.run_query(
+            plug, "SELECT last_accessed FROM databases WHERE name = %s",
+            (dbname,))
+        self.assertNotEqual(rows[0][0], None)
+
     @inlineCallbacks
     def test_call_create_database_bad_name(self):
         """
@@ -190,6 +637,30 @@ class TestPostgresPlugin(TestCase):
         dbs = yield self.list_dbs(plug)
         self.assertTrue(dbname in dbs)
 
+    @inlineCallbacks
+    def test_call_create_database_async_driver(self):
+        """
+        Creating databases works the same with the async driver.
+        """
+        dbname = "xylem_test_create_async"
+        plug = yield self.get_plugin({"db_driver": "async"})
+        self.assertIsInstance(plug._xylem_db(), AsyncConnectionPool)
+        yield self.dropdb(plug, dbname)
+
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result["Err"], None)
+        again = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(again, result)
+        dbs = yield self.list_dbs(plug)
+        self.assertTrue(dbname in dbs)
+
+    def test_unknown_db_driver(self):
+        """
+        We only know about the adbapi and async drivers.
+        """
+        self.assertRaises(
+            ValueError, self.get_plugin_no_setup, {"db_driver": "nope"})
+
     @inlineCallbacks
     def test_call_create_database_idempotent(self):
         """
@@ -218,10 +689,679 @@ class TestPostgresPlugin(TestCase):
         self.assertTrue(dbname in dbs)
 
         # Recreate the database
+        pool = plug._xylem_db()
         result = yield plug.call_create_database({"name": dbname})
         self.assertEqual(result, expected_result)
+        # The shared pool is reused, not torn down between requests.
+        self.assertIdentical(plug._xylem_db(), pool)
+        self.assertTrue(pool.running)
+        dbs = yield self.list_dbs(plug)
+        self.assertTrue(dbname in dbs)
+
+    @inlineCallbacks
+    def test_call_create_database_cached(self):
+        """
+        Repeat requests are served from the cache without touching the
+        databases table until the entry is invalidated.
+        """
+        dbname = "xylem_test_create_cached"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+
+        result = yield plug.call_create_database({"name": dbname})
+        # The cache holds the encrypted password, not the plaintext.
+        self.assertNotEqual(
+            plug._cache.get(dbname)["password"], result["password"])
+
+        # Remove the row behind the cache's back.
+        yield self.run_operation(
+            plug, "DELETE FROM databases WHERE name=%s;", (dbname,))
+        cached = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(cached, result)
+
+        stats = plug.call_cache_stats({})
+        self.assertEqual(stats["Err"], None)
+        self.assertEqual(stats["size"], 1)
+        # One hit for our own check above, one for the repeat request.
+        self.assertEqual(stats["hits"], 2)
+
+        plug._cache.invalidate(dbname)
+        r = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(
+            r, {"Err": "Database exists but not known to xylem"})
+
+    @inlineCallbacks
+    def test_call_create_database_concurrent(self):
+        """
+        Concurrent requests for the same database share one result instead of
+        racing each other.
+        """
+        dbname = "xylem_test_create_concurrent"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+
+        results = yield gatherResults([
+            plug.call_create_database({"name": dbname}) for _ in range(5)])
+        self.assertEqual(results[0]["Err"], None)
+        self.assertEqual(results, [results[0]] * 5)
+        self.assertEqual(len(plug._inflight), 0)
+
+        rows = yield self.run_query(
+            plug, "SELECT name FROM databases WHERE name=%s;", (dbname,))
+        self.assertEqual(len(rows), 1)
+
+    @inlineCallbacks
+    def test_call_create_database_advisory_lock(self):
+        """
+        With advisory locks enabled, we wait for other nodes holding the lock
+        for a database and release our own lock when we're done.
+        """
+        dbname = "xylem_test_create_locked"
+        plug = yield self.get_plugin({"advisory_locks": True})
+        other = self.get_plugin_no_setup({"advisory_locks": True})
+        yield self.dropdb(plug, dbname)
+
+        yield other._advisory_lock(dbname)
+        d = plug.call_create_database({"name": dbname})
+        # Give the request a moment to find the lock held.
+        yield deferLater(reactor, 0.3, lambda: None)
+        self.assertNoResult(d)
+
+        yield other._advisory_unlock(dbname)
+        result = yield d
+        self.assertEqual(result["Err"], None)
+
+        # Our lock was released, so the other node can take it immediately.
+        [[locked]] = yield other._lock_pool.runQuery(
+            "SELECT pg_try_advisory_lock(%s, hashtext(%s));",
+            (postgres.ADVISORY_LOCK_CLASS, dbname))
+        self.assertTrue(locked)
+        yield other._advisory_unlock(dbname)
+
+    @inlineCallbacks
+    def test_call_create_database_advisory_lock_timeout(self):
+        """
+        If we can't get the lock in time, we give up with an error.
+        """
+        dbname = "xylem_test_create_lock_timeout"
+        plug = yield self.get_plugin(
+            {"advisory_locks": True, "advisory_lock_timeout": 0.2})
+        other = self.get_plugin_no_setup({"advisory_locks": True})
+        yield self.dropdb(plug, dbname)
+
+        yield other._advisory_lock(dbname)
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(
+            result, {"Err": "Timed out waiting for lock on %s" % (dbname,)})
+        yield other._advisory_unlock(dbname)
+
+    @inlineCallbacks
+    def test_call_create_databases(self):
+        """
+        We can create and look up several databases in one call, with a
+        result for each name.
+        """
+        known = "xylem_test_batch_known"
+        unknown = "xylem_test_batch_unknown"
+        new = ["xylem_test_batch_new%s" % (i,) for i in range(4)]
+        plug = yield self.get_plugin({'servers': [
+            {"hostname": "db1.example.com", "connect_addr": "localhost"},
+            {"hostname": "db2.example.com", "connect_addr": "localhost"},
+        ]})
+        for dbname in [known, unknown] + new:
+            yield self.dropdb(plug, dbname)
+
+        known_result = yield plug.call_create_database({"name": known})
+        yield self.run_operation(plug, "CREATE DATABASE %s;" % (unknown,))
+        requests_before = self.server_requests(plug)
+
+        result = yield plug.call_create_databases({
+            "names": [known, unknown, "bad-name"] + new + [new[0]]})
+        self.assertEqual(result["Err"], None)
+        results = result["results"]
+        self.assertEqual(
+            sorted(results), sorted([known, unknown, "bad-name"] + new))
+        self.assertEqual(results[known], known_result)
+        self.assertEqual(results[unknown], {
+            "Err": "Database exists but not known to xylem"})
+        self.assertEqual(
+            results["bad-name"], {"Err": "Database name must be alphanumeric"})
+
+        dbs = yield self.list_dbs(plug)
+        for dbname in new:
+            self.assertEqual(results[dbname]["Err"], None)
+            self.assertEqual(results[dbname]["name"], dbname)
+            self.assertTrue(dbname in dbs)
+            # The batch result matches what a single lookup returns.
+            single = yield plug.call_create_database({"name": dbname})
+            self.assertEqual(single, results[dbname])
+
+        # The batch used a single interaction per server it placed databases
+        # on, and there are only two servers.
+        hosts = set(results[dbname]["hostname"] for dbname in new)
+        self.assertEqual(
+            self.server_requests(plug) - requests_before, len(hosts))
+
+    @inlineCallbacks
+    def test_call_create_databases_bad_args(self):
+        """
+        We need a list of names.
+        """
+        plug = yield self.get_plugin()
+        result = yield plug.call_create_databases({"names": "notalist"})
+        self.assertEqual(result, {"Err": "names must be a list"})
+
+    @inlineCallbacks
+    def test_call_create_databases_concurrent_single(self):
+        """
+        A single create running at the same time as a batch that includes the
+        same name shares its result.
+        """
+        dbname = "xylem_test_batch_concurrent"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+
+        d1 = plug.call_create_database({"name": dbname})
+        d2 = plug.call_create_databases({"names": [dbname]})
+        single = yield d1
+        batch = yield d2
+        self.assertEqual(single["Err"], None)
+        self.assertEqual(batch["results"][dbname], single)
+
+    @inlineCallbacks
+    def test_call_create_databases_insert_failed(self):
+        """
+        If we can't record some new databases, each of them gets an error
+        while the rest of the batch still succeeds.
+        """
+        names = ["xylem_test_batch_unrecorded%s" % (i,) for i in range(2)]
+        plug = yield self.get_plugin()
+        for dbname in names:
+            yield self.dropdb(plug, dbname)
+
+        def fail_insert(cursor, entries, query=None):
+            raise psycopg2.OperationalError("metadata DB went away")
+        plug._insert_dbs_interaction = fail_insert
+
+        result = yield plug.call_create_databases({"names": names})
+        self.assertEqual(result["Err"], None)
+        for dbname in names:
+            self.assertEqual(result["results"][dbname], {
+                "Err": "Unable to record %s: metadata DB went away" % (
+                    dbname,)})
+
+    @inlineCallbacks
+    def test_call_create_databases_provision_failed(self):
+        """
+        If provisioning fails outright, the request fails and so does anyone
+        waiting on the same names, without leaving unhandled errors behind.
+        """
+        dbname = "xylem_test_batch_provision_failed"
+        plug = yield self.get_plugin()
+
+        waiters = []
+
+        def fail_provision(names, requested_profile=None):
+            # The name is claimed by now, so this waits for the batch.
+            waiters.append(plug._inflight.run(dbname, lambda: None))
+            return fail(Exception("provisioning broke"))
+        plug._provision_dbs = fail_provision
+
+        yield self.assertFailure(
+            plug.call_create_databases({"names": [dbname]}), Exception)
+        [waiter] = waiters
+        yield self.assertFailure(waiter, Exception)
+
+    @inlineCallbacks
+    def test_warm_pool_refill(self):
+        """
+        We keep the configured number of warm databases on each server.
+        """
+        plug = yield self.get_plugin({'servers': [
+            {"hostname": "localhost", "warm_pool_size": 2},
+            {"hostname": "db.example.com", "connect_addr": "localhost"},
+        ]})
+        yield plug._refill_warm_pool()
+
+        rows = yield self.run_query(
+            plug, "SELECT name, host FROM warm_databases;")
+        self.assertEqual([r["host"] for r in rows], ["localhost"] * 2)
+        dbs = yield self.list_dbs(plug)
+        for row in rows:
+            self.assertTrue(row["name"] in dbs)
+
+        # A second refill doesn't add any more.
+        yield plug._refill_warm_pool()
+        rows = yield self.run_query(plug, "SELECT name FROM warm_databases;")
+        self.assertEqual(len(rows), 2)
+
+    @inlineCallbacks
+    def test_call_create_database_warm(self):
+        """
+        If there's a warm database available, we claim it instead of creating
+        a new one, and refill the pool afterwards.
+        """
+        dbname = "xylem_test_create_warm"
+        plug = yield self.get_plugin({"warm_pool_size": 1})
+        yield self.dropdb(plug, dbname)
+        yield plug._refill_warm_pool()
+        [warm] = yield self.run_query(plug, "SELECT * FROM warm_databases;")
+
+        refill = plug._refill_warm_pool
+        refills = []
+        plug._refill_warm_pool = lambda: refills.append(refill())
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result, {
+            "Err": None,
+            "name": dbname,
+            "hostname": "localhost",
+            "user": warm["username"],
+            "password": plug._decrypt(warm["password"]),
+        })
         dbs = yield self.list_dbs(plug)
         self.assertTrue(dbname in dbs)
+        self.assertFalse(warm["name"] in dbs)
+
+        # The claimed database is now a normal one.
+        plug._cache.clear()
+        again = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(again, result)
+
+        # And the pool was refilled.
+        self.assertEqual(len(refills), 1)
+        yield refills[0]
+        [new_warm] = yield self.run_query(
+            plug, "SELECT * FROM warm_databases;")
+        self.assertNotEqual(new_warm["name"], warm["name"])
+
+    @inlineCallbacks
+    def test_call_create_database_warm_missing(self):
+        """
+        If a warm database has gone missing, we fall back to creating a new
+        database.
+        """
+        dbname = "xylem_test_create_warm_gone"
+        plug = yield self.get_plugin({"warm_pool_size": 1})
+        logs = []
+        plug.log = logs.append
+        yield self.dropdb(plug, dbname)
+        yield plug._refill_warm_pool()
+        [warm] = yield self.run_query(plug, "SELECT * FROM warm_databases;")
+        yield self._dropdb(plug, warm["name"])
+
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result["Err"], None)
+        self.assertNotEqual(result["user"], warm["username"])
+        self.assertTrue(logs[0].startswith(
+            "Unable to claim warm database %s" % (warm["name"],)))
+        # There's nothing left to track.
+        rows = yield self.run_query(
+            plug, "SELECT * FROM warm_databases WHERE name = %s;",
+            (warm["name"],))
+        self.assertEqual(rows, [])
+
+    @inlineCallbacks
+    def test_call_create_database_warm_in_use(self):
+        """
+        If we can't rename a warm database that still exists, it goes back in
+        the pool and we create a new database instead.
+        """
+        dbname = "xylem_test_create_warm_busy"
+        plug = yield self.get_plugin({"warm_pool_size": 1})
+        logs = []
+        plug.log = logs.append
+        yield self.dropdb(plug, dbname)
+        yield plug._refill_warm_pool()
+        [warm] = yield self.run_query(plug, "SELECT * FROM warm_databases;")
+
+        # Postgres won't rename a database someone is connected to.
+        pool = plug._get_connection(
+            warm["name"], "localhost", 5432, "postgres", None, cp_max=1)
+        self.addCleanup(pool.close)
+        yield pool.runQuery("SELECT 1;")
+
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result["Err"], None)
+        self.assertNotEqual(result["user"], warm["username"])
+        self.assertTrue(logs[0].startswith(
+            "Unable to claim warm database %s" % (warm["name"],)))
+        [restored] = yield self.run_query(
+            plug, "SELECT * FROM warm_databases;")
+        self.assertEqual(restored, warm)
+
+    @inlineCallbacks
+    def run_as(self, plug, creds, sql, *args):
+        """
+        Run a query inside a database we created, as its owner.
+        """
+        pool = plug._get_connection(
+            creds["name"], "localhost", 5432, creds["user"],
+            creds["password"])
+        try:
+            rows = yield pool.runQuery(sql, *args)
+        finally:
+            pool.close()
+        returnValue(rows)
+
+    @inlineCallbacks
+    def test_call_clone_database(self):
+        """
+        We can clone a database we manage, and the clone's owner owns
+        everything in it.
+        """
+        source = "xylem_test_clone_src"
+        dbname = "xylem_test_clone_dst"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+        yield self.dropdb(plug, source)
+
+        src = yield plug.call_create_database({"name": source})
+        yield self.run_as(
+            plug, src, "CREATE TABLE t (v text); INSERT INTO t VALUES ('x');"
+            " SELECT 1;")
+
+        result = yield plug.call_clone_database(
+            {"name": dbname, "source": source})
+        self.assertEqual(result["Err"], None)
+        self.assertEqual(result["hostname"], "localhost")
+        self.assertNotEqual(result["user"], src["user"])
+
+        rows = yield self.run_as(
+            plug, result, "SELECT v, pg_get_userbyid(relowner) FROM t,"
+            " pg_class WHERE relname='t';")
+        self.assertEqual([list(r) for r in rows], [["x", result["user"]]])
+
+        owners = yield self.run_query(
+            plug, "SELECT datname, pg_get_userbyid(datdba) FROM pg_database"
+            " WHERE datname IN (%s, %s) ORDER BY datname;", (dbname, source))
+        self.assertEqual([list(r) for r in owners], [
+            [dbname, result["user"]], [source, src["user"]]])
+
+        # Cloning again just returns the existing clone.
+        again = yield plug.call_clone_database(
+            {"name": dbname, "source": source})
+        self.assertEqual(again, result)
+
+    @inlineCallbacks
+    def test_call_clone_database_unknown_source(self):
+        """
+        We can only clone databases we know about.
+        """
+        plug = yield self.get_plugin()
+        result = yield plug.call_clone_database(
+            {"name": "xylem_test_clone_x", "source": "xylem_test_nope"})
+        self.assertEqual(result, {
+            "Err": "Template database xylem_test_nope not known to xylem"})
+        result = yield plug.call_create_database(
+            {"name": "xylem_test_clone_x", "template": "bad-name"})
+        self.assertEqual(result, {"Err": "Database name must be alphanumeric"})
+
+    @inlineCallbacks
+    def test_call_clone_database_in_use(self):
+        """
+        If the source is in use, we can't clone it.
+        """
+        source = "xylem_test_clone_busy"
+        dbname = "xylem_test_clone_busy_dst"
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+        yield self.dropdb(plug, source)
+        src = yield plug.call_create_database({"name": source})
+
+        pool = plug._get_connection(
+            source, "localhost", 5432, src["user"], src["password"])
+        self.addCleanup(pool.close)
+        yield pool.runQuery("SELECT 1;")
+
+        result = yield plug.call_clone_database(
+            {"name": dbname, "source": source})
+        self.assertTrue(result["Err"].startswith(
+            "Unable to clone %s: " % (source,)))
+
+    @inlineCallbacks
+    def test_replica_lookups(self):
+        """
+        Lookups go to a replica that's keeping up, and fall back to the
+        primary for databases the replica doesn't know about yet.
+        """
+        replica_db = "xylem_test_replica"
+        admin = self.get_plugin_no_setup()
+        yield self.dropdb(admin, replica_db)
+        yield self.run_operation(admin, "CREATE DATABASE %s;" % (replica_db,))
+
+        # Our "replica" is a separate database with its own databases table.
+        replica = admin._get_connection(
+            replica_db, "localhost", 5432, "postgres", "")
+        try:
+            yield replica.runOperation(
+                "CREATE TABLE databases (name varchar(66) UNIQUE, host"
+                " varchar(256), username varchar(256),"
+                " password varchar(256), drop_requested_at timestamptz);")
+            yield replica.runOperation(
+                "INSERT INTO databases VALUES (%s, %s, %s, %s);",
+                ("only_on_replica", "replica.example.com", "ruser",
+                 admin._encrypt("rpass")))
+        finally:
+            replica.close()
+
+        plug = yield self.get_plugin({
+            "db_replicas": [{"host": "localhost", "db_name": replica_db}],
+        })
+        yield plug._replicas.check_lag()
+
+        dbname = "xylem_test_create_replica"
+        yield self.dropdb(plug, dbname)
+        created = yield plug.call_create_database({"name": dbname})
+        plug._cache.clear()
+
+        # The replica doesn't have our new database, so we ask the primary.
+        found = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(found, created)
+
+        # Something only the replica knows about shows that we used it.
+        found = yield plug.call_create_database({"name": "only_on_replica"})
+        self.assertEqual(found["hostname"], "replica.example.com")
+        self.assertEqual(found["password"], "rpass")
+
+        stats = plug.call_pool_stats({})["replicas"]
+        [replica_stats] = stats["replicas"].values()
+        self.assertEqual(replica_stats["lag"], 0)
+        self.assertTrue(replica_stats["queries"] >= 3)
+
+    @inlineCallbacks
+    def test_sharded_metadata(self):
+        """
+        Lookups and listings find rows on any shard, and rebalancing moves
+        rows to the shard they belong on.
+        """
+        shard_db = "xylem_test_shard"
+        admin = self.get_plugin_no_setup()
+        yield self.dropdb(admin, shard_db)
+        yield self.run_operation(admin, "CREATE DATABASE %s;" % (shard_db,))
+
+        # Everything starts out on the main DB.
+        names = sorted("db_shard_%s" % (i,) for i in range(20))
+        plug = yield self.get_plugin()
+        yield self.add_db_rows(plug, *[(name, "h1") for name in names])
+        plug._shutdown()
+
+        plug = self.get_plugin_no_setup({"db_shards": [
+            {"name": "other", "host": "localhost", "db_name": shard_db}]})
+        yield plug._setup_db()
+        found = yield plug._find_dbs(names)
+        self.assertEqual(sorted(found), names)
+        listed = yield plug.call_list_databases({})
+        self.assertEqual([db["name"] for db in listed["databases"]], names)
+
+        result = yield plug.call_rebalance_shards({"batch_size": 7})
+        other = plug._shards.pool("other")
+        rows = yield other.runQuery("SELECT name FROM databases;")
+        on_other = sorted(row[0] for row in rows)
+        self.assertNotEqual(on_other, [])
+        self.assertEqual(on_other, [
+            n for n in names if plug._shards.shard_for(n) == "other"])
+        self.assertEqual(result, {
+            "Err": None, "moved": {"main": len(on_other), "other": 0}})
+        [[count]] = yield self.run_query(
+            plug, "SELECT count(*) FROM databases;")
+        self.assertEqual(count, len(names) - len(on_other))
+
+        plug._cache.clear()
+        found = yield plug._find_dbs(names)
+        self.assertEqual(sorted(found), names)
+        listed = yield plug.call_list_databases({})
+        self.assertEqual([db["name"] for db in listed["databases"]], names)
+        stats = plug.call_pool_stats({})
+        self.assertEqual(sorted(stats["shards"]), ["main", "other"])
+
+    @inlineCallbacks
+    def test_sharded_drop_before_rebalance(self):
+        """
+        Databases whose rows haven't been moved to a new shard yet can still
+        be dropped, have their profiles applied and record access times.
+        """
+        shard_db = "xylem_test_shard"
+        admin = self.get_plugin_no_setup()
+        yield self.dropdb(admin, shard_db)
+        yield self.run_operation(admin, "CREATE DATABASE %s;" % (shard_db,))
+        shard_config = {"db_shards": [
+            {"name": "other", "host": "localhost", "db_name": shard_db}]}
+        shards = self.get_plugin_no_setup(shard_config)._shards
+        dbname = next(
+            name for name in ("xylem_test_drop_shard%s" % i for i in range(20))
+            if shards.shard_for(name) == "other")
+
+        plug = yield self.get_plugin()
+        yield self.dropdb(plug, dbname)
+        yield plug.call_create_database({"name": dbname})
+        plug._shutdown()
+
+        plug = self.get_plugin_no_setup(shard_config)
+        yield plug._setup_db()
+        self.no_background_checks(plug)
+
+        result = yield plug.call_apply_profile({"name": dbname})
+        self.assertEqual(result["Err"], None)
+        plug._accessed.add(dbname)
+        yield plug._flush_access_times()
+        [[accessed]] = yield self.run_query(
+            plug, "SELECT last_accessed IS NOT NULL FROM databases"
+            " WHERE name = %s;", (dbname,))
+        self.assertTrue(accessed)
+
+        result = yield plug.call_drop_database({"name": dbname})
+        self.assertEqual(
+            result, {"Err": None, "name": dbname, "status": "pending"})
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result, {"Err": "Database is being dropped"})
+
+        yield self.run_operation(
+            plug, "UPDATE databases"
+            " SET drop_requested_at = now() - interval '301 seconds';")
+        yield plug._drop_pending()
+        dbs = yield self.list_dbs(plug)
+        self.assertFalse(dbname in dbs)
+        rows = yield self.run_query(plug, "SELECT * FROM databases")
+        self.assertEqual(rows, [])
+
+    @inlineCallbacks
+    def add_db_rows(self, plug, *rows):
+        for name, host in rows:
+            yield self.run_operation(
+                plug, "INSERT INTO databases VALUES (%s, %s, %s, %s);",
+                (name, host, "u_" + name, plug._encrypt("p_" + name)))
+
+    @inlineCallbacks
+    def test_call_list_databases(self):
+        """
+        We can page through the databases we manage.
+        """
+        plug = yield self.get_plugin()
+        yield self.add_db_rows(
+            plug, ("db_c", "h1"), ("db_a", "h1"), ("db_e", "h2"),
+            ("db_b", "h2"), ("db_d", "h1"))
+
+        page = yield plug.call_list_databases({"limit": 2})
+        self.assertEqual(page, {"Err": None, "next": "db_b", "databases": [
+            {"name": "db_a", "hostname": "h1", "user": "u_db_a"},
+            {"name": "db_b", "hostname": "h2", "user": "u_db_b"},
+        ]})
+        names = [d["name"] for d in page["databases"]]
+        while page["next"] is not None:
+            page = yield plug.call_list_databases(
+                {"limit": 2, "after": page["next"]})
+            names.extend(d["name"] for d in page["databases"])
+        self.assertEqual(names, ["db_a", "db_b", "db_c", "db_d", "db_e"])
+
+    @inlineCallbacks
+    def test_call_list_databases_filtered(self):
+        """
+        We can list the databases on one host, with credentials if we ask for
+        them.
+        """
+        plug = yield self.get_plugin()
+        yield self.add_db_rows(
+            plug, ("db_a", "h1"), ("db_b", "h2"), ("db_c", "h1"))
+
+        page = yield plug.call_list_databases(
+            {"host": "h1", "include_credentials": True})
+        self.assertEqual(page, {"Err": None, "next": None, "databases": [
+            {"name": "db_a", "hostname": "h1", "user": "u_db_a",
+             "password": "p_db_a"},
+            {"name": "db_c", "hostname": "h1", "user": "u_db_c",
+             "password": "p_db_c"},
+        ]})
+
+    @inlineCallbacks
+    def test_call_list_databases_limits(self):
+        """
+        Page sizes must be positive and are capped.
+        """
+        plug = yield self.get_plugin({"list_max_page_size": 2})
+        yield self.add_db_rows(
+            plug, ("db_a", "h1"), ("db_b", "h1"), ("db_c", "h1"))
+
+        page = yield plug.call_list_databases({"limit": 100})
+        self.assertEqual(len(page["databases"]), 2)
+        self.assertEqual(page["next"], "db_b")
+
+        for limit in [0, -1, "10"]:
+            page = yield plug.call_list_databases({"limit": limit})
+            self.assertEqual(
+                page, {"Err": "limit must be a positive integer"})
+
+    @inlineCallbacks
+    def test_call_rotate_key(self):
+        """
+        Rotating the key re-encrypts every password that isn't encrypted with
+        the current key, and the passwords stay the same.
+        """
+        plug = yield self.get_plugin()
+        names = ["db_a", "db_b", "db_c"]
+        yield self.add_db_rows(plug, *[(name, "h1") for name in names])
+        plug._shutdown()
+
+        plug = self.get_plugin_no_setup({
+            "key": "newkey",
+            "key_id": "k2",
+            "unversioned_key": "mysecretkey",
+        })
+        yield plug._setup_db()
+        result = yield plug.call_rotate_key({"batch_size": 2})
+        self.assertEqual(result, {
+            "Err": None, "rotated": {"databases": 3, "warm_databases": 0}})
+        rows = yield self.run_query(
+            plug, "SELECT password FROM databases ORDER BY name;")
+        self.assertTrue(all(row[0].startswith("k2$") for row in rows))
+        page = yield plug.call_list_databases({"include_credentials": True})
+        self.assertEqual(
+            [db["password"] for db in page["databases"]],
+            ["p_" + name for name in names])
+
+        # Everything is already on the current key.
+        result = yield plug.call_rotate_key({})
+        self.assertEqual(result["rotated"], {
+            "databases": 0, "warm_databases": 0})
 
     @inlineCallbacks
     def test_call_create_database_existing_unknown(self):
@@ -272,3 +1412,255 @@ class TestPostgresPlugin(TestCase):
 
         dbs = yield self.list_dbs(plug)
         self.assertTrue(dbname in dbs)
+
+    @inlineCallbacks
+    def test_call_reconcile(self):
+        """
+        Reconciling reports databases we don't know about, databases we know
+        about that don't exist, and databases whose owner doesn't match.
+        """
+        plug = yield self.get_plugin()
+        self.no_background_checks(plug)
+        yield plug.call_create_database({"name": "xylem_test_reconcile_ok"})
+        self.addCleanup(self._dropdb, plug, "xylem_test_reconcile_ok")
+        yield self.dropdb(plug, "xylem_test_reconcile_orphan")
+        yield self.run_operation(
+            plug, "CREATE DATABASE xylem_test_reconcile_orphan;")
+        yield self.dropdb(plug, "xylem_test_reconcile_owner")
+        yield self.run_operation(
+            plug, "CREATE DATABASE xylem_test_reconcile_owner;")
+        yield self.add_db_rows(
+            plug,
+            ("xylem_test_reconcile_missing", "localhost"),
+            ("xylem_test_reconcile_owner", "localhost"),
+            ("xylem_test_reconcile_gone", "db.example.com"))
+
+        result = yield plug.call_reconcile({})
+        self.assertEqual(result["Err"], None)
+        self.assertEqual(result["unknown_servers"], {
+            "db.example.com": ["xylem_test_reconcile_gone"]})
+        report = result["servers"]["localhost"]
+        self.assertEqual(report["Err"], None)
+        self.assertIn("xylem_test_reconcile_orphan", report["orphans"])
+        self.assertNotIn("xylem_test_reconcile_ok", report["orphans"])
+        self.assertNotIn("xylem_test_db", report["orphans"])
+        self.assertNotIn("postgres", report["orphans"])
+        self.assertEqual(report["missing"], ["xylem_test_reconcile_missing"])
+        self.assertEqual(report["role_mismatches"], [{
+            "name": "xylem_test_reconcile_owner",
+            "user": "u_xylem_test_reconcile_owner",
+            "owner": "postgres",
+            "role_exists": False,
+        }])
+
+    @inlineCallbacks
+    def test_call_reconcile_unreachable(self):
+        """
+        Servers we can't reach are reported without affecting the others.
+        """
+        plug = yield self.get_plugin({"servers": [
+            {"hostname": "localhost"},
+            {"hostname": "localhost-broken", "connect_addr": "localhost",
+             "port": 1},
+        ]})
+        self.no_background_checks(plug)
+        result = yield plug.call_reconcile({})
+        self.assertEqual(result["servers"]["localhost"]["Err"], None)
+        self.assertNotEqual(
+            result["servers"]["localhost-broken"]["Err"], None)
+
+    def test_reconcile_schedule(self):
+        """
+        Reconciliation only runs on a schedule if one is configured.
+        """
+        plug = self.get_plugin_no_setup()
+        self.assertFalse(hasattr(plug.call_reconcile, "cronable"))
+        plug = self.get_plugin_no_setup(
+            {"reconcile_schedule": {"hour": "*/6"}})
+        self.assertEqual(plug.call_reconcile.cronable.name, "call_reconcile")
+
+    @inlineCallbacks
+    def test_call_drop_database(self):
+        """
+        Dropping a database hides it straight away, and the database and its
+        user are removed in the background.
+        """
+        dbname = "xylem_test_drop"
+        plug = yield self.get_plugin()
+        self.no_background_checks(plug)
+        yield self.dropdb(plug, dbname)
+        created = yield plug.call_create_database({"name": dbname})
+
+        result = yield plug.call_drop_database({"name": dbname})
+        self.assertEqual(
+            result, {"Err": None, "name": dbname, "status": "pending"})
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result, {"Err": "Database is being dropped"})
+        listing = yield plug.call_list_databases({})
+        self.assertEqual(listing["databases"], [])
+
+        # Other nodes may have it cached, so it isn't removed until their
+        # caches have expired.
+        yield plug._drop_pending()
+        dbs = yield self.list_dbs(plug)
+        self.assertTrue(dbname in dbs)
+
+        yield self.run_operation(
+            plug, "UPDATE databases"
+            " SET drop_requested_at = now() - interval '301 seconds';")
+        yield plug._drop_pending()
+        dbs = yield self.list_dbs(plug)
+        self.assertFalse(dbname in dbs)
+        roles = yield self.run_query(
+            plug, "SELECT 1 FROM pg_roles WHERE rolname = %s",
+            (created["user"],))
+        self.assertEqual(roles, [])
+        rows = yield self.run_query(plug, "SELECT * FROM databases")
+        self.assertEqual(rows, [])
+
+        # Now that it's gone, we can have it back.
+        result = yield plug.call_create_database({"name": dbname})
+        self.assertEqual(result["Err"], None)
+
+    @inlineCallbacks
+    def test_call_drop_database_unknown(self):
+        """
+        We can only drop databases we know about.
+        """
+        plug = yield self.get_plugin()
+        result = yield plug.call_drop_database({"name": "xylem_test_nope"})
+        self.assertEqual(result, {"Err": "Database not known to xylem"})
+        result = yield plug.call_drop_database({"name": "-"})
+        self.assertEqual(result, {"Err": "Database name must be alphanumeric"})
+
+    @inlineCallbacks
+    def test_drop_batches(self):
+        """
+        Each run drops a limited number of databases per server.
+        """
+        names = ["xylem_test_drop_batch%s" % i for i in range(3)]
+        plug = yield self.get_plugin({"drop_batch_size": 2})
+        self.no_background_checks(plug)
+        for name in names:
+            yield self.dropdb(plug, name)
+        yield plug.call_create_databases({"names": names})
+        yield self.run_operation(
+            plug, "UPDATE databases"
+            " SET drop_requested_at = now() - interval '1 hour';")
+
+        yield plug._drop_pending()
+        rows = yield self.run_query(plug, "SELECT name FROM databases")
+        self.assertEqual(len(rows), 1)
+        yield plug._drop_pending()
+        rows = yield self.run_query(plug, "SELECT name FROM databases")
+        self.assertEqual(rows, [])
+        dbs = yield self.list_dbs(plug)
+        self.assertEqual([n for n in names if n in dbs], [])
+
+    PROFILES = {
+        "small": {
+            "connection_limit": 5,
+            "statement_timeout": "30s",
+            "work_mem": "4MB",
+        },
+        "big": {"connection_limit": 50},
+    }
+
+    @inlineCallbacks
+    def get_limits(self, plug, dbname):
+        """
+        Look up the connection limits and settings applied to a database.
+        """
+        [[db_limit, role_limit]] = yield self.run_query(
+            plug,
+            "SELECT d.datconnlimit, r.rolconnlimit FROM pg_database d"
+            " JOIN pg_roles r ON r.oid = d.datdba WHERE d.datname = %s",
+            (dbname,))
+        settings = yield self.run_query(
+            plug,
+            "SELECT s.setconfig FROM pg_db_role_setting s JOIN pg_database d"
+            " ON d.oid = s.setdatabase WHERE d.datname = %s"
+            " AND s.setrole = 0", (dbname,))
+        returnValue((db_limit, role_limit, sorted(
+            settings[0][0] if settings else [])))
+
+    @inlineCallbacks
+    def test_create_database_profile(self):
+        """
+        A database created with a resource profile gets its limits, and we
+        record which profile it has.
+        """
+        dbname = "xylem_test_profile"
+        plug = yield self.get_plugin({"resource_profiles": self.PROFILES})
+        yield self.dropdb(plug, dbname)
+
+        result = yield plug.call_create_database(
+            {"name": dbname, "profile": "small"})
+        self.assertEqual(result["Err"], None)
+        limits = yield self.get_limits(plug, dbname)
+        self.assertEqual(
+            limits, (5, 5, ["statement_timeout=30s", "work_mem=4MB"]))
+        rows = yield self.run_query(
+            plug, "SELECT profile FROM databases WHERE name = %s", (dbname,))
+        self.assertEqual(rows[0][0], "small")
+
+        result = yield plug.call_create_database(
+            {"name": "xylem_test_nope", "profile": "huge"})
+        self.assertEqual(result, {"Err": "Unknown resource profile: huge"})
+
+    @inlineCallbacks
+    def test_create_databases_server_profile(self):
+        """
+        Servers can set a default profile, which batches use too.
+        """
+        dbname = "xylem_test_profile_batch"
+        plug = yield self.get_plugin({
+            "resource_profiles": self.PROFILES,
+            "servers": [{"hostname": "localhost", "resource_profile": "big"}],
+        })
+        yield self.dropdb(plug, dbname)
+
+        result = yield plug.call_create_databases({"names": [dbname]})
+        self.assertEqual(result["results"][dbname]["Err"], None)
+        limits = yield self.get_limits(plug, dbname)
+        self.assertEqual(limits, (50, 50, []))
+
+    @inlineCallbacks
+    def test_call_apply_profile(self):
+        """
+        We can apply a profile again, switch to a different one, or remove
+        it altogether.
+        """
+        dbname = "xylem_test_profile_apply"
+        profiles = {"small": dict(self.PROFILES["small"])}
+        plug = yield self.get_plugin({"resource_profiles": profiles})
+        yield self.dropdb(plug, dbname)
+        yield plug.call_create_database({"name": dbname, "profile": "small"})
+
+        profiles["small"]["connection_limit"] = 10
+        del profiles["small"]["work_mem"]
+        result = yield plug.call_apply_profile({"name": dbname})
+        self.assertEqual(
+            result, {"Err": None, "name": dbname, "profile": "small"})
+        limits = yield self.get_limits(plug, dbname)
+        self.assertEqual(limits, (10, 10, ["statement_timeout=30s"]))
+
+        result = yield plug.call_apply_profile(
+            {"name": dbname, "profile": None})
+        self.assertEqual(result["profile"], None)
+        limits = yield self.get_limits(plug, dbname)
+        self.assertEqual(limits, (-1, -1, []))
+        rows = yield self.run_query(
+            plug, "SELECT profile FROM databases WHERE name = %s", (dbname,))
+        self.assertEqual(rows[0][0], None)
+
+        result = yield plug.call_apply_profile({"name": "xylem_test_nope"})
+        self.assertEqual(result, {"Err": "Database not known to xylem"})
+
+    def test_bad_profile_setting(self):
+        """
+        Profiles can only have the settings we know how to apply.
+        """
+        self.assertRaises(
+            ValueError, self.get_plugin_no_setup,
+            {"resource_profiles": {"bad": {"shared_buffers": "1GB"}}})